@@ -1,22 +1,166 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+import os
+
+# Асинхронный режим сервера: threading, eventlet или gevent. Зелёные потоки должны
+# пропатчить стандартную библиотеку до импорта Flask, SQLAlchemy и драйверов базы
+ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, make_response, session, g, abort, \
+    send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from sqlalchemy import bindparam, case, column, delete, event, func, insert, literal_column, select, table, tuple_, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, make_transient_to_detached, selectinload
+from sqlalchemy.orm.util import identity_key
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import os
+from functools import wraps
+import atexit
+import click
+import csv
+import glob
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import mimetypes
+import re
+import signal
+import sys
+import threading
+import time
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///chat.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///chat.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True}
+app.config['SOCKETIO_ASYNC_MODE'] = ASYNC_MODE
+# С зелёными потоками тысячи соединений делят один процесс, поэтому пул ограничен и для SQLite:
+# лишние гринлеты ждут свободного соединения, а не открывают новые
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') or ASYNC_MODE != 'threading':
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update({
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    })
+# Прагмы применяются к каждому новому соединению с SQLite
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),  # мс
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -64000)),  # отрицательное значение - в КиБ
+    # Без этого SQLite молча принимает строки со ссылкой на удалённого пользователя
+    'foreign_keys': os.environ.get('SQLITE_FOREIGN_KEYS', 'ON'),
+}
+# Очередь сообщений Socket.IO (redis://..., amqp://...) нужна, когда воркеров больше одного
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+# Склейка событий комнаты чата в один кадр events_batch (0 - каждое событие отдельным кадром)
+app.config['SOCKETIO_BATCH_WINDOW_MS'] = int(os.environ.get('SOCKETIO_BATCH_WINDOW_MS', 0))
+# Пачки в msgpack бинарным вложением вместо JSON (нужен пакет msgpack)
+app.config['SOCKETIO_COMPACT_PAYLOADS'] = os.environ.get('SOCKETIO_COMPACT_PAYLOADS', '0') == '1'
+# Без sticky-сессий long-polling между воркерами не работает, поэтому там только websocket
+app.config['SOCKETIO_TRANSPORTS'] = os.environ.get(
+    'SOCKETIO_TRANSPORTS', 'websocket' if app.config['SOCKETIO_MESSAGE_QUEUE'] else 'polling,websocket'
+).split(',')
+# Комната, в которую попадают /chat и сообщения, написанные до появления комнат
+app.config['CHAT_DEFAULT_ROOM'] = os.environ.get('CHAT_DEFAULT_ROOM', 'general')
+app.config['CHAT_PAGE_SIZE'] = int(os.environ.get('CHAT_PAGE_SIZE', 50))
+app.config['CHAT_HISTORY_MAX_PAGE'] = 200
+# Догонка после переподключения: сколько последних событий комнаты держать в памяти
+# и сколько сообщений отдавать из базы, если разрыв больше буфера (иначе клиент перезагружает страницу)
+app.config['CHAT_EVENT_BUFFER'] = int(os.environ.get('CHAT_EVENT_BUFFER', 1000))
+app.config['CHAT_SYNC_MAX_MESSAGES'] = int(os.environ.get('CHAT_SYNC_MAX_MESSAGES', 500))
+app.config['PRESENCE_BACKEND'] = os.environ.get('PRESENCE_BACKEND', 'memory')  # memory или redis://...
+app.config['PRESENCE_TTL'] = int(os.environ.get('PRESENCE_TTL', 90))
+app.config['PRESENCE_FLUSH_INTERVAL'] = int(os.environ.get('PRESENCE_FLUSH_INTERVAL', 60))
+# Отложенная запись сообщений чата пачками (write-behind)
+app.config['CHAT_WRITE_BEHIND'] = os.environ.get('CHAT_WRITE_BEHIND', '0') == '1'
+app.config['CHAT_WRITE_BATCH_SIZE'] = int(os.environ.get('CHAT_WRITE_BATCH_SIZE', 200))
+app.config['CHAT_WRITE_INTERVAL_MS'] = int(os.environ.get('CHAT_WRITE_INTERVAL_MS', 50))
+app.config['CHAT_WRITE_DURABILITY'] = os.environ.get('CHAT_WRITE_DURABILITY', 'async')  # async, group_commit
+app.config['CHAT_WRITE_COMMIT_TIMEOUT'] = float(os.environ.get('CHAT_WRITE_COMMIT_TIMEOUT', 5))
+app.config['CATALOG_PAGE_SIZE'] = int(os.environ.get('CATALOG_PAGE_SIZE', 24))
+app.config['CATALOG_MAX_PAGE_SIZE'] = 100
+# TTL ограничивает устаревание кэша каталога в других воркерах
+app.config['CATALOG_CACHE_TTL'] = int(os.environ.get('CATALOG_CACHE_TTL', 300))
+app.config['CATALOG_CACHE_SIZE'] = int(os.environ.get('CATALOG_CACHE_SIZE', 256))  # страниц в LRU
+app.config['ADMIN_PAGE_SIZE'] = int(os.environ.get('ADMIN_PAGE_SIZE', 50))
+app.config['ORDERS_PAGE_SIZE'] = int(os.environ.get('ORDERS_PAGE_SIZE', 10))
+app.config['CART_SUMMARY_TTL'] = int(os.environ.get('CART_SUMMARY_TTL', 300))
+# Хэширование паролей: метод Werkzeug задаёт стоимость, например 'scrypt:32768:8:1' или 'pbkdf2:sha256:600000'
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+# Ограничение попыток входа до проверки пароля
+app.config['LOGIN_IP_BURST'] = int(os.environ.get('LOGIN_IP_BURST', 20))
+app.config['LOGIN_IP_PER_MINUTE'] = int(os.environ.get('LOGIN_IP_PER_MINUTE', 20))
+app.config['LOGIN_USER_BURST'] = int(os.environ.get('LOGIN_USER_BURST', 5))
+app.config['LOGIN_USER_PER_MINUTE'] = int(os.environ.get('LOGIN_USER_PER_MINUTE', 5))
+# Ограничение частоты событий сокета и JSON-мутаций по ролям: (burst, в минуту)
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # memory или redis://...
+app.config['RATE_LIMITS'] = {
+    role: (int(os.environ.get(f'RATE_LIMIT_{role.upper()}_BURST', burst)),
+           int(os.environ.get(f'RATE_LIMIT_{role.upper()}_PER_MINUTE', per_minute)))
+    for role, burst, per_minute in (('creator', 60, 600), ('moderator', 30, 240), ('user', 10, 60))
+}
+# Общий лимит на комнату: сколько событий в неё могут разослать все пользователи вместе
+app.config['RATE_LIMIT_ROOM_BURST'] = int(os.environ.get('RATE_LIMIT_ROOM_BURST', 100))
+app.config['RATE_LIMIT_ROOM_PER_MINUTE'] = int(os.environ.get('RATE_LIMIT_ROOM_PER_MINUTE', 1200))
+# Метрики: квантили считаются по последним METRICS_WINDOW наблюдениям каждой серии
+app.config['METRICS_WINDOW'] = int(os.environ.get('METRICS_WINDOW', 1024))
+# Токен для сборщика метрик (Authorization: Bearer ...); без него /metrics доступен только создателю
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['SLOW_QUERY_MS'] = int(os.environ.get('SLOW_QUERY_MS', 0))  # 0 - лог медленных запросов выключен
+app.config['PROFILER_ENABLED'] = os.environ.get('PROFILER_ENABLED', '0') == '1'
+app.config['PROFILER_INTERVAL_MS'] = int(os.environ.get('PROFILER_INTERVAL_MS', 10))
+# Кэш пользователей для user_loader. Сброс виден только своему воркеру, поэтому
+# с очередью кэш по умолчанию выключен (TTL 0), иначе смена роли доходила бы до остальных через TTL
+app.config['USER_CACHE_TTL'] = int(os.environ.get(
+    'USER_CACHE_TTL', 0 if app.config['SOCKETIO_MESSAGE_QUEUE'] else 60))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1000))
+# Хранение истории чата: старые сообщения переносятся в сжатые JSONL-архивы по дням (0 - без ограничения)
+app.config['CHAT_RETENTION_DAYS'] = int(os.environ.get('CHAT_RETENTION_DAYS', 0))
+app.config['CHAT_RETENTION_MAX_MESSAGES'] = int(os.environ.get('CHAT_RETENTION_MAX_MESSAGES', 0))
+app.config['CHAT_ARCHIVE_DIR'] = os.environ.get('CHAT_ARCHIVE_DIR', os.path.join(app.instance_path, 'archive'))
+app.config['CHAT_RETENTION_BATCH'] = int(os.environ.get('CHAT_RETENTION_BATCH', 500))
+app.config['CHAT_RETENTION_PAUSE'] = float(os.environ.get('CHAT_RETENTION_PAUSE', 0.05))
+app.config['CHAT_RETENTION_INTERVAL'] = int(os.environ.get('CHAT_RETENTION_INTERVAL', 3600))
+app.config['DB_VACUUM_INTERVAL'] = int(os.environ.get('DB_VACUUM_INTERVAL', 7 * 24 * 3600))
+app.config['BULK_CHUNK_SIZE'] = int(os.environ.get('BULK_CHUNK_SIZE', 500))
+app.config['MUTE_FLUSH_INTERVAL'] = int(os.environ.get('MUTE_FLUSH_INTERVAL', 30))
+# Муты, выданные в других воркерах, подтягиваются из базы с этим интервалом (0 - выключено)
+app.config['MUTE_REFRESH_INTERVAL'] = int(os.environ.get(
+    'MUTE_REFRESH_INTERVAL', 5 if app.config['SOCKETIO_MESSAGE_QUEUE'] else 0))
+# Статика: минифицированные копии с хешем содержимого в имени, заранее сжатые gzip (и brotli, если установлен)
+app.config['ASSETS_DIR'] = os.environ.get('ASSETS_DIR', os.path.join(app.static_folder, 'dist'))
+# В продакшене статику собирает flask build-assets при деплое; сборка при старте - для разработки
+app.config['ASSETS_BUILD_ON_STARTUP'] = os.environ.get('ASSETS_BUILD_ON_STARTUP', '0') == '1'
+app.config['ASSETS_MAX_AGE'] = int(os.environ.get('ASSETS_MAX_AGE', 365 * 24 * 3600))
+
 
 db = SQLAlchemy(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+                    async_mode=app.config['SOCKETIO_ASYNC_MODE'])
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
 
+ROLES = ['creator', 'moderator', 'user']
+
+
 # Модели базы данных
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -31,38 +175,88 @@ class User(UserMixin, db.Model):
     orders = db.relationship('Order', backref='customer', lazy=True, cascade='all, delete-orphan')
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.check(self.password_hash, password)
 
     def is_creator(self):
         return self.role == 'creator'
 
-    def is_moderator(self):
-        return self.role in ['creator', 'moderator']
+    def is_moderator(self, room_id=None):
+        # Глобальная роль или назначение модератором конкретной комнаты
+        if self.role in ['creator', 'moderator']:
+            return True
+        if room_id is None:
+            return False
+        return db.session.query(
+            RoomModerator.query.filter_by(room_id=room_id, user_id=self.id).exists()).scalar()
+
+    def check_mute_status(self, room_id=None):
+        return mute_registry.is_muted(self.id, room_id)
+
+
+class Room(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    slug = db.Column(db.String(50), unique=True, nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @property
+    def channel(self):
+        return room_channel(self.id)
+
+    def to_dict(self):
+        return {'id': self.id, 'slug': self.slug, 'name': self.name}
+
+
+def room_channel(room_id):
+    # Имя комнаты Socket.IO: события получают только её участники
+    return f'room:{room_id}'
+
+
+class RoomMute(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    mute_until = db.Column(db.DateTime, nullable=True)
 
-    def check_mute_status(self):
-        if self.is_muted and self.mute_until:
-            if datetime.utcnow() > self.mute_until:
-                self.is_muted = False
-                self.mute_until = None
-                db.session.commit()
-        return self.is_muted
+    __table_args__ = (db.UniqueConstraint('room_id', 'user_id', name='uq_room_mute_room_user'),)
+
+
+class RoomModerator(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('room_id', 'user_id', name='uq_room_moderator_room_user'),)
 
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False)
     text = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
-    def to_dict(self):
+    # Курсор истории чата идёт по (timestamp, id) - каждая страница это range scan по индексу;
+    # история комнаты читается по (room_id, timestamp, id)
+    __table_args__ = (db.Index('ix_message_timestamp_id', 'timestamp', 'id'),
+                      db.Index('ix_message_room_timestamp_id', 'room_id', 'timestamp', 'id'))
+
+    @property
+    def cursor(self):
+        return f'{self.timestamp.isoformat()}|{self.id}'
+
+    def to_dict(self, author=None):
+        # author передаётся явно там, где он уже загружен, чтобы не дёргать ленивый backref
+        author = author or self.author
         return {
             'id': self.id,
-            'username': self.author.username,
+            'room_id': self.room_id,
+            'username': author.username,
             'user_id': self.user_id,
-            'role': self.author.role,
+            'role': author.role,
             'text': self.text,
             'timestamp': self.timestamp.strftime('%H:%M')
         }
@@ -78,6 +272,8 @@ class Product(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     cart_items = db.relationship('CartItem', backref='product', lazy=True, cascade='all, delete-orphan')
 
+    __table_args__ = (db.Index('ix_product_stock_id', 'stock', 'id'),)
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -97,6 +293,9 @@ class CartItem(db.Model):
     added_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
+ORDER_STATUSES = ['pending', 'paid', 'shipped', 'completed', 'cancelled']
+
+
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -107,6 +306,25 @@ class Order(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     items = db.relationship('OrderItem', backref='order', lazy=True, cascade='all, delete-orphan')
 
+    __table_args__ = (
+        db.Index('ix_order_created_at', 'created_at'),
+        db.Index('ix_order_status_created_at', 'status', 'created_at'),
+        db.Index('ix_order_user_id_created_at', 'user_id', 'created_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'username': self.customer.username,
+            'total_price': self.total_price,
+            'status': self.status,
+            'delivery_address': self.delivery_address,
+            'contact_info': self.contact_info,
+            'created_at': self.created_at.isoformat(),
+            'items': [item.to_dict() for item in self.items]
+        }
+
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -116,10 +334,1535 @@ class OrderItem(db.Model):
     quantity = db.Column(db.Integer, nullable=False)
     product_image = db.Column(db.String(500), nullable=True)
 
+    def to_dict(self):
+        return {
+            'product_name': self.product_name,
+            'product_price': self.product_price,
+            'quantity': self.quantity,
+            'product_image': self.product_image
+        }
+
+
+# Агрегаты продаж, обновляются инкрементально при оформлении заказа и смене статуса.
+# Отменённые заказы в дневную и товарную статистику не входят
+class SalesDaily(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    orders_count = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+    def to_dict(self):
+        return {
+            'day': self.day.isoformat(),
+            'orders_count': self.orders_count,
+            'units': self.units,
+            'revenue': round(self.revenue, 2)
+        }
+
+
+class ProductSales(db.Model):
+    product_name = db.Column(db.String(200), primary_key=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+    __table_args__ = (db.Index('ix_product_sales_units', 'units'),)
+
+    def to_dict(self):
+        return {'product_name': self.product_name, 'units': self.units, 'revenue': round(self.revenue, 2)}
+
+
+class OrderStatusStats(db.Model):
+    status = db.Column(db.String(50), primary_key=True)
+    orders_count = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+
+def parse_message_cursor(cursor):
+    try:
+        timestamp, message_id = cursor.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def fetch_messages_page(room_id, before=None, limit=None):
+    # Последние limit сообщений комнаты старше курсора, в хронологическом порядке
+    limit = limit or app.config['CHAT_PAGE_SIZE']
+    query = Message.query.options(joinedload(Message.author)).filter(Message.room_id == room_id)
+    if before:
+        query = query.filter(tuple_(Message.timestamp, Message.id) < before)
+
+    rows = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    messages = rows[:limit]
+    messages.reverse()
+    return messages, has_more
+
+
+# Хэширование паролей в отдельном пуле потоков, чтобы не блокировать обработку сокетов.
+# hashlib отпускает GIL, а под eventlet/gevent используются их собственные пулы настоящих потоков
+class PasswordHasher:
+    def __init__(self, workers, method):
+        self.method = method
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+
+    def run(self, func, *args):
+        if socketio.async_mode == 'eventlet':
+            from eventlet import tpool
+            return tpool.execute(func, *args)
+        if socketio.async_mode == 'gevent':
+            import gevent
+            return gevent.get_hub().threadpool.spawn(func, *args).get()
+        return self._executor.submit(func, *args).result()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def check(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def hash_many(self, passwords):
+        if socketio.async_mode == 'threading':
+            return list(self._executor.map(lambda password: generate_password_hash(password, self.method),
+                                            passwords))
+        return [self.hash(password) for password in passwords]
+
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_METHOD'])
+
+
+class TokenBucketLimiter:
+    max_keys = 10000
+
+    def __init__(self, capacity, per_minute):
+        self.capacity = capacity
+        self.rate = per_minute / 60  # токенов в секунду
+        self._buckets = {}  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def allow(self, key, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated_at) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+        return allowed
+
+    def _prune(self, now):
+        # Полностью восстановившиеся корзины ничем не отличаются от отсутствующих
+        for key, (tokens, updated_at) in list(self._buckets.items()):
+            if tokens + (now - updated_at) * self.rate >= self.capacity:
+                del self._buckets[key]
+
+
+class RedisTokenBucketLimiter:
+    # Та же корзина, но в Redis, чтобы лимит был общим для всех воркеров
+    script = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return allowed
+"""
+
+    def __init__(self, url, capacity, per_minute, prefix):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._allow = self._redis.register_script(self.script)
+        self.capacity = capacity
+        self.rate = per_minute / 60
+        self.prefix = prefix
+
+    def allow(self, key, cost=1):
+        return bool(self._allow(keys=[f'{self.prefix}:{key}'],
+                                args=[self.capacity, self.rate, time.time(), cost]))
+
+
+def create_token_bucket(url, capacity, per_minute, prefix):
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisTokenBucketLimiter(url, capacity, per_minute, prefix)
+    return TokenBucketLimiter(capacity, per_minute)
+
+
+login_ip_limiter = TokenBucketLimiter(app.config['LOGIN_IP_BURST'], app.config['LOGIN_IP_PER_MINUTE'])
+login_user_limiter = TokenBucketLimiter(app.config['LOGIN_USER_BURST'], app.config['LOGIN_USER_PER_MINUTE'])
+
+
+# Лимиты действий пользователей: корзина на (действие, пользователь) с параметрами его роли
+# и общая корзина комнаты для событий, которые рассылаются всем
+class ActionRateLimiter:
+    def __init__(self, url, role_limits, room_limit):
+        self.role_limits = role_limits
+        self._roles = {role: create_token_bucket(url, burst, per_minute, f'ratelimit:{role}')
+                       for role, (burst, per_minute) in role_limits.items()}
+        self._rooms = create_token_bucket(url, *room_limit, 'ratelimit:room')
+        self._counters = defaultdict(lambda: {'allowed': 0, 'limited': 0})
+        self._lock = threading.Lock()
+
+    def allow(self, user, action, room=None):
+        bucket = self._roles.get(user.role, self._roles['user'])
+        allowed = bucket.allow(f'{action}:{user.id}')
+        if allowed and room:
+            allowed = self._rooms.allow(room)
+
+        with self._lock:
+            self._counters[action]['allowed' if allowed else 'limited'] += 1
+        return allowed
+
+    def stats(self):
+        with self._lock:
+            counters = {action: dict(counts) for action, counts in self._counters.items()}
+        return {'limits': self.role_limits, 'counters': counters}
+
+
+rate_limiter = ActionRateLimiter(app.config['RATE_LIMIT_BACKEND'], app.config['RATE_LIMITS'],
+                                 (app.config['RATE_LIMIT_ROOM_BURST'], app.config['RATE_LIMIT_ROOM_PER_MINUTE']))
+
+
+def rate_limit(action):
+    # Ставится под login_required: лишние запросы отсекаются до обращения к базе
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not rate_limiter.allow(current_user, action):
+                return jsonify({'success': False, 'message': 'Слишком много запросов. Попробуйте позже'}), 429
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Присутствие пользователей в комнатах: сессии сокетов живут в памяти (или в общем бэкенде),
+# а last_seen сбрасывается в базу пачками
+class MemoryPresenceBackend:
+    def __init__(self):
+        self._rooms = {}  # room_id -> {user_id: {sid: expires_at}}
+        self._lock = threading.Lock()
+
+    def touch(self, room_id, user_id, sid, expires_at, now):
+        # True, если до этого у пользователя не было живых сессий в комнате
+        with self._lock:
+            sessions = self._rooms.setdefault(room_id, {}).setdefault(user_id, {})
+            first = not any(expires >= now for expires in sessions.values())
+            sessions[sid] = expires_at
+            return first
+
+    def remove(self, room_id, user_id, sid, now):
+        # True, если это была последняя живая сессия пользователя в комнате
+        with self._lock:
+            users = self._rooms.get(room_id, {})
+            sessions = users.get(user_id)
+            if sessions is None:
+                return False
+            sessions.pop(sid, None)
+            if any(expires >= now for expires in sessions.values()):
+                return False
+            del users[user_id]
+            if not users:
+                del self._rooms[room_id]
+            return True
+
+    def online_user_ids(self, room_id, now):
+        with self._lock:
+            users = self._rooms.get(room_id, {})
+            for user_id, sessions in list(users.items()):
+                if max(sessions.values()) < now:
+                    del users[user_id]
+            return set(users)
+
+
+class RedisPresenceBackend:
+    # Общее состояние для нескольких воркеров. На комнату sorted set пользователей
+    # (user_id -> самый поздний срок его сессий) и по sorted set сессий на пользователя (sid -> срок).
+    # Фигурные скобки в ключах держат всю комнату в одном слоте Redis Cluster
+    touch_script = """
+local now = tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', '(' .. now)
+local first = redis.call('ZCARD', KEYS[2]) == 0
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+local latest = tonumber(redis.call('ZRANGE', KEYS[2], -1, -1, 'WITHSCORES')[2])
+redis.call('ZADD', KEYS[1], latest, ARGV[1])
+redis.call('EXPIREAT', KEYS[2], math.ceil(latest))
+redis.call('EXPIREAT', KEYS[1], math.ceil(tonumber(redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')[2])))
+if first then
+    return 1
+end
+return 0
+"""
+    remove_script = """
+redis.call('ZREM', KEYS[2], ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[3])
+local latest = redis.call('ZRANGE', KEYS[2], -1, -1, 'WITHSCORES')[2]
+if latest then
+    redis.call('ZADD', KEYS[1], latest, ARGV[1])
+    return 0
+end
+return redis.call('ZREM', KEYS[1], ARGV[1])
+"""
+
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._touch = self._redis.register_script(self.touch_script)
+        self._remove = self._redis.register_script(self.remove_script)
+
+    @staticmethod
+    def _keys(room_id, user_id):
+        return [f'presence:{{{room_id}}}:users', f'presence:{{{room_id}}}:{user_id}']
+
+    def touch(self, room_id, user_id, sid, expires_at, now):
+        return bool(self._touch(keys=self._keys(room_id, user_id), args=[user_id, sid, expires_at, now]))
+
+    def remove(self, room_id, user_id, sid, now):
+        return bool(self._remove(keys=self._keys(room_id, user_id), args=[user_id, sid, now]))
+
+    def online_user_ids(self, room_id, now):
+        key = self._keys(room_id, 0)[0]
+        self._redis.zremrangebyscore(key, '-inf', f'({now}')
+        return {int(user_id) for user_id in self._redis.zrange(key, 0, -1)}
+
+
+class PresenceTracker:
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self._last_seen = {}  # user_id -> datetime, ещё не записанные в базу
+        self._sid_rooms = {}  # sid -> {room_id, ...}; сокет, как и комнаты Socket.IO, живёт в одном процессе
+        self._lock = threading.Lock()
+
+    def mark_seen(self, user_id):
+        with self._lock:
+            self._last_seen[user_id] = datetime.utcnow()
+
+    def connect(self, user_id, sid):
+        self.mark_seen(user_id)
+
+    def heartbeat(self, user_id, sid):
+        # Продлевает сессию во всех комнатах сокета: без этого её уберут по сроку, как после падения воркера
+        now = time.time()
+        with self._lock:
+            room_ids = list(self._sid_rooms.get(sid, ()))
+        for room_id in room_ids:
+            self.backend.touch(room_id, user_id, sid, now + self.ttl, now)
+        self.mark_seen(user_id)
+
+    def join(self, room_id, user_id, sid):
+        # True, если это первая сессия пользователя в комнате
+        with self._lock:
+            self._sid_rooms.setdefault(sid, set()).add(room_id)
+        now = time.time()
+        return self.backend.touch(room_id, user_id, sid, now + self.ttl, now)
+
+    def leave(self, room_id, user_id, sid):
+        # True, если пользователь покинул комнату последней сессией
+        with self._lock:
+            room_ids = self._sid_rooms.get(sid)
+            if not room_ids or room_id not in room_ids:
+                return False
+            room_ids.discard(room_id)
+            if not room_ids:
+                del self._sid_rooms[sid]
+        return self.backend.remove(room_id, user_id, sid, time.time())
+
+    def disconnect(self, user_id, sid):
+        # Комнаты, которые пользователь покинул последней сессией
+        with self._lock:
+            room_ids = self._sid_rooms.pop(sid, set())
+        self.mark_seen(user_id)
+        now = time.time()
+        return [room_id for room_id in room_ids if self.backend.remove(room_id, user_id, sid, now)]
+
+    def is_member(self, room_id, sid):
+        with self._lock:
+            return room_id in self._sid_rooms.get(sid, ())
+
+    def online_user_ids(self, room_id):
+        return self.backend.online_user_ids(room_id, time.time())
+
+    def flush(self):
+        with self._lock:
+            pending, self._last_seen = self._last_seen, {}
+        if not pending:
+            return
+
+        try:
+            # Core executemany: пользователи, удалённые за время буферизации, просто пропускаются
+            user_table = User.__table__
+            db.session.execute(
+                user_table.update()
+                .where(user_table.c.id == bindparam('user_id'))
+                .values(last_seen=bindparam('last_seen')),
+                [{'user_id': user_id, 'last_seen': last_seen} for user_id, last_seen in pending.items()]
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for user_id, last_seen in pending.items():
+                    self._last_seen.setdefault(user_id, last_seen)
+            raise
+
+
+def create_presence_backend(url):
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisPresenceBackend(url)
+    return MemoryPresenceBackend()
+
+
+presence = PresenceTracker(create_presence_backend(app.config['PRESENCE_BACKEND']),
+                           app.config['PRESENCE_TTL'])
+if app.config['SOCKETIO_MESSAGE_QUEUE'] and isinstance(presence.backend, MemoryPresenceBackend):
+    app.logger.warning('PRESENCE_BACKEND=memory: каждый воркер видит в комнатах только своих пользователей')
+
+
+# Реестр мутов в памяти: (user_id, room_id) -> mute_until (None - навсегда).
+# room_id None - мут во всех комнатах (User.is_muted), иначе мут в одной комнате (RoomMute).
+# Истёкшие муты снимаются лениво, а в базу изменения уходят фоновой задачей
+class MuteRegistry:
+    def __init__(self):
+        self._mutes = {}
+        self._expired = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        rows = db.session.query(User.id, User.mute_until).filter(User.is_muted.is_(True)).all()
+        room_rows = db.session.query(RoomMute.user_id, RoomMute.room_id, RoomMute.mute_until).all()
+        with self._lock:
+            self._mutes = {(user_id, None): mute_until for user_id, mute_until in rows}
+            self._mutes.update({(user_id, room_id): mute_until for user_id, room_id, mute_until in room_rows})
+            self._expired.clear()
+
+    def mute(self, user_id, mute_until, room_id=None):
+        with self._lock:
+            self._mutes[(user_id, room_id)] = mute_until
+            self._expired.discard((user_id, room_id))
+
+    def unmute(self, user_id, room_id=None):
+        with self._lock:
+            self._mutes.pop((user_id, room_id), None)
+            self._expired.discard((user_id, room_id))
+
+    def forget_user(self, user_id):
+        with self._lock:
+            for key in [key for key in self._mutes if key[0] == user_id]:
+                del self._mutes[key]
+
+    def _check(self, key, now):
+        if key not in self._mutes:
+            return False
+        mute_until = self._mutes[key]
+        if mute_until and now > mute_until:
+            del self._mutes[key]
+            self._expired.add(key)
+            return False
+        return True
+
+    def is_muted(self, user_id, room_id=None):
+        now = datetime.utcnow()
+        with self._lock:
+            return self._check((user_id, None), now) or \
+                (room_id is not None and self._check((user_id, room_id), now))
+
+    def muted_ids(self, room_id=None):
+        # Замученные глобально и (если задана комната) в этой комнате
+        now = datetime.utcnow()
+        with self._lock:
+            return {key[0] for key in list(self._mutes)
+                    if key[1] in (None, room_id) and self._check(key, now)}
+
+    def refresh(self):
+        self.flush()
+        self.load()
+
+    def flush(self):
+        with self._lock:
+            expired, self._expired = self._expired, set()
+        if not expired:
+            return
+
+        # Условие по mute_until не даёт затереть мут, выданный заново в другом процессе
+        now = datetime.utcnow()
+        user_ids = [user_id for user_id, room_id in expired if room_id is None]
+        room_keys = [(room_id, user_id) for user_id, room_id in expired if room_id is not None]
+        try:
+            if user_ids:
+                User.query.filter(User.id.in_(user_ids),
+                                  User.is_muted.is_(True),
+                                  User.mute_until <= now) \
+                    .update({'is_muted': False, 'mute_until': None}, synchronize_session=False)
+            if room_keys:
+                db.session.execute(delete(RoomMute).where(
+                    tuple_(RoomMute.room_id, RoomMute.user_id).in_(room_keys),
+                    RoomMute.mute_until <= now))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                self._expired |= expired - set(self._mutes)
+            raise
+
+
+mute_registry = MuteRegistry()
+
+
+# Кэш каталога магазина: страницы витрины в виде готовых словарей.
+# Сбрасывается при любом изменении товаров или остатков
+CATALOG_SORTS = {
+    'default': (Product.id.asc(),),
+    'new': (Product.id.desc(),),
+    'price_asc': (Product.price.asc(), Product.id.asc()),
+    'price_desc': (Product.price.desc(), Product.id.asc()),
+    'name': (Product.name.asc(), Product.id.asc()),
+}
+
+
+class CatalogCache:
+    def __init__(self, ttl, max_pages):
+        self.ttl = ttl
+        self.max_pages = max_pages
+        self._pages = OrderedDict()
+        self._total = None  # (товаров в наличии, expires_at)
+        self._version = 0
+        self._updated_at = datetime.utcnow().replace(microsecond=0)
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+            self._updated_at = datetime.utcnow().replace(microsecond=0)
+            self._pages.clear()
+            self._total = None
+
+    def _count(self, now):
+        with self._lock:
+            if self._total and self._total[1] > now:
+                return self._total[0]
+            version = self._version
+
+        total = Product.query.filter(Product.stock > 0).count()
+        with self._lock:
+            if self._version == version:
+                self._total = (total, now + self.ttl)
+        return total
+
+    def get_page(self, page, limit, sort):
+        # Номер страницы приходит из запроса: за последней страницей ключи кэша не плодятся
+        now = time.time()
+        total = self._count(now)
+        page = min(page, max((total + limit - 1) // limit, 1))
+        key = (page, limit, sort)
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry and entry['expires_at'] > now:
+                self._pages.move_to_end(key)
+                return entry
+            version, updated_at = self._version, self._updated_at
+
+        products = [product.to_dict() for product in
+                    Product.query.filter(Product.stock > 0)
+                    .order_by(*CATALOG_SORTS[sort]).offset((page - 1) * limit).limit(limit)]
+
+        # ETag считается по содержимому, поэтому совпадает во всех воркерах
+        digest = hashlib.sha1(json.dumps([products, total], sort_keys=True).encode()).hexdigest()
+        entry = {
+            'products': products,
+            'total': total,
+            'page': page,
+            'limit': limit,
+            'sort': sort,
+            'pages': max((total + limit - 1) // limit, 1),
+            'etag': f'catalog-{digest}',
+            'last_modified': updated_at,
+            'expires_at': now + self.ttl,
+        }
+        with self._lock:
+            if self._version == version:
+                self._pages[key] = entry
+                self._pages.move_to_end(key)
+                while len(self._pages) > self.max_pages:
+                    self._pages.popitem(last=False)
+        return entry
+
+
+catalog_cache = CatalogCache(app.config['CATALOG_CACHE_TTL'], app.config['CATALOG_CACHE_SIZE'])
+
+
+# Сводка корзины (количество позиций и сумма) по пользователям.
+# Обновляется инкрементально в обработчиках корзины, TTL страхует от изменений из других воркеров
+class CartSummaryCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._summaries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            summary = self._summaries.get(user_id)
+            if summary and summary['expires_at'] > now:
+                return {'count': summary['count'], 'total': round(summary['total'], 2)}
+
+        count, total = db.session.query(func.count(CartItem.id),
+                                        func.coalesce(func.sum(CartItem.quantity * Product.price), 0)) \
+            .join(Product, CartItem.product_id == Product.id) \
+            .filter(CartItem.user_id == user_id).one()
+        with self._lock:
+            self._summaries[user_id] = {'count': count, 'total': float(total), 'expires_at': now + self.ttl}
+        return {'count': count, 'total': round(float(total), 2)}
+
+    def adjust(self, user_id, count=0, total=0.0):
+        with self._lock:
+            summary = self._summaries.get(user_id)
+            if summary is not None:
+                summary['count'] += count
+                summary['total'] += total
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._summaries.clear()
+            else:
+                self._summaries.pop(user_id, None)
+
+
+cart_summaries = CartSummaryCache(app.config['CART_SUMMARY_TTL'])
+
+
+# Отложенная запись сообщений: id выдаются сервером сразу, строки вставляются пачками.
+# Рассчитано на один процесс-писатель - id берутся из счётчика в памяти
+class MessageWriteBehind:
+    def __init__(self, batch_size, interval):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending = []
+        self._next_id = None
+        self._committed_id = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._committed = threading.Condition()
+
+    def enqueue(self, user_id, room_id, text):
+        with self._lock:
+            if self._next_id is None:
+                self._next_id = (db.session.query(func.max(Message.id)).scalar() or 0) + 1
+            row = {'id': self._next_id, 'user_id': user_id, 'room_id': room_id, 'text': text,
+                   'timestamp': datetime.utcnow()}
+            self._next_id += 1
+            self._pending.append(row)
+            full = len(self._pending) >= self.batch_size
+
+        if full:
+            self.flush()
+        return row
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return
+
+            last_id = rows[-1]['id']
+            try:
+                try:
+                    self._insert(rows)
+                except IntegrityError:
+                    # Автор удалён, пока сообщение ждало в буфере: такие строки отбрасываются,
+                    # иначе пачка не вставится никогда
+                    db.session.rollback()
+                    rows = self._without_orphans(rows)
+                    self._insert(rows)
+            except Exception:
+                db.session.rollback()
+                with self._lock:
+                    self._pending[:0] = rows
+                raise
+
+            with self._committed:
+                self._committed_id = last_id
+                self._committed.notify_all()
+
+    def _insert(self, rows):
+        if rows:
+            db.session.execute(insert(Message), rows)
+            db.session.commit()
+
+    def _without_orphans(self, rows):
+        existing = set(db.session.scalars(select(User.id).where(User.id.in_({row['user_id'] for row in rows}))))
+        kept = [row for row in rows if row['user_id'] in existing]
+        if len(kept) < len(rows):
+            app.logger.warning('Отброшено %d сообщений удалённых пользователей', len(rows) - len(kept))
+        return kept
+
+    def discard_users(self, user_ids):
+        with self._lock:
+            self._pending = [row for row in self._pending if row['user_id'] not in user_ids]
+
+    def wait_committed(self, message_id, timeout):
+        with self._committed:
+            return self._committed.wait_for(lambda: self._committed_id >= message_id, timeout)
+
+
+message_writer = None
+if app.config['CHAT_WRITE_BEHIND']:
+    message_writer = MessageWriteBehind(app.config['CHAT_WRITE_BATCH_SIZE'],
+                                        app.config['CHAT_WRITE_INTERVAL_MS'] / 1000)
+    if app.config['SOCKETIO_MESSAGE_QUEUE']:
+        app.logger.warning('CHAT_WRITE_BEHIND выдаёт id в памяти процесса и не рассчитан на несколько воркеров')
+
+
+# Архивирование старых сообщений чата. Пачка сначала дописывается в архив,
+# потом удаляется из базы короткой транзакцией, чтобы не держать блокировку записи
+def retention_boundaries():
+    # Граница для каждой комнаты: сообщения с (timestamp, id) меньше неё уходят в архив.
+    # Лимит CHAT_RETENTION_MAX_MESSAGES считается по комнате, чтобы оживлённая комната
+    # не вытесняла историю тихих; смещение идёт по индексу ix_message_room_timestamp_id
+    age_boundary = None
+    if app.config['CHAT_RETENTION_DAYS']:
+        age_boundary = (datetime.utcnow() - timedelta(days=app.config['CHAT_RETENTION_DAYS']), 0)
+
+    boundaries = {}
+    for room_id in db.session.scalars(select(Room.id).order_by(Room.id)):
+        room_boundaries = [age_boundary] if age_boundary else []
+        if app.config['CHAT_RETENTION_MAX_MESSAGES']:
+            oldest_kept = db.session.query(Message.timestamp, Message.id) \
+                .filter(Message.room_id == room_id) \
+                .order_by(Message.timestamp.desc(), Message.id.desc()) \
+                .offset(app.config['CHAT_RETENTION_MAX_MESSAGES'] - 1).first()
+            if oldest_kept:
+                room_boundaries.append(tuple(oldest_kept))
+        if room_boundaries:
+            boundaries[room_id] = max(room_boundaries)
+    return boundaries
+
+
+def archive_path(day):
+    return os.path.join(app.config['CHAT_ARCHIVE_DIR'], f'messages-{day.isoformat()}.jsonl.gz')
+
+
+def archive_messages_batch(room_id, boundary, batch_size):
+    rows = db.session.query(Message.id, Message.room_id, Message.user_id, Message.text, Message.timestamp,
+                            User.username) \
+        .outerjoin(User, User.id == Message.user_id) \
+        .filter(Message.room_id == room_id, tuple_(Message.timestamp, Message.id) < boundary) \
+        .order_by(Message.timestamp, Message.id) \
+        .limit(batch_size).all()
+    if not rows:
+        return 0
+
+    by_day = defaultdict(list)
+    for row in rows:
+        by_day[row.timestamp.date()].append({
+            'id': row.id,
+            'room_id': row.room_id,
+            'user_id': row.user_id,
+            'username': row.username,
+            'text': row.text,
+            'timestamp': row.timestamp.isoformat()
+        })
+
+    # Дописываем новый gzip-member; при сбое до DELETE строки могут попасть в архив дважды,
+    # read_archive такие дубли отбрасывает
+    os.makedirs(app.config['CHAT_ARCHIVE_DIR'], exist_ok=True)
+    for day, records in by_day.items():
+        with open(archive_path(day), 'ab') as archive_file:
+            with gzip.GzipFile(fileobj=archive_file, mode='ab') as gz:
+                gz.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode())
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+
+    db.session.execute(delete(Message).where(Message.id.in_([row.id for row in rows])))
+    db.session.commit()
+    return len(rows)
+
+
+def read_archive(date_from, date_to):
+    seen = set()
+    day = date_from
+    while day <= date_to:
+        path = archive_path(day)
+        if os.path.exists(path):
+            with gzip.open(path, 'rt', encoding='utf-8') as archive_file:
+                for line in archive_file:
+                    record = json.loads(line)
+                    if record['id'] not in seen:
+                        seen.add(record['id'])
+                        yield record
+        day += timedelta(days=1)
+
+
+def vacuum_marker_path():
+    # Время последнего VACUUM - mtime файла-метки рядом с архивами: переживает перезапуски и смену воркеров
+    return os.path.join(app.config['CHAT_ARCHIVE_DIR'], 'vacuum.stamp')
+
+
+def touch_vacuum_marker():
+    os.makedirs(app.config['CHAT_ARCHIVE_DIR'], exist_ok=True)
+    with open(vacuum_marker_path(), 'a'):
+        pass
+    os.utime(vacuum_marker_path())
+
+
+def vacuum_due():
+    try:
+        return time.time() - os.path.getmtime(vacuum_marker_path()) >= app.config['DB_VACUUM_INTERVAL']
+    except FileNotFoundError:
+        # Без метки отсчёт интервала начинается с первого архивирования
+        touch_vacuum_marker()
+        return False
+
+
+def maintain_database():
+    # Вызывается под блокировкой архивирования, поэтому VACUUM не запускается в двух процессах сразу
+    if db.engine.dialect.name != 'sqlite':
+        return
+
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.exec_driver_sql('ANALYZE')
+        if vacuum_due():
+            connection.exec_driver_sql('VACUUM')
+            touch_vacuum_marker()
+
+
+def lock_retention(lock_file):
+    # Архивирование запускается в каждом воркере: flock не даёт двум процессам одновременно
+    # дописывать gzip-архивы и делать VACUUM. Блокировка снимается при закрытии файла
+    try:
+        import fcntl
+    except ImportError:  # Windows: там приложение запускается одним процессом
+        return True
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def run_retention():
+    boundaries = retention_boundaries()
+    if not boundaries:
+        return 0
+
+    os.makedirs(app.config['CHAT_ARCHIVE_DIR'], exist_ok=True)
+    with open(os.path.join(app.config['CHAT_ARCHIVE_DIR'], 'retention.lock'), 'a') as lock_file:
+        if not lock_retention(lock_file):
+            app.logger.info('Архивирование уже выполняется другим процессом')
+            return 0
+
+        archived = 0
+        for room_id, boundary in boundaries.items():
+            while True:
+                count = archive_messages_batch(room_id, boundary, app.config['CHAT_RETENTION_BATCH'])
+                archived += count
+                if count < app.config['CHAT_RETENTION_BATCH']:
+                    break
+                socketio.sleep(app.config['CHAT_RETENTION_PAUSE'])
+
+        if archived:
+            maintain_database()
+    return archived
+
+
+# Полнотекстовый поиск по чату (SQLite FTS5). Индекс синхронизируется триггерами,
+# поэтому его не обходят ни отложенная запись, ни массовые удаления, ни архивирование
+message_fts = table('message_fts', column('rowid'))
+search_enabled = False
+
+# Окончания для грубого стемминга русских слов: основа ищется префиксным запросом
+RUSSIAN_ENDINGS = sorted([
+    'иями', 'ями', 'ами', 'иях', 'ях', 'ах', 'ией', 'ием', 'иям', 'ям', 'ам', 'ом', 'ем', 'ов', 'ев', 'ей', 'ой',
+    'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ый', 'ий', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ую', 'юю', 'ых', 'их',
+    'ия', 'ию', 'ии', 'ться', 'тся', 'ть', 'ешь', 'ет', 'ете', 'ут', 'ют', 'ит', 'ят', 'ишь', 'ил', 'ила',
+    'или', 'ало', 'ал', 'ала', 'али', 'ел', 'ела', 'ели',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+], key=len, reverse=True)
+
+
+def normalize_search_term(term):
+    return term.lower().replace('ё', 'е')
+
+
+def stem_search_term(term):
+    term = normalize_search_term(term)
+    if re.fullmatch('[а-я]+', term):
+        for ending in RUSSIAN_ENDINGS:
+            if term.endswith(ending) and len(term) - len(ending) >= 3:
+                return term[:-len(ending)]
+    return term
+
+
+def build_search_query(text):
+    # Слово ищется точно или по основе: ("мама" OR "мам"*). Основа грубая и находит лишнее
+    # («мам» - и «мамонт»), поэтому чат-поиск ставит точные совпадения первыми
+    groups = []
+    for term in re.findall(r'\w+', text):
+        exact, stem = normalize_search_term(term), stem_search_term(term)
+        groups.append(f'("{exact}" OR "{stem}"*)' if stem != exact else f'"{exact}"*')
+    return ' '.join(groups)
+
+
+def build_exact_search_query(text):
+    return ' '.join(f'"{normalize_search_term(term)}"' for term in re.findall(r'\w+', text))
+
+
+def setup_message_search():
+    global search_enabled
+    if db.engine.dialect.name != 'sqlite':
+        return
+
+    # unicode61 не склеивает ё и е в кириллице, поэтому индекс строится по нормализованному
+    # представлению message_search_source, а триггеры пишут тот же нормализованный текст
+    normalized = "replace(replace({0}.text, 'ё', 'е'), 'Ё', 'Е')"
+    with db.engine.begin() as connection:
+        exists = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_fts'").first()
+        connection.exec_driver_sql(
+            "CREATE VIEW IF NOT EXISTS message_search_source AS "
+            f"SELECT id, {normalized.format('message')} AS text FROM message")
+        try:
+            connection.exec_driver_sql(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+                "text, content='message_search_source', content_rowid='id', tokenize='unicode61')")
+        except Exception:
+            app.logger.warning('SQLite собран без FTS5, поиск по чату отключён')
+            return
+
+        connection.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN "
+            f"INSERT INTO message_fts(rowid, text) VALUES (new.id, {normalized.format('new')}); END")
+        connection.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN "
+            "INSERT INTO message_fts(message_fts, rowid, text) "
+            f"VALUES ('delete', old.id, {normalized.format('old')}); END")
+        connection.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF text ON message BEGIN "
+            "INSERT INTO message_fts(message_fts, rowid, text) "
+            f"VALUES ('delete', old.id, {normalized.format('old')}); "
+            f"INSERT INTO message_fts(rowid, text) VALUES (new.id, {normalized.format('new')}); END")
+        if not exists:
+            # Первичное наполнение индекса существующими сообщениями
+            connection.exec_driver_sql("INSERT INTO message_fts(message_fts) VALUES ('rebuild')")
+
+    search_enabled = True
+
+
+# Рассылка событий комнате чата (Socket.IO-комнате room:<id>). При включённой склейке события копятся в течение окна
+# и уходят одним кадром; вход и выход одного пользователя в пределах окна взаимно гасятся
+PRESENCE_EVENTS = ('user_connected', 'user_disconnected')
+
+
+class BroadcastBatcher:
+    def __init__(self, window, compact):
+        self.window = window
+        self._packb = None
+        if compact:
+            import msgpack
+            self._packb = msgpack.packb
+        self._pending = {}  # room -> [[event, data], ...]
+        self._lock = threading.Lock()
+
+    def emit(self, event, data, room):
+        with self._lock:
+            scheduled = room in self._pending
+            events = self._pending.setdefault(room, [])
+            if event in PRESENCE_EVENTS:
+                previous = next((item for item in events if item[0] in PRESENCE_EVENTS
+                                 and item[1]['user_id'] == data['user_id']), None)
+                if previous:
+                    events.remove(previous)
+                    if previous[0] != event:
+                        return
+            events.append([event, data])
+
+        if not scheduled:
+            socketio.start_background_task(self._flush_later, room)
+
+    def _flush_later(self, room):
+        socketio.sleep(self.window)
+        self.flush(room)
+
+    def flush(self, room):
+        with self._lock:
+            events = self._pending.pop(room, None)
+        if events:
+            payload = self._packb(events) if self._packb else {'events': events}
+            socketio.emit('events_batch', payload, room=room)
+
+
+broadcast_batcher = None
+if app.config['SOCKETIO_BATCH_WINDOW_MS']:
+    broadcast_batcher = BroadcastBatcher(app.config['SOCKETIO_BATCH_WINDOW_MS'] / 1000,
+                                         app.config['SOCKETIO_COMPACT_PAYLOADS'])
+
+
+# Журнал последних событий комнат с возрастающими номерами: переподключившийся клиент
+# получает только пропущенное. Номера действуют в пределах процесса (epoch), поэтому
+# с очередью сообщений, где события рассылают и другие воркеры, журнал не ведётся
+class ChatEventLog:
+    def __init__(self, size):
+        self.epoch = os.urandom(8).hex()
+        self.seq = 0
+        self._events = deque(maxlen=size)  # (seq, room_id, event, data)
+        self._room_locks = {}
+        self.lock = threading.Lock()
+
+    def room_lock(self, room_id):
+        # Под ней номер выдаётся и событие рассылается: в комнате номера уходят по порядку,
+        # а рассылки разных комнат друг друга не ждут
+        with self.lock:
+            return self._room_locks.setdefault(room_id, threading.Lock())
+
+    def record(self, event, data, room_id):
+        with self.lock:
+            self.seq += 1
+            data = {**data, 'seq': self.seq}
+            self._events.append((self.seq, room_id, event, data))
+            return data
+
+    def since(self, seq, room_id):
+        # None, если часть пропущенных событий уже вытеснена из буфера
+        with self.lock:
+            oldest = self._events[0][0] if self._events else self.seq + 1
+            if seq > self.seq or seq < oldest - 1:
+                return None
+            return [[event, data] for event_seq, event_room_id, event, data in self._events
+                    if event_seq > seq and event_room_id == room_id], self.seq
+
+
+chat_events = None
+if not app.config['SOCKETIO_MESSAGE_QUEUE']:
+    chat_events = ChatEventLog(app.config['CHAT_EVENT_BUFFER'])
+
+
+def broadcast(event, data, room_id):
+    # Событие получают только участники комнаты, поэтому стоимость рассылки растёт с её размером
+    if not chat_events:
+        send_broadcast(event, data, room_channel(room_id))
+        return
+
+    with chat_events.room_lock(room_id):
+        send_broadcast(event, chat_events.record(event, data, room_id), room_channel(room_id))
+
+
+def send_broadcast(event, data, room):
+    if broadcast_batcher:
+        broadcast_batcher.emit(event, data, room)
+    else:
+        socketio.emit(event, data, room=room)
+
+
+# Фоновые задачи
+_background_lock = threading.Lock()
+_background_started = False
+
+
+def run_periodically(interval, func):
+    def loop():
+        while True:
+            socketio.sleep(interval)
+            with app.app_context():
+                try:
+                    func()
+                except Exception:
+                    app.logger.exception('Ошибка фоновой задачи %s', func.__qualname__)
+
+    socketio.start_background_task(loop)
+
+
+def start_background_tasks():
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+
+    run_periodically(app.config['PRESENCE_FLUSH_INTERVAL'], presence.flush)
+    run_periodically(app.config['MUTE_FLUSH_INTERVAL'], mute_registry.flush)
+    if app.config['MUTE_REFRESH_INTERVAL']:
+        run_periodically(app.config['MUTE_REFRESH_INTERVAL'], mute_registry.refresh)
+    if message_writer:
+        run_periodically(message_writer.interval, message_writer.flush)
+    if app.config['CHAT_RETENTION_DAYS'] or app.config['CHAT_RETENTION_MAX_MESSAGES']:
+        run_periodically(app.config['CHAT_RETENTION_INTERVAL'], run_retention)
+    if app.config['PROFILER_ENABLED']:
+        profiler.start()
+
+
+def flush_background_work():
+    with app.app_context():
+        if message_writer:
+            message_writer.flush()
+        presence.flush()
+        mute_registry.flush()
+
+
+atexit.register(flush_background_work)
+
+
+# Плавная остановка: новые подключения отклоняются, текущие закрываются на уровне транспорта
+# (клиенты переподключаются к другому воркеру), буферы записываются в базу
+accepting_connections = True
+
+
+def drain_connections():
+    global accepting_connections
+    accepting_connections = False
+    eio = socketio.server.eio
+    for sid, eio_socket in list(eio.sockets.items()):
+        # Без ожидания доставки: обработчик сигнала может занимать поток, который обслуживает эти соединения
+        eio_socket.close(wait=False)
+        eio.sockets.pop(sid, None)
+    flush_background_work()
+
+
+# Инструментирование: время обработки маршрутов и событий сокета, число и время запросов к базе
+class Summary:
+    def __init__(self, window):
+        self.count = 0
+        self.total = 0.0
+        self._recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self._recent.append(value)
+
+    def quantiles(self, qs=(0.5, 0.95, 0.99)):
+        values = sorted(self._recent)
+        if not values:
+            return {q: 0.0 for q in qs}
+        return {q: values[min(len(values) - 1, int(q * len(values)))] for q in qs}
+
+
+class Metrics:
+    def __init__(self, window):
+        self.window = window
+        self._summaries = {}  # (name, labels) -> Summary
+        self._counters = defaultdict(float)  # (name, labels) -> value
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = Summary(self.window)
+            summary.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def render(self):
+        lines = []
+        with self._lock:
+            summaries = sorted(self._summaries.items())
+            counters = sorted(self._counters.items())
+            quantiles = {key: summary.quantiles() for key, summary in summaries}
+
+        seen = set()
+        for (name, labels), summary in summaries:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# TYPE {name} summary')
+            for q, value in quantiles[(name, labels)].items():
+                lines.append(f'{name}{format_labels(labels + (("quantile", q),))} {value:.6f}')
+            lines.append(f'{name}_sum{format_labels(labels)} {summary.total:.6f}')
+            lines.append(f'{name}_count{format_labels(labels)} {summary.count}')
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{format_labels(labels)} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+metrics = Metrics(app.config['METRICS_WINDOW'])
+
+# Запросы к базе в рамках текущего HTTP-запроса или события сокета (с eventlet/gevent - на гринлет)
+query_stats = threading.local()
+
+
+def begin_query_stats():
+    query_stats.count = 0
+    query_stats.duration = 0.0
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    if hasattr(query_stats, 'count'):
+        query_stats.count += 1
+        query_stats.duration += elapsed
+    if app.config['SLOW_QUERY_MS'] and elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+        app.logger.warning('Медленный запрос (%.1f мс): %s', elapsed * 1000, ' '.join(statement.split())[:1000])
+
+
+def record_handler(prefix, labels, started):
+    metrics.observe(f'{prefix}_duration_seconds', time.perf_counter() - started, **labels)
+    metrics.observe(f'{prefix}_db_queries', query_stats.count, **labels)
+    metrics.observe(f'{prefix}_db_duration_seconds', query_stats.duration, **labels)
+    del query_stats.count
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    begin_query_stats()
+
+
+@app.after_request
+def finish_request_metrics(response):
+    endpoint = request.endpoint or 'not_found'
+    if 'request_started' in g:
+        record_handler('http_request', {'endpoint': endpoint}, g.request_started)
+    metrics.inc('http_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+
+def socket_handler(event_name):
+    # @socketio.on с замером времени обработки события и запросов к базе
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            begin_query_stats()
+            started = time.perf_counter()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                record_handler('socketio_event', {'event': event_name}, started)
+        return socketio.on(event_name)(wrapper)
+    return decorator
+
+
+# Сэмплирующий профилировщик: периодически снимает стеки всех потоков и копит их
+# в свёрнутом виде (формат flamegraph.pl / speedscope)
+class SamplingProfiler:
+    max_depth = 64
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.running = False
+        self.samples = 0
+        self._stacks = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self.running = True
+        socketio.start_background_task(self._run)
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        own_thread = threading.get_ident()
+        while self.running:
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, frame in frames.items():
+                    if thread_id != own_thread:
+                        self._stacks[self._collapse(frame)] += 1
+                self.samples += 1
+            socketio.sleep(self.interval)
+
+    def _collapse(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def collapsed(self):
+        with self._lock:
+            stacks = sorted(self._stacks.items(), key=lambda item: -item[1])
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+
+profiler = SamplingProfiler(app.config['PROFILER_INTERVAL_MS'] / 1000)
+
+
+def catalog_page_args():
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = request.args.get('limit', app.config['CATALOG_PAGE_SIZE'], type=int)
+    limit = min(max(limit, 1), app.config['CATALOG_MAX_PAGE_SIZE'])
+    sort = request.args.get('sort', 'default')
+    if sort not in CATALOG_SORTS:
+        sort = 'default'
+    return page, limit, sort
+
+
+def not_modified(etag, last_modified=None):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if_modified_since = request.if_modified_since
+    return bool(last_modified and if_modified_since and last_modified <= if_modified_since.replace(tzinfo=None))
+
+
+def conditional_response(etag, last_modified, render):
+    # render вызывается только если у клиента нет актуальной копии
+    if not_modified(etag, last_modified):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+# Сборка статики: имя файла меняется вместе с содержимым, поэтому браузер кэширует его навсегда
+# и не перепроверяет. Минификация консервативная и без зависимостей: результат (а значит и хеш)
+# одинаков на всех серверах
+ASSET_SOURCES = ('css/*.css', 'js/*.js')
+ASSET_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+HASHED_ASSET_NAME = re.compile(r'[\w./-]+\.[0-9a-f]{12}\.(?:css|js)')
+
+asset_manifest = {}  # исходное имя -> {'file': имя с хешем, 'encodings': [...]}
+asset_files = {}  # имя с хешем -> доступные сжатые варианты
+
+
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,])\s*', r'\1', text)
+    return text.replace(';}', '}').strip()
+
+
+def minify_js(text):
+    # Только отступы, пустые строки и строчные комментарии: переводы строк остаются,
+    # так что автоматическая расстановка точек с запятой не меняется
+    lines = []
+    in_template = False
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not in_template and (not stripped or stripped.startswith('//')):
+            continue
+        lines.append(stripped)
+        in_template ^= len(re.findall(r'(?<!\\)`', line)) % 2 == 1
+    return '\n'.join(lines) + '\n'
+
+
+def compress_asset(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli.compress(data, quality=11)
+
+
+def write_atomically(path, data):
+    # Воркеры собирают статику одновременно: файл появляется целиком или не появляется
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as temp_file:
+        temp_file.write(data)
+    os.replace(temp_path, path)
+
+
+def build_assets():
+    manifest = {}
+    for pattern in ASSET_SOURCES:
+        for source in sorted(glob.glob(os.path.join(app.static_folder, pattern))):
+            name = os.path.relpath(source, app.static_folder).replace(os.sep, '/')
+            with open(source, encoding='utf-8') as source_file:
+                text = source_file.read()
+            data = (minify_css(text) if name.endswith('.css') else minify_js(text)).encode()
+
+            stem, extension = os.path.splitext(name)
+            hashed = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}'
+            target = os.path.join(app.config['ASSETS_DIR'], hashed)
+            encodings = []
+            if not os.path.exists(target):
+                write_atomically(target, data)
+            for encoding, suffix in ASSET_ENCODINGS:
+                if not os.path.exists(target + suffix):
+                    compressed = compress_asset(data, encoding)
+                    # Сжатый вариант, который не меньше исходного, не нужен
+                    if compressed is None or len(compressed) >= len(data):
+                        continue
+                    write_atomically(target + suffix, compressed)
+                encodings.append(encoding)
+            manifest[name] = {'file': hashed, 'encodings': encodings}
+
+    write_atomically(os.path.join(app.config['ASSETS_DIR'], 'manifest.json'),
+                     json.dumps(manifest, indent=2, sort_keys=True).encode())
+    use_asset_manifest(manifest)
+    return manifest
+
+
+def load_asset_manifest():
+    try:
+        with open(os.path.join(app.config['ASSETS_DIR'], 'manifest.json'), encoding='utf-8') as manifest_file:
+            use_asset_manifest(json.load(manifest_file))
+    except OSError:
+        app.logger.warning('Статика не собрана (flask build-assets), файлы отдаются из static как есть')
+
+
+def use_asset_manifest(manifest):
+    asset_manifest.clear()
+    asset_manifest.update(manifest)
+    asset_files.clear()
+    asset_files.update({entry['file']: entry['encodings'] for entry in manifest.values()})
+
+
+@app.template_global()
+def asset_url(filename):
+    entry = asset_manifest.get(filename)
+    if not entry:
+        return url_for('static', filename=filename)
+    return url_for('asset', filename=entry['file'])
+
+
+def old_asset_encodings(filename):
+    # Файлы прошлых сборок остаются в ASSETS_DIR: на них ссылаются страницы из кэша браузера и CDN.
+    # Сжатые варианты определяются по файлам рядом, результат запоминается до смены манифеста
+    path = safe_join(app.config['ASSETS_DIR'], filename)
+    if not HASHED_ASSET_NAME.fullmatch(filename) or path is None or not os.path.isfile(path):
+        return None
+    encodings = [encoding for encoding, suffix in ASSET_ENCODINGS if os.path.isfile(path + suffix)]
+    asset_files[filename] = encodings
+    return encodings
+
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    encodings = asset_files.get(filename)
+    if encodings is None:
+        encodings = old_asset_encodings(filename)
+    if encodings is None:
+        abort(404)
+
+    # Сжатый вариант по Accept-Encoding; тип содержимого - от исходного файла
+    path, content_encoding = filename, None
+    for encoding, suffix in ASSET_ENCODINGS:
+        if encoding in encodings and request.accept_encodings[encoding]:
+            path, content_encoding = filename + suffix, encoding
+            break
+
+    response = send_from_directory(app.config['ASSETS_DIR'], path,
+                                   mimetype=mimetypes.guess_type(filename)[0],
+                                   max_age=app.config['ASSETS_MAX_AGE'])
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    response.headers['Cache-Control'] = f"public, max-age={app.config['ASSETS_MAX_AGE']}, immutable"
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+# Кэш пользователей по id: хранит значения колонок и собирает из них объект,
+# привязанный к текущей сессии, без SELECT
+class UserCache:
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # user_id -> (значения колонок, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        if self.ttl <= 0:
+            return db.session.get(User, user_id)
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                values = entry[0]
+            else:
+                self.misses += 1
+                values = None
+
+        if values is None:
+            user = db.session.get(User, user_id)
+            if user is not None:
+                self._put(user, now)
+            return user
+
+        existing = db.session.identity_map.get(identity_key(User, user_id))
+        if existing is not None:
+            return existing
+
+        user = User(**values)
+        make_transient_to_detached(user)
+        db.session.add(user)
+        return user
+
+    def _put(self, user, now):
+        values = {column.key: getattr(user, column.key) for column in User.__table__.columns}
+        with self._lock:
+            self._entries[user.id] = (values, now + self.ttl)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            self.invalidations += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+user_cache = UserCache(app.config['USER_CACHE_TTL'], app.config['USER_CACHE_SIZE'])
+
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.get(int(user_id))
 
 
 # Маршруты
@@ -139,12 +1882,16 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
 
+        if not login_ip_limiter.allow(request.remote_addr) or \
+                not login_user_limiter.allow((username or '').lower()):
+            flash('Слишком много попыток входа. Попробуйте позже', 'error')
+            return render_template('login.html'), 429
+
         user = User.query.filter_by(username=username).first()
 
         if user and user.check_password(password):
             login_user(user)
-            user.last_seen = datetime.utcnow()
-            db.session.commit()
+            presence.mark_seen(user.id)
             return redirect(url_for('chat'))
         else:
             flash('Неверный логин или пароль', 'error')
@@ -153,19 +1900,126 @@ def login():
 
 
 @app.route('/chat')
+@app.route('/chat/rooms/<slug>')
 @login_required
-def chat():
-    if current_user.check_mute_status():
+def chat(slug=None):
+    rooms = Room.query.order_by(Room.id).all()
+    slug = slug or app.config['CHAT_DEFAULT_ROOM']
+    room = next((room for room in rooms if room.slug == slug), None)
+    if not room:
+        abort(404)
+
+    if current_user.check_mute_status(room.id):
         flash('Вы были замучены и не можете отправлять сообщения', 'error')
 
-    messages = Message.query.order_by(Message.timestamp.asc()).all()
-    users = User.query.all()
-    online_users = User.query.filter(User.last_seen >= datetime.utcnow() - timedelta(minutes=5)).all()
+    # Номер события берётся до чтения истории: всё, что случится после, клиент догонит через sync
+    sync_state = {'epoch': chat_events.epoch, 'seq': chat_events.seq} if chat_events else {'epoch': '', 'seq': 0}
+    messages, has_more = fetch_messages_page(room.id)
+    # Модераторы комнаты тем же запросом, что и список пользователей, а не is_moderator() в шаблоне
+    rows = db.session.execute(
+        select(User, RoomModerator.id)
+        .outerjoin(RoomModerator, (RoomModerator.user_id == User.id) & (RoomModerator.room_id == room.id))
+    ).all()
+    users = [user for user, _ in rows]
+    moderator_ids = {user.id for user, assigned in rows if assigned or user.is_moderator()}
+    online_ids = presence.online_user_ids(room.id) | {current_user.id}
 
     return render_template('chat.html',
-                           messages=messages,
+                           room=room,
+                           rooms=rooms,
+                           messages=[message.to_dict() for message in messages],
+                           cursor=messages[0].cursor if messages else '',
+                           has_more=has_more,
                            users=users,
-                           online_users=online_users)
+                           online_ids=online_ids,
+                           moderator_ids=moderator_ids,
+                           can_moderate=current_user.id in moderator_ids,
+                           muted_ids=mute_registry.muted_ids(room.id),
+                           sync_state=sync_state,
+                           socket_options={'transports': app.config['SOCKETIO_TRANSPORTS']})
+
+
+ROOM_SLUG_RE = re.compile(r'[a-z0-9][a-z0-9_-]{0,49}')
+
+
+@app.route('/chat/rooms', methods=['POST'])
+@login_required
+@rate_limit('moderation')
+def create_room():
+    if not current_user.is_moderator():
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+
+    name = (request.json.get('name') or '').strip()
+    slug = (request.json.get('slug') or '').strip().lower()
+    if not name or len(name) > 100:
+        return jsonify({'success': False, 'message': 'Укажите название комнаты'}), 400
+    if not ROOM_SLUG_RE.fullmatch(slug):
+        return jsonify({'success': False, 'message': 'Адрес комнаты: латинские буквы, цифры, - и _'}), 400
+    if Room.query.filter_by(slug=slug).first():
+        return jsonify({'success': False, 'message': 'Комната с таким адресом уже существует'}), 400
+
+    room = Room(slug=slug, name=name)
+    db.session.add(room)
+    db.session.commit()
+
+    return jsonify({'success': True, 'message': f'Комната {name} создана',
+                    'room': room.to_dict(), 'url': url_for('chat', slug=room.slug)})
+
+
+@app.route('/chat/history')
+@login_required
+def chat_history():
+    before = request.args.get('before')
+    cursor = parse_message_cursor(before) if before else None
+    if before and not cursor:
+        return jsonify({'success': False, 'message': 'Неверный курсор'}), 400
+
+    room_id = request.args.get('room_id', type=int) or default_room_id
+    limit = min(request.args.get('limit', app.config['CHAT_PAGE_SIZE'], type=int),
+                app.config['CHAT_HISTORY_MAX_PAGE'])
+    messages, has_more = fetch_messages_page(room_id, cursor, max(limit, 1))
+
+    return jsonify({
+        'success': True,
+        'messages': [message.to_dict() for message in messages],
+        'has_more': has_more,
+        'next_cursor': messages[0].cursor if messages else None
+    })
+
+
+@app.route('/chat/search')
+@login_required
+def chat_search():
+    if not search_enabled:
+        return jsonify({'success': False, 'message': 'Поиск недоступен'}), 503
+
+    match = build_search_query(request.args.get('q', ''))
+    if not match:
+        return jsonify({'success': False, 'message': 'Пустой запрос'}), 400
+
+    room_id = request.args.get('room_id', type=int) or default_room_id
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    rank = func.bm25(literal_column('message_fts'))
+    # Сообщения, где все слова запроса встречаются в точной форме, выше совпавших только по основе
+    exact_ids = select(message_fts.c.rowid).select_from(message_fts) \
+        .where(literal_column('message_fts').op('MATCH')(build_exact_search_query(request.args.get('q', '')))) \
+        .correlate(None)
+
+    rows = db.session.query(Message, rank) \
+        .options(joinedload(Message.author)) \
+        .join(message_fts, message_fts.c.rowid == Message.id) \
+        .filter(literal_column('message_fts').op('MATCH')(match), Message.room_id == room_id) \
+        .order_by(case((Message.id.in_(exact_ids), 0), else_=1), rank) \
+        .offset((page - 1) * limit).limit(limit + 1).all()
+
+    return jsonify({
+        'success': True,
+        'results': [{**message.to_dict(), 'date': message.timestamp.isoformat(), 'rank': score}
+                    for message, score in rows[:limit]],
+        'page': page,
+        'has_more': len(rows) > limit
+    })
 
 
 @app.route('/admin')
@@ -176,11 +2030,75 @@ def admin():
         return redirect(url_for('chat'))
 
     users = User.query.all()
-    return render_template('admin.html', users=users)
+    rooms = Room.query.order_by(Room.id).all()
+    return render_template('admin.html', users=users, rooms=rooms, muted_ids=mute_registry.muted_ids())
+
+
+@app.route('/admin/stats/user_cache')
+@login_required
+def user_cache_stats():
+    if not current_user.is_creator():
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+
+    return jsonify({'success': True, **user_cache.stats()})
+
+
+@app.route('/admin/stats/rate_limits')
+@login_required
+def rate_limit_stats():
+    if not current_user.is_creator():
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+
+    return jsonify({'success': True, **rate_limiter.stats()})
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    token = app.config['METRICS_TOKEN']
+    scraper = token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not scraper and not (current_user.is_authenticated and current_user.is_creator()):
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+
+    lines = ['# TYPE rate_limit_events_total counter']
+    for action, counts in sorted(rate_limiter.stats()['counters'].items()):
+        for result, value in sorted(counts.items()):
+            lines.append(f'rate_limit_events_total{format_labels((("action", action), ("result", result)))} {value}')
+    cache = user_cache.stats()
+    lines.append('# TYPE user_cache_lookups_total counter')
+    lines.append(f'user_cache_lookups_total{{result="hit"}} {cache["hits"]}')
+    lines.append(f'user_cache_lookups_total{{result="miss"}} {cache["misses"]}')
+    lines.append('# TYPE user_cache_size gauge')
+    lines.append(f'user_cache_size {cache["size"]}')
+
+    body = metrics.render() + '\n'.join(lines) + '\n'
+    return app.response_class(body, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/profiler', methods=['GET', 'POST'])
+@login_required
+def admin_profiler():
+    if not current_user.is_creator():
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+
+    if request.method == 'POST':
+        action = request.json.get('action')
+        if action == 'start':
+            profiler.start()
+        elif action == 'stop':
+            profiler.stop()
+        elif action == 'reset':
+            profiler.reset()
+        else:
+            return jsonify({'success': False, 'message': 'Неизвестное действие'}), 400
+        return jsonify({'success': True, 'running': profiler.running, 'samples': profiler.samples})
+
+    # Свёрнутые стеки: flamegraph.pl или speedscope строят по ним flame graph
+    return app.response_class(profiler.collapsed(), mimetype='text/plain')
 
 
 @app.route('/admin/create_user', methods=['POST'])
 @login_required
+@rate_limit('admin')
 def create_user():
     if not current_user.is_creator():
         return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
@@ -202,6 +2120,7 @@ def create_user():
 
 @app.route('/admin/change_role', methods=['POST'])
 @login_required
+@rate_limit('admin')
 def change_role():
     if not current_user.is_creator():
         return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
@@ -215,12 +2134,43 @@ def change_role():
 
     user.role = new_role
     db.session.commit()
+    user_cache.invalidate(user.id)
 
     return jsonify({'success': True, 'message': f'Роль изменена на {new_role}'})
 
 
+@app.route('/admin/room_moderator', methods=['POST'])
+@login_required
+@rate_limit('admin')
+def room_moderator():
+    if not current_user.is_creator():
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+
+    user = User.query.get(request.json.get('user_id'))
+    if not user:
+        return jsonify({'success': False, 'message': 'Пользователь не найден'}), 404
+    room = db.session.get(Room, parse_int(request.json.get('room_id')))
+    if not room:
+        return jsonify({'success': False, 'message': 'Комната не найдена'}), 404
+
+    # moderator: true - назначить модератором комнаты, false - снять
+    assigned = RoomModerator.query.filter_by(room_id=room.id, user_id=user.id).first()
+    if request.json.get('moderator'):
+        if not assigned:
+            db.session.add(RoomModerator(room_id=room.id, user_id=user.id))
+        message = f'{user.username} - модератор комнаты {room.name}'
+    else:
+        if assigned:
+            db.session.delete(assigned)
+        message = f'{user.username} больше не модератор комнаты {room.name}'
+    db.session.commit()
+
+    return jsonify({'success': True, 'message': message})
+
+
 @app.route('/admin/delete_user', methods=['POST'])
 @login_required
+@rate_limit('admin')
 def delete_user():
     if not current_user.is_creator():
         return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
@@ -234,75 +2184,360 @@ def delete_user():
     if user.is_creator():
         return jsonify({'success': False, 'message': 'Нельзя удалить создателя'}), 400
 
-    db.session.delete(user)
+    delete_users_cascade([user.id])
     db.session.commit()
+    mute_registry.forget_user(user.id)
+    user_cache.invalidate(user.id)
 
     return jsonify({'success': True, 'message': 'Пользователь удален'})
 
 
+def mute_expiry(duration, custom_minutes=0):
+    # None - мут навсегда
+    if duration == '10m':
+        return datetime.utcnow() + timedelta(minutes=10)
+    if duration == '1h':
+        return datetime.utcnow() + timedelta(hours=1)
+    if duration == 'custom' and custom_minutes > 0:
+        return datetime.utcnow() + timedelta(minutes=custom_minutes)
+    return None
+
+
+def mute_notice_rooms(room_id):
+    # Уведомление о муте в одной комнате уходит только её участникам, о глобальном - во все комнаты
+    if room_id is not None:
+        return [room_id]
+    return db.session.scalars(select(Room.id)).all()
+
+
+def unrecord_user_orders(user_ids):
+    # Заказы удаляемых пользователей вычитаются из агрегатов продаж, суммы считает база
+    user_orders = Order.user_id.in_(user_ids)
+    statuses = db.session.execute(
+        select(Order.status, func.count(Order.id), func.sum(Order.total_price))
+        .where(user_orders).group_by(Order.status)).all()
+    for status, orders_count, revenue in statuses:
+        bump_rollup(OrderStatusStats, {'status': status}, orders_count=-orders_count, revenue=-revenue)
+
+    daily = defaultdict(lambda: {'orders_count': 0, 'units': 0, 'revenue': 0.0})
+    orders = db.session.execute(
+        select(Order.created_at, Order.total_price, func.coalesce(func.sum(OrderItem.quantity), 0))
+        .outerjoin(OrderItem, OrderItem.order_id == Order.id)
+        .where(user_orders, Order.status != 'cancelled')
+        .group_by(Order.id, Order.created_at, Order.total_price)).all()
+    for created_at, total_price, units in orders:
+        daily[created_at.date()]['orders_count'] += 1
+        daily[created_at.date()]['units'] += units
+        daily[created_at.date()]['revenue'] += total_price
+    for day, values in daily.items():
+        bump_rollup(SalesDaily, {'day': day}, **{name: -value for name, value in values.items()})
+
+    products = db.session.execute(
+        select(OrderItem.product_name, func.sum(OrderItem.quantity),
+               func.sum(OrderItem.product_price * OrderItem.quantity))
+        .join(Order, OrderItem.order_id == Order.id)
+        .where(user_orders, Order.status != 'cancelled')
+        .group_by(OrderItem.product_name)).all()
+    for product_name, units, revenue in products:
+        bump_rollup(ProductSales, {'product_name': product_name}, units=-units, revenue=-revenue)
+
+
+def delete_users_cascade(user_ids):
+    # Массовые DELETE вместо загрузки всех дочерних объектов в сессию
+    if message_writer:
+        # Сообщения из буфера отложенной записи иначе вставятся уже без автора
+        message_writer.discard_users(set(user_ids))
+    unrecord_user_orders(user_ids)
+    order_ids = select(Order.id).where(Order.user_id.in_(user_ids))
+    db.session.execute(delete(OrderItem).where(OrderItem.order_id.in_(order_ids)))
+    for model in (Order, CartItem, Message, RoomMute, RoomModerator):
+        db.session.execute(delete(model).where(model.user_id.in_(user_ids)))
+    db.session.execute(delete(User).where(User.id.in_(user_ids)))
+
+
 @app.route('/mute_user', methods=['POST'])
 @login_required
+@rate_limit('moderation')
 def mute_user():
-    if not current_user.is_moderator():
-        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
-
     user_id = request.json.get('user_id')
+    room_id = request.json.get('room_id')  # без комнаты - мут во всех комнатах
     duration = request.json.get('duration')  # 'forever', '10m', '1h', 'custom'
     custom_minutes = request.json.get('custom_minutes', 0)
 
+    # Модератор комнаты мутит только в своей комнате, глобальный мут - только глобальной роли
+    if not current_user.is_moderator(room_id):
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+
     user = User.query.get(user_id)
     if not user:
         return jsonify({'success': False, 'message': 'Пользователь не найден'}), 404
 
-    if user.is_moderator():
+    if user.is_moderator(room_id):
         return jsonify({'success': False, 'message': 'Нельзя замутить модератора'}), 400
 
-    user.is_muted = True
+    if room_id is not None and not db.session.get(Room, room_id):
+        return jsonify({'success': False, 'message': 'Комната не найдена'}), 404
 
-    if duration == 'forever':
-        user.mute_until = None
-    elif duration == '10m':
-        user.mute_until = datetime.utcnow() + timedelta(minutes=10)
-    elif duration == '1h':
-        user.mute_until = datetime.utcnow() + timedelta(hours=1)
-    elif duration == 'custom' and custom_minutes > 0:
-        user.mute_until = datetime.utcnow() + timedelta(minutes=custom_minutes)
+    mute_until = mute_expiry(duration, custom_minutes)
+    if room_id is None:
+        user.is_muted = True
+        user.mute_until = mute_until
+    else:
+        room_mute = RoomMute.query.filter_by(room_id=room_id, user_id=user.id).first()
+        if room_mute:
+            room_mute.mute_until = mute_until
+        else:
+            db.session.add(RoomMute(room_id=room_id, user_id=user.id, mute_until=mute_until))
 
     db.session.commit()
+    mute_registry.mute(user.id, mute_until, room_id)
+    user_cache.invalidate(user.id)
 
-    socketio.emit('user_muted', {
+    notice = {
         'username': user.username,
         'moderator': current_user.username,
         'duration': duration
-    }, room='chat')
+    }
+    for target_room_id in mute_notice_rooms(room_id):
+        broadcast('user_muted', notice, target_room_id)
 
     return jsonify({'success': True, 'message': f'Пользователь {user.username} замучен'})
 
 
 @app.route('/unmute_user', methods=['POST'])
 @login_required
+@rate_limit('moderation')
 def unmute_user():
-    if not current_user.is_moderator():
+    user_id = request.json.get('user_id')
+    room_id = request.json.get('room_id')
+    if not current_user.is_moderator(room_id):
         return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
 
-    user_id = request.json.get('user_id')
     user = User.query.get(user_id)
 
     if not user:
         return jsonify({'success': False, 'message': 'Пользователь не найден'}), 404
 
-    user.is_muted = False
-    user.mute_until = None
+    # Размут в комнате снимает и глобальный мут, иначе пользователь так и не сможет в ней писать.
+    # Модератор комнаты глобальный мут не снимает
+    global_mute = room_id is None or (mute_registry.is_muted(user.id) and current_user.is_moderator())
+    if global_mute:
+        user.is_muted = False
+        user.mute_until = None
+    if room_id is not None:
+        db.session.execute(delete(RoomMute).where(RoomMute.room_id == room_id, RoomMute.user_id == user.id))
     db.session.commit()
+    if global_mute:
+        mute_registry.unmute(user.id)
+    if room_id is not None:
+        mute_registry.unmute(user.id, room_id)
+    user_cache.invalidate(user.id)
 
-    socketio.emit('user_unmuted', {
+    notice = {
         'username': user.username,
         'moderator': current_user.username
-    }, room='chat')
+    }
+    for target_room_id in mute_notice_rooms(room_id):
+        broadcast('user_unmuted', notice, target_room_id)
 
     return jsonify({'success': True, 'message': f'Мут снят с {user.username}'})
 
 
+# Массовые операции с пользователями: JSON-массив или CSV-файл с заголовком,
+# обработка пачками по BULK_CHUNK_SIZE строк, одна транзакция на пачку
+def read_bulk_rows():
+    upload = request.files.get('file')
+    if upload:
+        return csv.DictReader(io.TextIOWrapper(upload.stream, encoding='utf-8-sig'))
+
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('rows')
+    return data if isinstance(data, list) else None
+
+
+def chunked(rows, size):
+    chunk = []
+    for index, row in enumerate(rows, start=1):
+        chunk.append((index, row if isinstance(row, dict) else {}))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_bulk_users(chunk):
+    ids = {parse_int(row.get('user_id')) for _, row in chunk} - {None}
+    return {user.id: user for user in User.query.filter(User.id.in_(ids))} if ids else {}
+
+
+def bulk_create_users(chunk, results):
+    usernames = {str(row.get('username') or '').strip() for _, row in chunk}
+    taken = {username for (username,) in db.session.query(User.username).filter(User.username.in_(usernames))}
+
+    valid = []
+    for index, row in chunk:
+        username = str(row.get('username') or '').strip()
+        password = str(row.get('password') or '')
+        role = row.get('role') or 'user'
+        if not username or not password:
+            results.append({'row': index, 'success': False, 'message': 'Не указан логин или пароль'})
+        elif role not in ROLES:
+            results.append({'row': index, 'success': False, 'message': 'Неизвестная роль'})
+        elif username in taken:
+            results.append({'row': index, 'success': False, 'message': 'Пользователь уже существует'})
+        else:
+            taken.add(username)
+            valid.append((index, username, password, role))
+
+    if not valid:
+        return []
+
+    hashes = password_hasher.hash_many([password for _, _, password, _ in valid])
+    db.session.execute(insert(User), [
+        {'username': username, 'password_hash': password_hash, 'role': role}
+        for (_, username, _, role), password_hash in zip(valid, hashes)
+    ])
+    return [(index, f'Пользователь {username} создан') for index, username, _, _ in valid]
+
+
+def bulk_change_role(chunk, results):
+    users = load_bulk_users(chunk)
+    valid = []
+    for index, row in chunk:
+        user = users.get(parse_int(row.get('user_id')))
+        role = row.get('role')
+        if not user:
+            results.append({'row': index, 'success': False, 'message': 'Пользователь не найден'})
+        elif role not in ROLES:
+            results.append({'row': index, 'success': False, 'message': 'Неизвестная роль'})
+        else:
+            valid.append((index, user.id, role))
+
+    if valid:
+        user_table = User.__table__
+        db.session.execute(
+            user_table.update().where(user_table.c.id == bindparam('user_id')).values(role=bindparam('new_role')),
+            [{'user_id': user_id, 'new_role': role} for _, user_id, role in valid]
+        )
+    return [(index, f'Роль изменена на {role}') for index, _, role in valid]
+
+
+def bulk_delete_users(chunk, results):
+    users = load_bulk_users(chunk)
+    valid = {}
+    for index, row in chunk:
+        user = users.get(parse_int(row.get('user_id')))
+        if not user:
+            results.append({'row': index, 'success': False, 'message': 'Пользователь не найден'})
+        elif user.is_creator():
+            results.append({'row': index, 'success': False, 'message': 'Нельзя удалить создателя'})
+        else:
+            valid[index] = user.id
+
+    if valid:
+        delete_users_cascade(set(valid.values()))
+    return [(index, 'Пользователь удален') for index in valid]
+
+
+def bulk_mute_users(chunk, results):
+    users = load_bulk_users(chunk)
+    valid = []
+    for index, row in chunk:
+        user = users.get(parse_int(row.get('user_id')))
+        duration = row.get('duration', 'forever')
+        custom_minutes = parse_int(row.get('custom_minutes')) or 0
+        if not user:
+            results.append({'row': index, 'success': False, 'message': 'Пользователь не найден'})
+        elif user.is_moderator():
+            results.append({'row': index, 'success': False, 'message': 'Нельзя замутить модератора'})
+        elif duration not in ('forever', '10m', '1h', 'custom') or (duration == 'custom' and custom_minutes <= 0):
+            results.append({'row': index, 'success': False, 'message': 'Неверная длительность'})
+        else:
+            valid.append((index, user.id, mute_expiry(duration, custom_minutes)))
+
+    if valid:
+        user_table = User.__table__
+        db.session.execute(
+            user_table.update().where(user_table.c.id == bindparam('user_id'))
+            .values(is_muted=True, mute_until=bindparam('until')),
+            [{'user_id': user_id, 'until': until} for _, user_id, until in valid]
+        )
+    return [(index, 'Пользователь замучен') for index, _, _ in valid]
+
+
+BULK_USER_ACTIONS = {
+    'create': bulk_create_users,
+    'change_role': bulk_change_role,
+    'delete': bulk_delete_users,
+    'mute': bulk_mute_users,
+}
+
+
+def apply_bulk_side_effects(action, chunk):
+    # Синхронизация кэшей в памяти после успешного коммита пачки
+    if action != 'create':
+        for user_id in {parse_int(row.get('user_id')) for _, row in chunk}:
+            user_cache.invalidate(user_id)
+
+    if action == 'delete':
+        for user_id in {parse_int(row.get('user_id')) for _, row in chunk}:
+            mute_registry.forget_user(user_id)
+            cart_summaries.invalidate(user_id)
+    elif action == 'mute':
+        mute_registry.refresh()
+
+
+@app.route('/admin/users/bulk/<action>', methods=['POST'])
+@login_required
+@rate_limit('admin')
+def bulk_users(action):
+    if not current_user.is_creator():
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+
+    handler = BULK_USER_ACTIONS.get(action)
+    if not handler:
+        return jsonify({'success': False, 'message': 'Неизвестная операция'}), 404
+
+    rows = read_bulk_rows()
+    if rows is None:
+        return jsonify({'success': False, 'message': 'Ожидается JSON-массив или CSV-файл'}), 400
+
+    results = []
+    for chunk in chunked(rows, app.config['BULK_CHUNK_SIZE']):
+        chunk_results = []
+        try:
+            succeeded = handler(chunk, chunk_results)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('Ошибка массовой операции %s', action)
+            failed = {result['row'] for result in chunk_results}
+            chunk_results += [{'row': index, 'success': False, 'message': 'Ошибка базы данных'}
+                              for index, _ in chunk if index not in failed]
+        else:
+            chunk_results += [{'row': index, 'success': True, 'message': message} for index, message in succeeded]
+            apply_bulk_side_effects(action, chunk)
+        results += sorted(chunk_results, key=lambda result: result['row'])
+
+    succeeded_count = sum(result['success'] for result in results)
+    return jsonify({
+        'success': True,
+        'processed': len(results),
+        'succeeded': succeeded_count,
+        'failed': len(results) - succeeded_count,
+        'results': results
+    })
+
+
 @app.route('/logout')
 @login_required
 def logout():
@@ -315,94 +2550,236 @@ def logout():
 @app.route('/shop')
 @login_required
 def shop():
-    products = Product.query.filter(Product.stock > 0).all()
-    cart_count = CartItem.query.filter_by(user_id=current_user.id).count()
-    return render_template('shop.html', products=products, cart_count=cart_count)
+    catalog = catalog_cache.get_page(*catalog_page_args())
+    cart_count = cart_summaries.get(current_user.id)['count']
+
+    def render():
+        return render_template('shop.html', products=catalog['products'], catalog=catalog, cart_count=cart_count)
+
+    # Страница с flash-сообщениями одноразовая, её не отдаём через 304
+    if '_flashes' in session:
+        return render()
+
+    # В HTML есть навбар и счётчик корзины, поэтому ETag зависит ещё и от пользователя
+    page_key = f"{catalog['etag']}|{current_user.id}|{current_user.username}|{current_user.role}|{cart_count}"
+    etag = 'shop-' + hashlib.sha1(page_key.encode()).hexdigest()
+    return conditional_response(etag, None, render)
+
+
+@app.route('/shop/api/products')
+@login_required
+def catalog_api():
+    catalog = catalog_cache.get_page(*catalog_page_args())
+    fields = ('products', 'total', 'page', 'limit', 'sort', 'pages')
+    return conditional_response(catalog['etag'], catalog['last_modified'],
+                                lambda: jsonify({field: catalog[field] for field in fields}))
 
 
 @app.route('/shop/product/<int:product_id>')
 @login_required
 def product_detail(product_id):
     product = Product.query.get_or_404(product_id)
-    cart_count = CartItem.query.filter_by(user_id=current_user.id).count()
+    cart_count = cart_summaries.get(current_user.id)['count']
     return render_template('product_detail.html', product=product, cart_count=cart_count)
 
 
+def load_cart_items(user_id):
+    return CartItem.query.options(joinedload(CartItem.product)).filter_by(user_id=user_id).all()
+
+
 @app.route('/cart')
 @login_required
 def cart():
-    cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
+    cart_items = load_cart_items(current_user.id)
     total = sum(item.product.price * item.quantity for item in cart_items)
     return render_template('cart.html', cart_items=cart_items, total=total)
 
 
 @app.route('/cart/add/<int:product_id>', methods=['POST'])
 @login_required
+@rate_limit('cart')
 def add_to_cart(product_id):
+    # id и цена запоминаются до коммита: после него объекты истекают и перечитываются из базы
+    user_id = current_user.id
     product = Product.query.get_or_404(product_id)
+    price = product.price
     quantity = int(request.json.get('quantity', 1))
 
     if product.stock < quantity:
         return jsonify({'success': False, 'message': 'Недостаточно товара на складе'}), 400
 
-    cart_item = CartItem.query.filter_by(user_id=current_user.id, product_id=product_id).first()
+    cart_item = CartItem.query.filter_by(user_id=user_id, product_id=product_id).first()
 
     if cart_item:
         cart_item.quantity += quantity
+        new_items = 0
     else:
-        cart_item = CartItem(user_id=current_user.id, product_id=product_id, quantity=quantity)
+        cart_item = CartItem(user_id=user_id, product_id=product_id, quantity=quantity)
         db.session.add(cart_item)
+        new_items = 1
 
     db.session.commit()
+    cart_summaries.adjust(user_id, new_items, price * quantity)
 
-    cart_count = CartItem.query.filter_by(user_id=current_user.id).count()
-    return jsonify({'success': True, 'message': 'Товар добавлен в корзину', 'cart_count': cart_count})
+    summary = cart_summaries.get(user_id)
+    return jsonify({'success': True, 'message': 'Товар добавлен в корзину',
+                    'cart_count': summary['count'], 'cart_total': summary['total']})
 
 
 @app.route('/cart/update/<int:item_id>', methods=['POST'])
 @login_required
+@rate_limit('cart')
 def update_cart(item_id):
-    cart_item = CartItem.query.get_or_404(item_id)
+    user_id = current_user.id
+    cart_item = CartItem.query.options(joinedload(CartItem.product)).get_or_404(item_id)
 
-    if cart_item.user_id != current_user.id:
+    if cart_item.user_id != user_id:
         return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
 
     quantity = int(request.json.get('quantity', 1))
+    price = cart_item.product.price
+    old_quantity = cart_item.quantity
 
     if quantity <= 0:
         db.session.delete(cart_item)
+        count_delta, quantity_delta = -1, -old_quantity
     elif cart_item.product.stock >= quantity:
         cart_item.quantity = quantity
+        count_delta, quantity_delta = 0, quantity - old_quantity
     else:
         return jsonify({'success': False, 'message': 'Недостаточно товара'}), 400
 
     db.session.commit()
-    return jsonify({'success': True})
+    cart_summaries.adjust(user_id, count_delta, price * quantity_delta)
+
+    summary = cart_summaries.get(user_id)
+    return jsonify({'success': True, 'cart_count': summary['count'], 'cart_total': summary['total']})
 
 
 @app.route('/cart/remove/<int:item_id>', methods=['POST'])
 @login_required
+@rate_limit('cart')
 def remove_from_cart(item_id):
-    cart_item = CartItem.query.get_or_404(item_id)
+    user_id = current_user.id
+    cart_item = CartItem.query.options(joinedload(CartItem.product)).get_or_404(item_id)
 
-    if cart_item.user_id != current_user.id:
+    if cart_item.user_id != user_id:
         return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
 
+    line_total = cart_item.product.price * cart_item.quantity
     db.session.delete(cart_item)
     db.session.commit()
+    cart_summaries.adjust(user_id, -1, -line_total)
+
+    summary = cart_summaries.get(user_id)
+    return jsonify({'success': True, 'cart_count': summary['count'], 'cart_total': summary['total']})
+
+
+def bump_rollup(model, key, **deltas):
+    # Один атомарный upsert: при UPDATE, а затем INSERT две транзакции могли бы вставить один ключ
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        stmt = (sqlite if dialect == 'sqlite' else postgresql).insert(model).values(**key, **deltas)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=list(key),
+            set_={name: getattr(model, name) + getattr(stmt.excluded, name) for name in deltas}
+        ))
+    elif dialect in ('mysql', 'mariadb'):
+        stmt = mysql.insert(model).values(**key, **deltas)
+        db.session.execute(stmt.on_duplicate_key_update(
+            {name: getattr(model, name) + getattr(stmt.inserted, name) for name in deltas}
+        ))
+    else:
+        # Остальные базы: UPDATE, затем INSERT в точке сохранения, при гонке - UPDATE ещё раз
+        for attempt in range(2):
+            result = db.session.execute(
+                update(model).filter_by(**key)
+                .values({name: getattr(model, name) + delta for name, delta in deltas.items()})
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount:
+                return
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(insert(model).values(**key, **deltas))
+                return
+            except IntegrityError:
+                if attempt:
+                    raise
+
+
+def record_sales(day, total, lines, sign=1):
+    # lines - пары (product_name, product_price, quantity)
+    bump_rollup(SalesDaily, {'day': day},
+                orders_count=sign, units=sign * sum(quantity for _, _, quantity in lines),
+                revenue=sign * total)
+    for product_name, product_price, quantity in lines:
+        bump_rollup(ProductSales, {'product_name': product_name},
+                    units=sign * quantity, revenue=sign * product_price * quantity)
+
+
+class CheckoutError(Exception):
+    pass
+
+
+def place_order(user_id, address, contact):
+    # Корзина и товары одним запросом, в порядке id товаров - одинаковый порядок блокировок
+    rows = db.session.query(CartItem.product_id, CartItem.quantity,
+                            Product.name, Product.price, Product.image_url) \
+        .join(Product, CartItem.product_id == Product.id) \
+        .filter(CartItem.user_id == user_id) \
+        .order_by(CartItem.product_id).all()
+
+    if not rows:
+        raise CheckoutError('Корзина пуста')
+
+    try:
+        # Списание со склада условным UPDATE: при нехватке строка не обновится
+        for row in rows:
+            result = db.session.execute(
+                update(Product)
+                .where(Product.id == row.product_id, Product.stock >= row.quantity)
+                .values(stock=Product.stock - row.quantity)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount != 1:
+                raise CheckoutError(f'Недостаточно товара «{row.name}» на складе')
 
-    return jsonify({'success': True})
+        order = Order(
+            user_id=user_id,
+            total_price=sum(row.price * row.quantity for row in rows),
+            delivery_address=address,
+            contact_info=contact
+        )
+        db.session.add(order)
+        db.session.flush()
+
+        db.session.execute(insert(OrderItem), [{
+            'order_id': order.id,
+            'product_name': row.name,
+            'product_price': row.price,
+            'quantity': row.quantity,
+            'product_image': row.image_url
+        } for row in rows])
+
+        CartItem.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+        record_sales(order.created_at.date(), order.total_price,
+                     [(row.name, row.price, row.quantity) for row in rows])
+        bump_rollup(OrderStatusStats, {'status': order.status}, orders_count=1, revenue=order.total_price)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    catalog_cache.invalidate()
+    cart_summaries.invalidate(user_id)
+    return order
 
 
 @app.route('/checkout', methods=['GET', 'POST'])
 @login_required
 def checkout():
-    cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
-
-    if not cart_items:
-        flash('Корзина пуста', 'error')
-        return redirect(url_for('shop'))
-
     if request.method == 'POST':
         address = request.form.get('address')
         contact = request.form.get('contact')
@@ -411,40 +2788,21 @@ def checkout():
             flash('Заполните все поля', 'error')
             return redirect(url_for('checkout'))
 
-        # Создаем заказ
-        total = sum(item.product.price * item.quantity for item in cart_items)
-        order = Order(
-            user_id=current_user.id,
-            total_price=total,
-            delivery_address=address,
-            contact_info=contact
-        )
-        db.session.add(order)
-        db.session.flush()
-
-        # Добавляем товары в заказ
-        for item in cart_items:
-            order_item = OrderItem(
-                order_id=order.id,
-                product_name=item.product.name,
-                product_price=item.product.price,
-                quantity=item.quantity,
-                product_image=item.product.image_url
-            )
-            db.session.add(order_item)
-
-            # Уменьшаем количество на складе
-            item.product.stock -= item.quantity
-
-        # Очищаем корзину
-        for item in cart_items:
-            db.session.delete(item)
-
-        db.session.commit()
+        try:
+            place_order(current_user.id, address, contact)
+        except CheckoutError as error:
+            flash(str(error), 'error')
+            return redirect(url_for('cart'))
 
         flash('Заказ успешно оформлен! Мы свяжемся с вами в ближайшее время.', 'success')
         return redirect(url_for('my_orders'))
 
+    cart_items = load_cart_items(current_user.id)
+
+    if not cart_items:
+        flash('Корзина пуста', 'error')
+        return redirect(url_for('shop'))
+
     total = sum(item.product.price * item.quantity for item in cart_items)
     return render_template('checkout.html', cart_items=cart_items, total=total)
 
@@ -452,12 +2810,45 @@ def checkout():
 @app.route('/orders')
 @login_required
 def my_orders():
-    orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).all()
-    return render_template('my_orders.html', orders=orders)
+    page = max(request.args.get('page', 1, type=int), 1)
+    orders_page = Order.query.options(selectinload(Order.items)) \
+        .filter_by(user_id=current_user.id) \
+        .order_by(Order.created_at.desc(), Order.id.desc()) \
+        .paginate(page=page, per_page=app.config['ORDERS_PAGE_SIZE'], error_out=False)
+    return render_template('my_orders.html', orders=orders_page.items, orders_page=orders_page)
 
 
 # === АДМИНКА МАГАЗИНА ===
 
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+
+def admin_orders_page():
+    # Фильтры по статусу и дате опираются на индексы (status, created_at) и (created_at)
+    query = Order.query.options(selectinload(Order.items), joinedload(Order.customer))
+
+    status = request.args.get('status')
+    if status in ORDER_STATUSES:
+        query = query.filter(Order.status == status)
+
+    date_from = parse_date(request.args.get('date_from'))
+    if date_from:
+        query = query.filter(Order.created_at >= date_from)
+
+    date_to = parse_date(request.args.get('date_to'))
+    if date_to:
+        query = query.filter(Order.created_at < date_to + timedelta(days=1))
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', app.config['ADMIN_PAGE_SIZE'], type=int), 1), 200)
+    return query.order_by(Order.created_at.desc(), Order.id.desc()) \
+        .paginate(page=page, per_page=per_page, error_out=False)
+
+
 @app.route('/admin/shop')
 @login_required
 def admin_shop():
@@ -465,13 +2856,40 @@ def admin_shop():
         flash('Доступ запрещен', 'error')
         return redirect(url_for('shop'))
 
-    products = Product.query.all()
-    orders = Order.query.order_by(Order.created_at.desc()).all()
-    return render_template('admin_shop.html', products=products, orders=orders)
+    products_page = Product.query.order_by(Product.id.desc()).paginate(
+        page=max(request.args.get('products_page', 1, type=int), 1),
+        per_page=app.config['ADMIN_PAGE_SIZE'], error_out=False)
+    orders_page = admin_orders_page()
+
+    filters = {key: request.args.get(key, '') for key in ('status', 'date_from', 'date_to')}
+    return render_template('admin_shop.html',
+                           products=products_page.items,
+                           products_page=products_page,
+                           orders=orders_page.items,
+                           orders_page=orders_page,
+                           filters=filters,
+                           order_statuses=ORDER_STATUSES)
+
+
+@app.route('/admin/shop/api/orders')
+@login_required
+def admin_orders_api():
+    if not current_user.is_creator():
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+
+    orders_page = admin_orders_page()
+    return jsonify({
+        'success': True,
+        'orders': [order.to_dict() for order in orders_page.items],
+        'page': orders_page.page,
+        'pages': orders_page.pages,
+        'total': orders_page.total
+    })
 
 
 @app.route('/admin/shop/product/create', methods=['POST'])
 @login_required
+@rate_limit('admin')
 def create_product():
     if not current_user.is_creator():
         return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
@@ -492,17 +2910,20 @@ def create_product():
 
     db.session.add(product)
     db.session.commit()
+    catalog_cache.invalidate()
 
     return jsonify({'success': True, 'message': 'Товар создан'})
 
 
 @app.route('/admin/shop/product/<int:product_id>/edit', methods=['POST'])
 @login_required
+@rate_limit('admin')
 def edit_product(product_id):
     if not current_user.is_creator():
         return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
 
     product = Product.query.get_or_404(product_id)
+    old_price = product.price
 
     product.name = request.json.get('name', product.name)
     product.description = request.json.get('description', product.description)
@@ -511,12 +2932,16 @@ def edit_product(product_id):
     product.image_url = request.json.get('image_url', product.image_url)
 
     db.session.commit()
+    catalog_cache.invalidate()
+    if product.price != old_price:
+        cart_summaries.invalidate()
 
     return jsonify({'success': True, 'message': 'Товар обновлен'})
 
 
 @app.route('/admin/shop/product/<int:product_id>/delete', methods=['POST'])
 @login_required
+@rate_limit('admin')
 def delete_product(product_id):
     if not current_user.is_creator():
         return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
@@ -524,12 +2949,15 @@ def delete_product(product_id):
     product = Product.query.get_or_404(product_id)
     db.session.delete(product)
     db.session.commit()
+    catalog_cache.invalidate()
+    cart_summaries.invalidate()
 
     return jsonify({'success': True, 'message': 'Товар удален'})
 
 
 @app.route('/admin/shop/order/<int:order_id>/status', methods=['POST'])
 @login_required
+@rate_limit('admin')
 def update_order_status(order_id):
     if not current_user.is_creator():
         return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
@@ -537,43 +2965,223 @@ def update_order_status(order_id):
     order = Order.query.get_or_404(order_id)
     status = request.json.get('status')
 
-    if status in ['pending', 'paid', 'shipped', 'completed', 'cancelled']:
-        order.status = status
+    if status in ORDER_STATUSES:
+        if status != order.status:
+            bump_rollup(OrderStatusStats, {'status': order.status}, orders_count=-1, revenue=-order.total_price)
+            bump_rollup(OrderStatusStats, {'status': status}, orders_count=1, revenue=order.total_price)
+
+            if 'cancelled' in (status, order.status):
+                lines = [(item.product_name, item.product_price, item.quantity) for item in order.items]
+                record_sales(order.created_at.date(), order.total_price, lines,
+                             sign=-1 if status == 'cancelled' else 1)
+
+            order.status = status
         db.session.commit()
         return jsonify({'success': True, 'message': 'Статус обновлен'})
 
     return jsonify({'success': False, 'message': 'Неверный статус'}), 400
 
 
+@app.route('/admin/shop/stats')
+@login_required
+def shop_stats():
+    if not current_user.is_creator():
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+
+    statuses = OrderStatusStats.query.all()
+    daily = SalesDaily.query.filter(SalesDaily.day >= since).order_by(SalesDaily.day).all()
+    top_products = ProductSales.query.order_by(ProductSales.units.desc()).limit(10).all()
+
+    return jsonify({
+        'success': True,
+        'orders_count': sum(row.orders_count for row in statuses),
+        'revenue': round(sum(row.revenue for row in statuses if row.status != 'cancelled'), 2),
+        'statuses': {row.status: {'orders_count': row.orders_count, 'revenue': round(row.revenue, 2)}
+                     for row in statuses},
+        'daily': [row.to_dict() for row in daily],
+        'top_products': [row.to_dict() for row in top_products]
+    })
+
+
+@app.cli.command('rebuild-sales-stats')
+@click.option('--batch-size', default=1000, help='Сколько строк читать из базы за раз')
+def rebuild_sales_stats(batch_size):
+    """Пересчитать агрегаты продаж по всем заказам."""
+    daily = defaultdict(lambda: {'orders_count': 0, 'units': 0, 'revenue': 0.0})
+    products = defaultdict(lambda: {'units': 0, 'revenue': 0.0})
+    statuses = defaultdict(lambda: {'orders_count': 0, 'revenue': 0.0})
+
+    # Заказы и позиции читаются потоком, в памяти только сами агрегаты
+    orders = db.session.execute(
+        select(Order.created_at, Order.status, Order.total_price).execution_options(yield_per=batch_size))
+    for created_at, status, total_price in orders:
+        statuses[status]['orders_count'] += 1
+        statuses[status]['revenue'] += total_price
+        if status != 'cancelled':
+            daily[created_at.date()]['orders_count'] += 1
+            daily[created_at.date()]['revenue'] += total_price
+
+    items = db.session.execute(
+        select(Order.created_at, OrderItem.product_name, OrderItem.product_price, OrderItem.quantity)
+        .join(Order, OrderItem.order_id == Order.id)
+        .where(Order.status != 'cancelled')
+        .execution_options(yield_per=batch_size))
+    for created_at, product_name, product_price, quantity in items:
+        daily[created_at.date()]['units'] += quantity
+        products[product_name]['units'] += quantity
+        products[product_name]['revenue'] += product_price * quantity
+
+    for model in (SalesDaily, ProductSales, OrderStatusStats):
+        db.session.execute(model.__table__.delete())
+    for model, key, rows in ((SalesDaily, 'day', daily),
+                             (ProductSales, 'product_name', products),
+                             (OrderStatusStats, 'status', statuses)):
+        if rows:
+            db.session.execute(insert(model), [{key: name, **values} for name, values in rows.items()])
+    db.session.commit()
+
+    print(f'Агрегаты пересчитаны: {len(daily)} дней, {len(products)} товаров')
+
+
+@app.route('/admin/archive')
+@login_required
+def chat_archive():
+    if not current_user.is_creator():
+        return jsonify({'success': False, 'message': 'Доступ запрещен'}), 403
+
+    date_from = parse_date(request.args.get('from'))
+    date_to = parse_date(request.args.get('to')) or date_from
+    if not date_from or date_to < date_from or (date_to - date_from).days > 31:
+        return jsonify({'success': False, 'message': 'Укажите период from/to не длиннее 31 дня'}), 400
+
+    limit = min(max(request.args.get('limit', 1000, type=int), 1), 10000)
+    messages = []
+    for record in read_archive(date_from.date(), date_to.date()):
+        if len(messages) == limit:
+            break
+        messages.append(record)
+
+    return jsonify({'success': True, 'messages': messages, 'truncated': len(messages) == limit})
+
+
+@app.cli.command('archive-messages')
+def archive_messages_command():
+    """Перенести старые сообщения чата в архив по политике хранения."""
+    print(f'Перенесено в архив: {run_retention()} сообщений')
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Собрать статику: минификация, хеш в имени, gzip/brotli."""
+    manifest = build_assets()
+    print(f"Статика собрана в {app.config['ASSETS_DIR']}: {len(manifest)} файлов")
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Перестроить полнотекстовый индекс сообщений."""
+    if not search_enabled:
+        print('Поиск недоступен для этой базы данных')
+        return
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO message_fts(message_fts) VALUES ('rebuild')")
+    print('Индекс поиска перестроен')
+
+
 # WebSocket события
-@socketio.on('connect')
-def handle_connect():
+@socket_handler('connect')
+def handle_connect(auth=None):
+    if not accepting_connections:
+        return False
+
     if current_user.is_authenticated:
-        join_room('chat')
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
-        emit('user_connected', {
-            'username': current_user.username,
-            'user_id': current_user.id
-        }, room='chat')
+        start_background_tasks()
+        presence.connect(current_user.id, request.sid)
 
 
-@socketio.on('disconnect')
+@socket_handler('disconnect')
 def handle_disconnect():
     if current_user.is_authenticated:
-        leave_room('chat')
-        emit('user_disconnected', {
+        for room_id in presence.disconnect(current_user.id, request.sid):
+            broadcast('user_disconnected', {
+                'username': current_user.username,
+                'user_id': current_user.id
+            }, room_id)
+
+
+def socket_rate_limited(event, room_id=None):
+    if rate_limiter.allow(current_user, event, room_channel(room_id) if room_id else None):
+        return False
+    emit('rate_limited', {'event': event, 'message': 'Слишком много запросов. Подождите немного'})
+    return True
+
+
+def requested_room_id(data):
+    # id комнаты из события, если клиент в неё вошёл
+    if not isinstance(data, dict):
+        return None
+    try:
+        room_id = int(data.get('room_id'))
+    except (TypeError, ValueError):
+        return None
+    return room_id if presence.is_member(room_id, request.sid) else None
+
+
+@socket_handler('join')
+def handle_join(data):
+    if not current_user.is_authenticated:
+        return
+
+    if socket_rate_limited('join'):
+        return
+
+    room = db.session.get(Room, data.get('room_id'))
+    if not room:
+        return {'success': False, 'message': 'Комната не найдена'}
+
+    join_room(room.channel)
+    if presence.join(room.id, current_user.id, request.sid):
+        broadcast('user_connected', {
+            'username': current_user.username,
+            'user_id': current_user.id
+        }, room.id)
+    return {'success': True, 'room': room.to_dict()}
+
+
+@socket_handler('leave')
+def handle_leave(data):
+    if not current_user.is_authenticated:
+        return
+
+    room_id = requested_room_id(data)
+    if room_id is None:
+        return
+
+    leave_room(room_channel(room_id))
+    if presence.leave(room_id, current_user.id, request.sid):
+        broadcast('user_disconnected', {
             'username': current_user.username,
             'user_id': current_user.id
-        }, room='chat')
+        }, room_id)
 
 
-@socketio.on('send_message')
+@socket_handler('send_message')
 def handle_message(data):
     if not current_user.is_authenticated:
         return
 
-    if current_user.check_mute_status():
+    room_id = requested_room_id(data)
+    if room_id is None:
+        emit('message_error', {'message': 'Вы не состоите в этой комнате'})
+        return
+
+    if socket_rate_limited('send_message', room_id):
+        return
+
+    if current_user.check_mute_status(room_id):
         emit('message_error', {'message': 'Вы замучены и не можете отправлять сообщения'})
         return
 
@@ -581,44 +3189,164 @@ def handle_message(data):
     if not message_text:
         return
 
-    message = Message(user_id=current_user.id, text=message_text)
-    db.session.add(message)
-    db.session.commit()
+    if message_writer:
+        message = Message(**message_writer.enqueue(current_user.id, room_id, message_text))
+        payload = message.to_dict(author=current_user)
+        if app.config['CHAT_WRITE_DURABILITY'] == 'group_commit':
+            # Рассылаем только после коммита пачки, в которую попало сообщение
+            if not message_writer.wait_committed(message.id, app.config['CHAT_WRITE_COMMIT_TIMEOUT']):
+                emit('message_error', {'message': 'Сообщение ещё не сохранено, попробуйте позже'})
+                return
+    else:
+        message = Message(user_id=current_user.id, room_id=room_id, text=message_text)
+        db.session.add(message)
+        db.session.flush()
+        # Payload собирается до коммита, пока объекты не истекли и не требуют повторного SELECT
+        payload = message.to_dict(author=current_user)
+        db.session.commit()
 
-    emit('new_message', message.to_dict(), room='chat')
+    broadcast('new_message', payload, room_id)
 
 
-@socketio.on('delete_message')
+@socket_handler('delete_message')
 def handle_delete_message(data):
     if not current_user.is_authenticated:
         return
 
-    message_id = data.get('message_id')
-    message = Message.query.get(message_id)
+    message_id = parse_int(data.get('message_id')) if isinstance(data, dict) else None
+    if message_writer:
+        # Сообщение может ещё лежать в буфере отложенной записи
+        message_writer.flush()
+    message = db.session.get(Message, message_id) if message_id is not None else None
+
+    # Лимит и права - по комнате самого сообщения, а не по room_id из события
+    room_id = message.room_id if message else None
+    if socket_rate_limited('delete_message', room_id):
+        return
 
     if not message:
         return
 
-    if message.user_id != current_user.id and not current_user.is_moderator():
+    if message.user_id != current_user.id and not current_user.is_moderator(room_id):
         emit('message_error', {'message': 'Вы не можете удалить это сообщение'})
         return
 
     db.session.delete(message)
     db.session.commit()
 
-    emit('message_deleted', {'message_id': message_id}, room='chat')
+    broadcast('message_deleted', {'message_id': message_id}, room_id)
+
+
+@socket_handler('sync')
+def handle_sync(data):
+    if not current_user.is_authenticated:
+        return
 
+    if socket_rate_limited('sync'):
+        return
 
-@socketio.on('heartbeat')
+    room_id = requested_room_id(data)
+    if room_id is None:
+        return {'mode': 'reload'}
+
+    if chat_events and data.get('epoch') == chat_events.epoch:
+        seq = parse_int(data.get('seq') or 0)
+        if seq is None:
+            return {'mode': 'reload'}
+        missed = chat_events.since(seq, room_id)
+        if missed is not None:
+            events, seq = missed
+            return {'mode': 'events', 'events': events, 'epoch': chat_events.epoch, 'seq': seq}
+
+    return sync_from_database(room_id, data)
+
+
+def sync_from_database(room_id, data):
+    # Разрыв больше буфера (или другой процесс): новые сообщения комнаты по id и проверка удалённых
+    epoch, seq = (chat_events.epoch, chat_events.seq) if chat_events else ('', 0)
+    if message_writer:
+        message_writer.flush()
+
+    # Испорченное состояние клиента: проще перезагрузить страницу, чем угадывать
+    last_message_id = parse_int(data.get('last_message_id') or 0)
+    known_ids = data.get('known_ids') or []
+    if last_message_id is None or not isinstance(known_ids, list):
+        return {'mode': 'reload'}
+
+    limit = app.config['CHAT_SYNC_MAX_MESSAGES']
+    messages = Message.query.options(joinedload(Message.author)) \
+        .filter(Message.room_id == room_id, Message.id > last_message_id) \
+        .order_by(Message.id).limit(limit + 1).all()
+    if len(messages) > limit:
+        return {'mode': 'reload'}
+
+    known_ids = {parse_int(message_id) for message_id in known_ids[-limit:]} - {None}
+    existing_ids = set(db.session.scalars(select(Message.id).where(Message.id.in_(known_ids)))) if known_ids else set()
+
+    return {
+        'mode': 'snapshot',
+        'messages': [message.to_dict() for message in messages],
+        'deleted_ids': sorted(known_ids - existing_ids),
+        'online_ids': sorted(presence.online_user_ids(room_id)),
+        'epoch': epoch,
+        'seq': seq
+    }
+
+
+@socket_handler('heartbeat')
 def handle_heartbeat():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
+        presence.heartbeat(current_user.id, request.sid)
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+
+def add_missing_columns():
+    # create_all не меняет существующие таблицы: новые колонки моделей добавляются через ALTER TABLE
+    # (без NOT NULL - старые строки заполняются отдельно)
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column_info['name'] for column_info in inspector.get_columns(table.name)}
+            for table_column in table.columns:
+                if table_column.name not in existing:
+                    column_type = table_column.type.compile(dialect=db.engine.dialect)
+                    connection.exec_driver_sql(
+                        f'ALTER TABLE "{table.name}" ADD COLUMN "{table_column.name}" {column_type}')
+
+
+default_room_id = None
+
+
+def ensure_default_room():
+    global default_room_id
+    room = Room.query.filter_by(slug=app.config['CHAT_DEFAULT_ROOM']).first()
+    if not room:
+        room = Room(slug=app.config['CHAT_DEFAULT_ROOM'], name='Общий чат')
+        db.session.add(room)
         db.session.commit()
+    default_room_id = room.id
+
+    # Сообщения, написанные до появления комнат
+    db.session.execute(update(Message).where(Message.room_id.is_(None)).values(room_id=room.id))
+    db.session.commit()
 
 
 # Инициализация базы данных
 with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', apply_sqlite_pragmas)
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+
     db.create_all()
+    add_missing_columns()
+    ensure_default_room()
 
     # Создание пользователя-создателя если его нет
     if not User.query.filter_by(username='Resolving').first():
@@ -628,5 +3356,33 @@ with app.app_context():
         db.session.commit()
         print("Создатель 'Resolving' создан с паролем 'admin123'")
 
+    # create_all не добавляет новые индексы в уже существующие таблицы
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+    setup_message_search()
+    mute_registry.load()
+
+if app.config['ASSETS_BUILD_ON_STARTUP']:
+    try:
+        build_assets()
+    except OSError as e:
+        # Например, static только для чтения: берём уже собранный манифест или отдаём файлы как есть
+        app.logger.warning('Не удалось собрать статику: %s', e)
+        load_asset_manifest()
+else:
+    load_asset_manifest()
+
+
+def handle_sigterm(signum, frame):
+    drain_connections()
+    sys.exit(0)
+
+
 if __name__ == '__main__':
-    socketio.run(app, debug=True)
\ No newline at end of file
+    # Локальный запуск; в продакшене: gunicorn -c gunicorn.conf.py app:app
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    debug = os.environ.get('FLASK_DEBUG', '0') == '1'
+    socketio.run(app, host=os.environ.get('HOST', '127.0.0.1'), port=int(os.environ.get('PORT', 5000)),
+                 debug=debug, use_reloader=debug, allow_unsafe_werkzeug=ASYNC_MODE == 'threading')
@@ -0,0 +1 @@
+# Нагрузочные прогоны приложения: python -m bench --help
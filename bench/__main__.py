@@ -0,0 +1,89 @@
+# python -m bench seed --db bench.db --messages 1000000
+# python -m bench run --db bench.db --out before.json [сценарий[:вариант] ...]
+# python -m bench compare before.json after.json
+import argparse
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Нагрузочные прогоны чата и магазина')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed = commands.add_parser('seed', help='наполнить базу тестовыми данными')
+    seed.add_argument('--db', default='bench.db', help='файл SQLite (по умолчанию bench.db)')
+    seed.add_argument('--users', type=int, default=1000)
+    seed.add_argument('--rooms', type=int, default=20, help='комнат вместе с общей')
+    seed.add_argument('--messages', type=int, default=100000)
+    seed.add_argument('--products', type=int, default=200)
+    seed.add_argument('--orders', type=int, default=5000)
+    seed.add_argument('--days', type=int, default=30, help='период, по которому распределены сообщения и заказы')
+    seed.add_argument('--force', action='store_true', help='перезаписать существующую базу')
+
+    run = commands.add_parser('run', help='выполнить сценарии и сохранить результаты в JSON')
+    run.add_argument('scenarios', nargs='*', help='сценарий или сценарий:вариант, по умолчанию все')
+    run.add_argument('--db', default='bench.db', help='наполненная база; каждый вариант работает на копии')
+    run.add_argument('--out', default='bench-results.json')
+    run.add_argument('--duration', type=float, help='длительность сценариев с ограничением по времени, с')
+    run.add_argument('--concurrency', type=int, help='число параллельных пользователей или отправителей')
+    run.add_argument('--clients', type=int, help='подключённых клиентов в сценариях рассылки')
+    run.add_argument('--messages', type=int, help='сообщений на вариант')
+    run.add_argument('--workers', type=int, help='воркеров в queue_fanout')
+    run.add_argument('--queue-url', help='очередь сообщений Socket.IO для queue_fanout (по умолчанию bench.broker)')
+    run.add_argument('--keep-workdir', action='store_true', help='не удалять копии баз и логи прогонов')
+
+    commands.add_parser('list', help='показать сценарии и варианты')
+
+    compare = commands.add_parser('compare', help='сравнить два файла результатов')
+    compare.add_argument('base')
+    compare.add_argument('new')
+
+    worker = commands.add_parser('worker')  # внутренняя команда: один вариант в отдельном процессе
+    worker.add_argument('scenario')
+    worker.add_argument('variant')
+    worker.add_argument('--params', required=True)
+    worker.add_argument('--result', required=True)
+
+    args = parser.parse_args()
+    sys.path.insert(0, ROOT)
+
+    if args.command == 'seed':
+        if os.path.exists(args.db):
+            if not args.force:
+                parser.error(f'{args.db} уже существует, добавьте --force')
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(args.db + suffix):
+                    os.remove(args.db + suffix)
+        # Конфигурация приложения читается при импорте
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(args.db)}'
+        os.environ.setdefault('SQLITE_SYNCHRONOUS', 'OFF')
+        from bench.seed import seed as seed_database
+        seed_database(users=args.users, rooms=args.rooms, messages=args.messages, products=args.products,
+                      orders=args.orders, days=args.days)
+    elif args.command == 'list':
+        from bench.scenarios import SCENARIOS
+        for name, definition in SCENARIOS.items():
+            print(f"{name:<22} {definition['description']}")
+            print(f"{'':<22} варианты: {', '.join(definition['variants'])}")
+    elif args.command == 'run':
+        from bench.runner import run as run_scenarios
+        overrides = {'duration': args.duration, 'concurrency': args.concurrency, 'clients': args.clients,
+                     'messages': args.messages, 'workers': args.workers, 'queue_url': args.queue_url}
+        report = run_scenarios(args.scenarios, args.db, overrides, args.out, args.keep_workdir)
+        failed = [f"{entry['scenario']}:{entry['variant']}" for entry in report['results']
+                  if entry['status'] == 'failed']
+        print(f'Результаты: {args.out}' + (f", с ошибками: {', '.join(failed)}" if failed else ''))
+        sys.exit(1 if failed else 0)
+    elif args.command == 'compare':
+        from bench.runner import compare as compare_results
+        compare_results(args.base, args.new)
+    elif args.command == 'worker':
+        from bench.runner import run_worker
+        run_worker(args.scenario, args.variant, json.loads(args.params), args.result)
+
+
+if __name__ == '__main__':
+    main()
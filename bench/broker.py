@@ -0,0 +1,109 @@
+# Заглушка очереди сообщений Socket.IO для прогонов на одной машине: брокер пересылает каждый кадр
+# всем подключённым воркерам (как PUBLISH/SUBSCRIBE в Redis), воркеры подключаются к нему по TCP.
+# Воркеры запускаются как bench.broker_app:app с SOCKETIO_MESSAGE_QUEUE=tcp://127.0.0.1:<порт>
+import pickle
+import socket
+import struct
+import threading
+import urllib.parse
+
+import socketio
+
+FRAME_HEADER = struct.Struct('>I')
+
+
+def send_frame(sock, data):
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+
+def read_frames(sock):
+    reader = sock.makefile('rb')
+    while True:
+        header = reader.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return
+        yield reader.read(FRAME_HEADER.unpack(header)[0])
+
+
+class QueueBroker:
+    def __init__(self, host='127.0.0.1'):
+        self._server = socket.create_server((host, 0))
+        self.url = f'tcp://{host}:{self._server.getsockname()[1]}'
+        self.frames = 0
+        self._clients = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                return
+            with self._lock:
+                self._clients.append(connection)
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        # Кадр уходит и отправителю: менеджер сам пропускает свои сообщения по host_id
+        try:
+            for frame in read_frames(connection):
+                with self._lock:
+                    self.frames += 1
+                    for client in self._clients:
+                        try:
+                            send_frame(client, frame)
+                        except OSError:
+                            pass
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._clients.remove(connection)
+            connection.close()
+
+    def stop(self):
+        self._server.close()
+        with self._lock:
+            for client in self._clients:
+                client.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class BrokerManager(socketio.PubSubManager):
+    # Одно соединение на воркер: открывается при первом обращении, то есть уже после fork
+    name = 'bench-broker'
+
+    def __init__(self, url, channel='socketio', write_only=False, logger=None):
+        parsed = urllib.parse.urlsplit(url)
+        self.address = (parsed.hostname, parsed.port)
+        self._connection = None
+        self._connect_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _socket(self):
+        with self._connect_lock:
+            if self._connection is None:
+                self._connection = socket.create_connection(self.address)
+            return self._connection
+
+    def _publish(self, data):
+        frame = pickle.dumps({'channel': self.channel, 'data': data})
+        connection = self._socket()
+        with self._send_lock:
+            send_frame(connection, frame)
+
+    def _listen(self):
+        for frame in read_frames(self._socket()):
+            message = pickle.loads(frame)
+            if message['channel'] == self.channel:
+                yield message['data']
@@ -0,0 +1,19 @@
+# Точка входа gunicorn для прогонов с заглушкой брокера (bench.broker): очередь tcp://...
+# подключается через BrokerManager. SocketIO подменяется до импорта app, поэтому так
+# запускается только режим threading - зелёным потокам app должен пропатчить всё первым
+import flask_socketio
+
+from bench.broker import BrokerManager
+
+
+class BrokerSocketIO(flask_socketio.SocketIO):
+    def init_app(self, flask_app, **kwargs):
+        url = kwargs.get('message_queue') or ''
+        if url.startswith('tcp://'):
+            kwargs['client_manager'] = BrokerManager(url, channel=kwargs.pop('channel', 'flask-socketio'))
+        super().init_app(flask_app, **kwargs)
+
+
+flask_socketio.SocketIO = BrokerSocketIO
+
+from app import app  # noqa: E402,F401
@@ -0,0 +1,235 @@
+# Общие средства нагрузочных сценариев: замеры операций, подсчёт запросов к базе,
+# виртуальные пользователи на тестовых клиентах Flask и Flask-SocketIO, журнал доставки кадров
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+# Окружение всех прогонов: лимиты частоты подняты, чтобы мерить приложение, а не ограничитель
+BASE_ENV = {
+    'SECRET_KEY': 'bench-secret-key',
+    'LOGIN_IP_BURST': '1000000',
+    'LOGIN_IP_PER_MINUTE': '1000000000',
+    'LOGIN_USER_BURST': '1000000',
+    'LOGIN_USER_PER_MINUTE': '1000000000',
+    'RATE_LIMIT_ROOM_BURST': '1000000',
+    'RATE_LIMIT_ROOM_PER_MINUTE': '1000000000',
+    **{f'RATE_LIMIT_{role}_{limit}': '1000000000'
+       for role in ('CREATOR', 'MODERATOR', 'USER') for limit in ('BURST', 'PER_MINUTE')},
+}
+
+BENCH_PASSWORD = 'bench-password'
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def latency_summary(seconds):
+    # Задержки в миллисекундах, квантили как в /metrics
+    if not seconds:
+        return {'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    values = sorted(seconds)
+    return {
+        'mean': round(sum(values) / len(values) * 1000, 3),
+        'p50': round(percentile(values, 0.5) * 1000, 3),
+        'p95': round(percentile(values, 0.95) * 1000, 3),
+        'p99': round(percentile(values, 0.99) * 1000, 3),
+        'max': round(values[-1] * 1000, 3),
+    }
+
+
+class QueryCounter:
+    # Запросы к базе, выполненные текущим потоком: тестовые клиенты обрабатывают
+    # запросы и события сокета в вызывающем потоке
+    def __init__(self, engine):
+        self._local = threading.local()
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def current(self):
+        return getattr(self._local, 'count', 0)
+
+
+class Recorder:
+    def __init__(self, queries=None):
+        self.queries = queries
+        self._latencies = defaultdict(list)
+        self._queries = defaultdict(list)
+        self._errors = defaultdict(int)
+        self._error_samples = {}
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, op, seconds, queries=None):
+        with self._lock:
+            self._latencies[op].append(seconds)
+            if queries is not None:
+                self._queries[op].append(queries)
+
+    def error(self, op, reason=None):
+        with self._lock:
+            self._errors[op] += 1
+            if reason and op not in self._error_samples:
+                self._error_samples[op] = str(reason)[:300]
+
+    @contextmanager
+    def timed(self, op):
+        # Операция считается ошибкой, если внутри выброшено исключение или вызван fail()
+        outcome = {'failed': None}
+        queries_before = self.queries.current() if self.queries else None
+        started = time.perf_counter()
+        try:
+            yield outcome
+        except Exception as error:
+            self.error(op, repr(error))
+            return
+        elapsed = time.perf_counter() - started
+        if outcome['failed']:
+            self.error(op, outcome['failed'])
+            return
+        queries = self.queries.current() - queries_before if self.queries else None
+        self.record(op, elapsed, queries)
+
+    def stop(self):
+        self.finished = time.perf_counter()
+
+    def summary(self):
+        duration = (self.finished or time.perf_counter()) - self.started
+        operations = {}
+        for op in sorted(set(self._latencies) | set(self._errors)):
+            latencies = self._latencies.get(op, [])
+            queries = self._queries.get(op, [])
+            errors = self._errors.get(op, 0)
+            total = len(latencies) + errors
+            operations[op] = {
+                'count': len(latencies),
+                'errors': errors,
+                'error_rate': round(errors / total, 4) if total else 0.0,
+                'throughput_per_s': round(len(latencies) / duration, 2) if duration else 0.0,
+                'latency_ms': latency_summary(latencies),
+            }
+            if queries:
+                operations[op]['queries_per_op'] = {'mean': round(sum(queries) / len(queries), 2),
+                                                    'max': max(queries)}
+            if op in self._error_samples:
+                operations[op]['error_sample'] = self._error_samples[op]
+        return round(duration, 3), operations
+
+
+def run_threads(count, target, *args):
+    # Потоки стартуют одновременно через барьер; исключения потоков не теряются
+    barrier = threading.Barrier(count)
+    failures = []
+
+    def worker(index):
+        barrier.wait()
+        try:
+            target(index, *args)
+        except Exception as error:
+            failures.append(repr(error))
+
+    threads = [threading.Thread(target=worker, args=(index,), daemon=True) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise RuntimeError(f'{len(failures)} потоков упали, первый: {failures[0]}')
+
+
+class VirtualUser:
+    # HTTP-клиент и клиент сокета одного пользователя. Без http сессия Flask-Login выставляется
+    # напрямую, чтобы не тратить время на хеширование пароля там, где вход не измеряется
+    def __init__(self, web, user_id, socket=True, http=None):
+        self.web = web
+        self.user_id = user_id
+        self.http = http
+        if http is None:
+            self.http = web.app.test_client()
+            with self.http.session_transaction() as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+        self.socket = web.socketio.test_client(web.app, flask_test_client=self.http) if socket else None
+
+    def join(self, room_id):
+        reply = self.socket.emit('join', {'room_id': room_id}, callback=True)
+        if not reply or not reply.get('success'):
+            raise RuntimeError(f'Не удалось войти в комнату {room_id}: {reply}')
+
+    def send(self, room_id, text):
+        self.socket.emit('send_message', {'room_id': room_id, 'message': text})
+
+    def drain(self):
+        # Кадры, дошедшие до тестового клиента, иначе очередь растёт всё время прогона
+        return self.socket.get_received()
+
+    def close(self):
+        if self.socket and self.socket.is_connected():
+            self.socket.disconnect()
+
+
+def login_with_password(client, username, password=BENCH_PASSWORD):
+    response = client.post('/login', data={'username': username, 'password': password})
+    return response.status_code == 302 and response.headers.get('Location', '').endswith('/chat')
+
+
+class DeliveryLog:
+    # Перехват отправки кадров Engine.IO: время, получатель и содержимое каждого кадра рассылки.
+    # Без forward кадры не доходят до тестовых клиентов - их разбор не попадает в замер
+    token_re = re.compile(r'#B(\d{8})#')
+
+    def __init__(self, server, forward=False):
+        self._server = server
+        self._original = server._send_eio_packet
+        self._forward = forward
+        self.frames = []  # (time, eio_sid, data)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        def send_eio_packet(eio_sid, eio_pkt):
+            with self._lock:
+                self.frames.append((time.perf_counter(), eio_sid, eio_pkt.data))
+            if self._forward:
+                self._original(eio_sid, eio_pkt)
+
+        self._server._send_eio_packet = send_eio_packet
+        return self
+
+    def __exit__(self, *exc):
+        self._server._send_eio_packet = self._original
+
+    @staticmethod
+    def token(number):
+        return f'#B{number:08d}#'
+
+    def totals(self):
+        # Байты - как на проводе: префикс типа пакета Engine.IO плюс тело в UTF-8
+        frames = len(self.frames)
+        size = sum(1 + (len(data) if isinstance(data, bytes) else len(data.encode()))
+                   for _, _, data in self.frames)
+        return frames, size
+
+    def deliveries(self):
+        # Номер сообщения -> время доставки каждому получателю
+        delivered = defaultdict(list)
+        for sent_at, _, data in self.frames:
+            text = data.decode('utf-8', 'replace') if isinstance(data, bytes) else data
+            for number in self.token_re.findall(text):
+                delivered[int(number)].append(sent_at)
+        return delivered
+
+    def fanout_latencies(self, sent):
+        # От отправки до доставки последнему получателю; sent: номер -> время отправки
+        delivered = self.deliveries()
+        latencies = [max(delivered[number]) - started for number, started in sent.items() if number in delivered]
+        return latencies, len(sent) - sum(1 for number in sent if number in delivered)
@@ -0,0 +1,279 @@
+# Прогоны против настоящих серверов: gunicorn с gunicorn.conf.py в отдельных процессах,
+# клиенты Socket.IO поверх WebSocket (протокол Engine.IO v4 вручную, на simple-websocket)
+import http.cookiejar
+import itertools
+import json
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import simple_websocket
+
+from bench.harness import BASE_ENV, BENCH_PASSWORD
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class LiveServer:
+    def __init__(self, db_path, log_path, app_module='app:app', **env):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.log_path = log_path
+        self.app_module = app_module
+        self.env = {**os.environ, **BASE_ENV,
+                    'DATABASE_URL': f'sqlite:///{os.path.abspath(db_path)}',
+                    'BIND': f'127.0.0.1:{self.port}',
+                    'WEB_CONCURRENCY': '1',
+                    **{key: str(value) for key, value in env.items()}}
+        self.process = None
+
+    def start(self, timeout=60):
+        log = open(self.log_path, 'ab')
+        self.process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', self.app_module],
+                                        cwd=ROOT, env=self.env, stdout=log, stderr=subprocess.STDOUT)
+        log.close()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Сервер завершился с кодом {self.process.returncode}, лог: {self.log_path}')
+            try:
+                urllib.request.urlopen(f'{self.url}/login', timeout=2).close()
+                return self
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f'Сервер не поднялся за {timeout} с, лог: {self.log_path}')
+
+    def worker_pids(self):
+        try:
+            with open(f'/proc/{self.process.pid}/task/{self.process.pid}/children') as children:
+                return [int(pid) for pid in children.read().split()]
+        except OSError:
+            return []
+
+    def resources(self):
+        # Память и потоки воркеров (Linux /proc)
+        rss_kb, threads = 0, 0
+        for pid in self.worker_pids():
+            try:
+                with open(f'/proc/{pid}/status') as status:
+                    for line in status:
+                        if line.startswith('VmRSS:'):
+                            rss_kb += int(line.split()[1])
+                        elif line.startswith('Threads:'):
+                            threads += int(line.split()[1])
+            except OSError:
+                pass
+        return {'rss_mb': round(rss_kb / 1024, 1), 'threads': threads}
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpSession:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies), NoRedirect)
+
+    def request(self, path, form=None, json_body=None):
+        data, headers = None, {}
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode()
+        elif json_body is not None:
+            data = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers)
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+    def login(self, username, password=BENCH_PASSWORD):
+        status, _ = self.request('/login', form={'username': username, 'password': password})
+        if status != 302:
+            raise RuntimeError(f'Вход {username} не удался: HTTP {status}')
+        return self
+
+    def cookie_header(self):
+        return '; '.join(f'{cookie.name}={cookie.value}' for cookie in self.cookies)
+
+    def for_server(self, base_url):
+        # Та же сессия (подписанная cookie) на другом воркере
+        session = HttpSession(base_url)
+        for cookie in self.cookies:
+            session.cookies.set_cookie(cookie)
+        return session
+
+
+class WebSocketClient(simple_websocket.Client):
+    # Пакет open может прийти одним чтением с ответом на рукопожатие, а simple-websocket разбирает
+    # такие данные только после следующего чтения сокета - разбираем их сразу, до запуска потока чтения
+    def handshake(self):
+        super().handshake()
+        self._handle_events()
+
+
+class LiveClient:
+    # Минимальный клиент Socket.IO: пространство имён '/', текстовые события и подтверждения
+    def __init__(self, base_url, cookie, timeout=10):
+        url = base_url.replace('http', 'ws', 1) + '/socket.io/?EIO=4&transport=websocket'
+        self.events = []  # (time, event, data)
+        self.binary_frames = 0
+        self._acks = {}
+        self._ack_ids = itertools.count(1)
+        self._ack_ready = threading.Condition()
+        self.ws = call_with_timeout(lambda: WebSocketClient(url, headers={'Cookie': cookie}), timeout)
+        opened = self.ws.receive(timeout)
+        if not opened or not opened.startswith('0'):
+            self.close()
+            raise ConnectionError(f'Нет пакета open: {opened!r}')
+        self.ws.send('40')
+        connected = self.ws.receive(timeout)
+        if not connected or not connected.startswith('40'):
+            self.close()
+            raise ConnectionError(f'Подключение отклонено: {connected!r}')
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        while True:
+            try:
+                data = self.ws.receive()
+            except simple_websocket.ConnectionClosed:
+                break
+            if data is None:
+                break
+            received_at = time.perf_counter()
+            if isinstance(data, bytes):
+                self.binary_frames += 1
+            elif data == '2':
+                self.ws.send('3')
+            elif data.startswith('42'):
+                event, *args = json.loads(data[2:])
+                self.events.append((received_at, event, args[0] if args else None))
+            elif data.startswith('43'):
+                ack_id, payload = split_ack(data[2:])
+                with self._ack_ready:
+                    self._acks[ack_id] = payload
+                    self._ack_ready.notify_all()
+
+    def emit(self, event, data, ack=False, timeout=10):
+        if not ack:
+            self.ws.send('42' + json.dumps([event, data]))
+            return None
+        ack_id = next(self._ack_ids)
+        self.ws.send(f'42{ack_id}' + json.dumps([event, data]))
+        with self._ack_ready:
+            if not self._ack_ready.wait_for(lambda: ack_id in self._acks, timeout):
+                raise TimeoutError(f'Нет подтверждения {event}')
+            payload = self._acks.pop(ack_id)
+        return payload[0] if payload else None
+
+    def join(self, room_id):
+        reply = self.emit('join', {'room_id': room_id}, ack=True)
+        if not reply or not reply.get('success'):
+            raise RuntimeError(f'Не удалось войти в комнату {room_id}: {reply}')
+
+    def received(self, event):
+        return [(received_at, data) for received_at, name, data in self.events if name == event]
+
+    def close(self):
+        try:
+            self.ws.close()
+        except simple_websocket.ConnectionClosed:
+            pass
+
+
+def split_ack(data):
+    digits = len(data) - len(data.lstrip('0123456789'))
+    return int(data[:digits]), json.loads(data[digits:])
+
+
+def call_with_timeout(func, timeout):
+    # simple-websocket ждёт рукопожатия без таймаута: занятый сервер не должен подвешивать прогон
+    result = {}
+
+    def target():
+        try:
+            result['value'] = func()
+        except Exception as error:
+            result['error'] = error
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError('Рукопожатие WebSocket не завершилось')
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+def bench_accounts(db_path, count):
+    with sqlite3.connect(db_path) as connection:
+        return connection.execute(
+            "SELECT id, username FROM user WHERE username LIKE 'bench_user_%' AND role = 'user' "
+            "ORDER BY id LIMIT ?", (count,)).fetchall()
+
+
+def default_room(db_path):
+    with sqlite3.connect(db_path) as connection:
+        return connection.execute('SELECT id FROM room ORDER BY id LIMIT 1').fetchone()[0]
+
+
+def connect_clients(base_urls, sessions, count, room_id, parallel=50, recorder=None):
+    # Клиенты раскладываются по серверам и сессиям по кругу; неудачные подключения считаются, а не прерывают прогон
+    clients, failures = [], []
+    lock = threading.Lock()
+    slots = iter(range(count))
+
+    def worker():
+        for index in slots:
+            base_url = base_urls[index % len(base_urls)]
+            session = sessions[index % len(sessions)]
+            started = time.perf_counter()
+            try:
+                client = LiveClient(base_url, session.cookie_header())
+                client.join(room_id)
+            except Exception as error:
+                with lock:
+                    failures.append(repr(error))
+                continue
+            if recorder:
+                recorder.record('connect', time.perf_counter() - started)
+            with lock:
+                clients.append(client)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(parallel, count))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clients, failures
@@ -0,0 +1,210 @@
+# Запуск сценариев и сравнение результатов. Каждый вариант внутрипроцессного сценария
+# выполняется в свежем интерпретаторе на своей копии наполненной базы, результаты
+# собираются в один JSON, который можно сравнить с прошлым прогоном
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from bench.harness import BASE_ENV, QueryCounter, Recorder
+from bench.scenarios import SCENARIOS, Context, ScenarioSkipped
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def resolve(specs):
+    # 'chat_write' - все варианты, 'chat_write:sync' - один
+    selected = []
+    for spec in specs or SCENARIOS:
+        name, _, variant = spec.partition(':')
+        if name not in SCENARIOS:
+            raise SystemExit(f'Неизвестный сценарий {name}, доступны: {", ".join(SCENARIOS)}')
+        variants = SCENARIOS[name]['variants']
+        if variant and variant not in variants:
+            raise SystemExit(f'У сценария {name} нет варианта {variant}, доступны: {", ".join(variants)}')
+        selected.extend((name, item) for item in ([variant] if variant else variants))
+    return selected
+
+
+def scenario_params(name, variant, overrides):
+    definition = SCENARIOS[name]
+    params = {**definition['defaults'], **definition['variants'][variant].get('params', {})}
+    params.update({key: value for key, value in overrides.items() if value is not None and key in params})
+    return params
+
+
+def missing_modules(name, variant):
+    return [module for module in SCENARIOS[name]['variants'][variant].get('requires', [])
+            if importlib.util.find_spec(module) is None]
+
+
+def copy_database(db_path, target):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            shutil.copyfile(db_path + suffix, target + suffix)
+    return target
+
+
+def database_stats(db_path):
+    with sqlite3.connect(db_path) as connection:
+        return {table: connection.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+                for table in ('user', 'room', 'message', 'product', 'order')}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_entry(name, variant, params, status, **fields):
+    return {'scenario': name, 'variant': variant, 'status': status, 'params': params,
+            'env': SCENARIOS[name]['variants'][variant].get('env', {}), **fields}
+
+
+def run_worker(name, variant, params, result_path):
+    # Вызывается в дочернем процессе: окружение варианта уже выставлено
+    import app as web
+
+    with web.app.app_context():
+        queries = QueryCounter(web.db.engine)
+    ctx = Context(web, params, Recorder(queries))
+    try:
+        SCENARIOS[name]['run'](ctx)
+        status, reason = 'ok', None
+    except ScenarioSkipped as skipped:
+        status, reason = 'skipped', str(skipped)
+    duration, operations = ctx.recorder.summary()
+    entry = result_entry(name, variant, params, status, duration_s=duration, operations=operations,
+                         checks=ctx.checks, extra=ctx.extra)
+    if reason:
+        entry['reason'] = reason
+    with open(result_path, 'w', encoding='utf-8') as result:
+        json.dump(entry, result, ensure_ascii=False)
+    # Фоновые потоки сокетов и пула хеширования не должны задерживать выход
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def run_in_subprocess(name, variant, params, db_path, workdir):
+    label = f'{name}-{variant}'
+    database = copy_database(db_path, os.path.join(workdir, f'{label}.db'))
+    result_path = os.path.join(workdir, f'{label}.json')
+    log_path = os.path.join(workdir, f'{label}.log')
+    env = {**os.environ, **BASE_ENV, **SCENARIOS[name]['variants'][variant].get('env', {}),
+           'DATABASE_URL': f'sqlite:///{database}'}
+    with open(log_path, 'wb') as log:
+        process = subprocess.run([sys.executable, '-m', 'bench', 'worker', name, variant,
+                                  '--params', json.dumps(params), '--result', result_path],
+                                 cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    if process.returncode != 0 or not os.path.exists(result_path):
+        with open(log_path, encoding='utf-8', errors='replace') as log:
+            tail = log.read()[-2000:]
+        return result_entry(name, variant, params, 'failed', reason=f'код выхода {process.returncode}',
+                            log_tail=tail)
+    with open(result_path, encoding='utf-8') as result:
+        return json.load(result)
+
+
+def run_external(name, variant, params, db_path, workdir):
+    # Сценарии с живыми серверами: база копируется, серверы и клиенты запускает сам сценарий
+    label = f'{name}-{variant}'
+    files = {'db': copy_database(db_path, os.path.join(workdir, f'{label}.db')),
+             'log': os.path.join(workdir, f'{label}.log')}
+    ctx = Context(None, {**params, **files}, Recorder(), SCENARIOS[name]['variants'][variant].get('env', {}))
+    try:
+        SCENARIOS[name]['run'](ctx)
+    except ScenarioSkipped as skipped:
+        return result_entry(name, variant, params, 'skipped', reason=str(skipped))
+    except Exception as error:
+        return result_entry(name, variant, params, 'failed', reason=repr(error))
+    duration, operations = ctx.recorder.summary()
+    return result_entry(name, variant, params, 'ok', duration_s=duration, operations=operations,
+                        checks=ctx.checks, extra=ctx.extra)
+
+
+def run(specs, db_path, overrides, out_path, keep_workdir=False):
+    if not os.path.exists(db_path):
+        raise SystemExit(f'Нет базы {db_path}: сначала python -m bench seed --db {db_path}')
+    db_path = os.path.abspath(db_path)
+    report = {
+        'meta': {
+            'started_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'database': database_stats(db_path),
+        },
+        'results': [],
+    }
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        for name, variant in resolve(specs):
+            params = scenario_params(name, variant, overrides)
+            missing = missing_modules(name, variant)
+            print(f'{name}:{variant} ...', end=' ', flush=True)
+            started = time.perf_counter()
+            if missing:
+                entry = result_entry(name, variant, params, 'skipped',
+                                     reason=f'не установлены модули: {", ".join(missing)}')
+            elif SCENARIOS[name]['external']:
+                entry = run_external(name, variant, params, db_path, workdir)
+            else:
+                entry = run_in_subprocess(name, variant, params, db_path, workdir)
+            print(f"{entry['status']} за {time.perf_counter() - started:.1f} с"
+                  + (f" ({entry['reason']})" if entry.get('reason') else ''))
+            report['results'].append(entry)
+            # Промежуточный результат сохраняется после каждого варианта
+            with open(out_path, 'w', encoding='utf-8') as out:
+                json.dump(report, out, ensure_ascii=False, indent=2)
+    finally:
+        if keep_workdir:
+            print(f'Базы и логи прогонов: {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def compare(base_path, new_path):
+    # Пропускная способность, p50/p99 и запросы на операцию для совпадающих сценариев, вариантов и операций
+    with open(base_path, encoding='utf-8') as base_file, open(new_path, encoding='utf-8') as new_file:
+        base, new = json.load(base_file), json.load(new_file)
+    base_results = {(entry['scenario'], entry['variant']): entry for entry in base['results']}
+
+    def change(old, current):
+        if not old:
+            return '-'
+        return f'{(current - old) / old * 100:+.1f}%'
+
+    header = f"{'сценарий:вариант / операция':<46} {'ops/s':>10} {'Δ':>8} {'p50 мс':>9} {'Δ':>8} " \
+             f"{'p99 мс':>9} {'Δ':>8} {'запр.':>6} {'ошибки':>7}"
+    print(header)
+    print('-' * len(header))
+    for entry in new['results']:
+        key = (entry['scenario'], entry['variant'])
+        old_entry = base_results.get(key, {})
+        if entry['status'] != 'ok':
+            print(f"{':'.join(key):<46} {entry['status']}")
+            continue
+        for op, stats in entry['operations'].items():
+            old = old_entry.get('operations', {}).get(op)
+            latency = stats['latency_ms']
+            queries = stats.get('queries_per_op', {}).get('mean', '')
+            print(f"{':'.join(key) + ' / ' + op:<46} {stats['throughput_per_s']:>10.1f} "
+                  f"{change(old and old['throughput_per_s'], stats['throughput_per_s']):>8} "
+                  f"{latency['p50']:>9.2f} {change(old and old['latency_ms']['p50'], latency['p50']):>8} "
+                  f"{latency['p99']:>9.2f} {change(old and old['latency_ms']['p99'], latency['p99']):>8} "
+                  f"{queries:>6} {stats['errors']:>7}")
+        failed_checks = [check for check, value in entry.get('checks', {}).items() if value not in (True, 0)]
+        if failed_checks:
+            print(f"{'':<4}не пройдены проверки: {', '.join(failed_checks)}")
@@ -0,0 +1,671 @@
+# Сценарии нагрузки. Внутрипроцессные сценарии выполняются в отдельном процессе на вариант:
+# конфигурация приложения читается из окружения при импорте app. Сценарии с живыми серверами
+# (external) запускаются из основного процесса и сами поднимают gunicorn
+import importlib.util
+import itertools
+import os
+import random
+import threading
+import time
+
+from sqlalchemy import delete, func, select, text
+
+from bench.harness import DeliveryLog, VirtualUser, login_with_password, run_threads
+
+SCENARIOS = {}
+
+
+class ScenarioSkipped(Exception):
+    pass
+
+
+def scenario(name, description, variants=None, defaults=None, external=False):
+    # variants: имя -> {'env': {...}, 'params': {...}, 'requires': [модули]}
+    def decorator(func):
+        SCENARIOS[name] = {
+            'run': func,
+            'description': description,
+            'variants': variants or {'default': {}},
+            'defaults': defaults or {},
+            'external': external,
+        }
+        return func
+    return decorator
+
+
+class Context:
+    def __init__(self, web, params, recorder, env=None):
+        self.web = web
+        self.params = params
+        self.recorder = recorder
+        self.env = env or {}
+        self.extra = {}
+        self.checks = {}
+
+    def bench_users(self, count, role='user'):
+        # Пользователи из наполнения; если их меньше, чем нужно, сессии повторяются
+        web = self.web
+        with web.app.app_context():
+            users = web.db.session.execute(
+                select(web.User.id, web.User.username)
+                .where(web.User.username.like('bench_user_%'), web.User.role == role)
+                .order_by(web.User.id).limit(count)).all()
+        if not users:
+            raise RuntimeError('База не наполнена: запустите python -m bench seed')
+        return [users[index % len(users)] for index in range(count)]
+
+    def room_ids(self, count=None):
+        web = self.web
+        with web.app.app_context():
+            room_ids = web.db.session.scalars(select(web.Room.id).order_by(web.Room.id)).all()
+            while count and len(room_ids) < count:
+                room = web.Room(slug=f'bench-{len(room_ids):04d}', name=f'Нагрузочная {len(room_ids)}')
+                web.db.session.add(room)
+                web.db.session.commit()
+                room_ids.append(room.id)
+        return room_ids[:count] if count else room_ids
+
+    def product_ids(self):
+        web = self.web
+        with web.app.app_context():
+            return web.db.session.scalars(select(web.Product.id).where(web.Product.stock > 0)).all()
+
+    def flush(self):
+        # Отложенная запись сообщений и буферы присутствия - до проверок по базе
+        self.web.flush_background_work()
+
+
+def numbered_text(number):
+    return f'нагрузочное сообщение {DeliveryLog.token(number)}'
+
+
+def deadline_loop(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        yield
+
+
+def connect_users(ctx, user_rows, room_ids, parallel=16):
+    # Подключение и вход в комнаты до начала замера; пользователь index попадает в комнату index % len(room_ids)
+    users = [None] * len(user_rows)
+
+    def worker(index):
+        for position in range(index, len(user_rows), parallel):
+            user = VirtualUser(ctx.web, user_rows[position][0])
+            user.join(room_ids[position % len(room_ids)])
+            user.drain()
+            users[position] = user
+
+    run_threads(min(parallel, len(user_rows)), worker)
+    return users
+
+
+def send_paced(ctx, senders, total, room_for, interval, sent, numbers):
+    # Отправители по очереди берут номера сообщений; interval - пауза между отправками одного отправителя
+    def worker(index):
+        sender = senders[index]
+        for number in numbers:
+            if number > total:
+                return
+            room_id = room_for(number)
+            with ctx.recorder.timed('send'):
+                sent[number] = time.perf_counter()
+                sender.send(room_id, numbered_text(number))
+            if interval:
+                time.sleep(interval)
+
+    run_threads(len(senders), worker)
+
+
+def wait_batches(ctx):
+    # Склеенные события уходят по таймеру: ждём несколько окон
+    window = ctx.web.app.config['SOCKETIO_BATCH_WINDOW_MS']
+    if window:
+        time.sleep(window * 3 / 1000 + 0.05)
+
+
+def record_fanout(ctx, log, sent, op='broadcast'):
+    latencies, lost = log.fanout_latencies(sent)
+    for latency in latencies:
+        ctx.recorder.record(op, latency)
+    ctx.checks[f'{op}_lost_messages'] = lost
+    frames, size = log.totals()
+    ctx.extra.update({'frames': frames, 'bytes': size,
+                      'frames_per_message': round(frames / max(len(sent), 1), 2),
+                      'bytes_per_message': round(size / max(len(sent), 1), 1)})
+
+
+@scenario('mixed', 'Смешанная нагрузка: вход, чат, каталог, корзина и оформление заказа одновременно',
+          defaults={'concurrency': 16, 'duration': 20})
+def mixed(ctx):
+    web = ctx.web
+    params = ctx.params
+    rows = ctx.bench_users(params['concurrency'])
+    room_ids = ctx.room_ids()[:4]
+    product_ids = ctx.product_ids()
+    users = [None] * len(rows)
+
+    def login(index):
+        user_id, username = rows[index]
+        client = web.app.test_client()
+        with ctx.recorder.timed('login') as outcome:
+            if not login_with_password(client, username):
+                outcome['failed'] = 'вход не удался'
+        user = VirtualUser(web, user_id, http=client)
+        user.join(room_ids[index % len(room_ids)])
+        users[index] = user
+
+    run_threads(len(rows), login)
+
+    numbers = itertools.count(1)
+    sent = {}
+    outcomes = {'checkout_ok': 0, 'checkout_rejected': 0}
+    lock = threading.Lock()
+    actions = [('shop', 20), ('catalog_api', 15), ('cart', 15), ('chat_page', 5), ('chat_history', 10),
+               ('chat_send', 20), ('cart_add', 10), ('checkout', 3), ('orders', 2)]
+    names, weights = zip(*actions)
+
+    def expect(outcome, response, *statuses):
+        if response.status_code not in statuses:
+            outcome['failed'] = f'HTTP {response.status_code}'
+
+    def worker(index):
+        rng = random.Random(index)
+        user = users[index]
+        room_id = room_ids[index % len(room_ids)]
+        cart_filled = False
+        for _ in deadline_loop(params['duration']):
+            action = rng.choices(names, weights=weights)[0]
+            if action == 'checkout' and not cart_filled:
+                action = 'cart_add'
+            with ctx.recorder.timed(action) as outcome:
+                if action == 'shop':
+                    expect(outcome, user.http.get('/shop'), 200)
+                elif action == 'catalog_api':
+                    expect(outcome, user.http.get(f'/shop/api/products?page={rng.randint(1, 5)}'), 200)
+                elif action == 'cart':
+                    expect(outcome, user.http.get('/cart'), 200)
+                elif action == 'chat_page':
+                    expect(outcome, user.http.get('/chat'), 200)
+                elif action == 'chat_history':
+                    expect(outcome, user.http.get(f'/chat/history?room_id={room_id}'), 200)
+                elif action == 'chat_send':
+                    number = next(numbers)
+                    sent[number] = time.perf_counter()
+                    user.send(room_id, numbered_text(number))
+                elif action == 'cart_add':
+                    response = user.http.post(f'/cart/add/{rng.choice(product_ids)}', json={'quantity': 1})
+                    expect(outcome, response, 200, 400)
+                    cart_filled = cart_filled or response.status_code == 200
+                elif action == 'checkout':
+                    response = user.http.post('/checkout', data={'address': 'Нагрузочный адрес',
+                                                                  'contact': 'bench@example.com'})
+                    expect(outcome, response, 302)
+                    with lock:
+                        outcomes['checkout_ok' if response.headers.get('Location', '').endswith('/orders')
+                                 else 'checkout_rejected'] += 1
+                    cart_filled = False
+                elif action == 'orders':
+                    expect(outcome, user.http.get('/orders'), 200)
+
+    with DeliveryLog(web.socketio.server) as log:
+        ctx.recorder.started = time.perf_counter()
+        run_threads(len(users), worker)
+        ctx.recorder.stop()
+    record_fanout(ctx, log, sent, 'chat_delivery')
+    ctx.extra.update(outcomes)
+
+
+@scenario('chat_write', 'Запись сообщений чата: синхронно, отложенная запись, групповой коммит',
+          variants={
+              'sync': {'env': {'CHAT_WRITE_BEHIND': '0'}},
+              'write_behind': {'env': {'CHAT_WRITE_BEHIND': '1', 'CHAT_WRITE_DURABILITY': 'async'}},
+              'group_commit': {'env': {'CHAT_WRITE_BEHIND': '1', 'CHAT_WRITE_DURABILITY': 'group_commit'}},
+          },
+          defaults={'concurrency': 8, 'messages': 2000, 'listeners': 20})
+def chat_write(ctx):
+    web = ctx.web
+    params = ctx.params
+    room_id = ctx.room_ids()[0]
+    senders = connect_users(ctx, ctx.bench_users(params['concurrency']), [room_id])
+    connect_users(ctx, ctx.bench_users(params['listeners']), [room_id])
+
+    sent = {}
+    with DeliveryLog(web.socketio.server) as log:
+        ctx.recorder.started = time.perf_counter()
+        send_paced(ctx, senders, params['messages'], lambda number: room_id, 0, sent, itertools.count(1))
+        ctx.recorder.stop()
+        ctx.flush()
+    record_fanout(ctx, log, sent)
+    ctx.extra['messages_per_s'] = round(len(sent) / (ctx.recorder.finished - ctx.recorder.started), 1)
+
+    with web.app.app_context():
+        stored = web.db.session.scalar(select(func.count(web.Message.id))
+                                       .where(web.Message.text.like('нагрузочное сообщение #B%')))
+    ctx.checks['all_persisted'] = stored == len(sent)
+
+
+@scenario('sqlite_concurrency', 'Параллельные читатели (/shop, /chat) и писатели (сообщения, заказы) на SQLite',
+          variants={
+              'tuned': {'env': {}},
+              'baseline': {'env': {'SQLITE_JOURNAL_MODE': 'DELETE', 'SQLITE_SYNCHRONOUS': 'FULL',
+                                   'SQLITE_BUSY_TIMEOUT': '0', 'SQLITE_MMAP_SIZE': '0',
+                                   'SQLITE_CACHE_SIZE': '-2000'}},
+          },
+          defaults={'readers': 8, 'writers': 4, 'duration': 15})
+def sqlite_concurrency(ctx):
+    web = ctx.web
+    params = ctx.params
+    room_id = ctx.room_ids()[0]
+    product_ids = ctx.product_ids()
+    readers = [VirtualUser(web, user_id, socket=False) for user_id, _ in ctx.bench_users(params['readers'])]
+    writers = connect_users(ctx, ctx.bench_users(params['readers'] + params['writers'])[params['readers']:],
+                            [room_id])
+    numbers = itertools.count(1)
+    rejected = []
+
+    def read(index):
+        user = readers[index]
+        for step, _ in enumerate(deadline_loop(params['duration'])):
+            path = '/shop' if step % 2 else '/chat'
+            with ctx.recorder.timed('read_shop' if step % 2 else 'read_chat') as outcome:
+                response = user.http.get(path)
+                if response.status_code != 200:
+                    outcome['failed'] = f'HTTP {response.status_code}'
+
+    def write(index):
+        rng = random.Random(index)
+        user = writers[index]
+        for step, _ in enumerate(deadline_loop(params['duration'])):
+            if step % 2 == 0:
+                with ctx.recorder.timed('write_message'):
+                    user.send(room_id, numbered_text(next(numbers)))
+                continue
+            with ctx.recorder.timed('write_checkout') as outcome:
+                response = user.http.post(f'/cart/add/{rng.choice(product_ids)}', json={'quantity': 1})
+                if response.status_code != 200:
+                    outcome['failed'] = f'HTTP {response.status_code} при добавлении в корзину'
+                    continue
+                response = user.http.post('/checkout', data={'address': 'Нагрузочный адрес',
+                                                              'contact': 'bench@example.com'})
+                location = response.headers.get('Location', '')
+                if response.status_code != 302 or not location.endswith(('/orders', '/cart')):
+                    outcome['failed'] = f'HTTP {response.status_code}'
+                elif location.endswith('/cart'):
+                    rejected.append(1)
+
+    def worker(index):
+        if index < len(readers):
+            read(index)
+        else:
+            write(index - len(readers))
+
+    web.app.logger.disabled = True  # "database is locked" считаются ошибками, а не пишутся трассировками
+    with DeliveryLog(web.socketio.server):
+        ctx.recorder.started = time.perf_counter()
+        run_threads(len(readers) + len(writers), worker)
+        ctx.recorder.stop()
+    with web.app.app_context():
+        ctx.extra['journal_mode'] = web.db.session.execute(text('PRAGMA journal_mode')).scalar()
+    ctx.extra['checkout_rejected'] = len(rejected)
+
+
+@scenario('checkout_contention', 'Одновременное оформление заказов на товар с ограниченным остатком',
+          variants={'limited': {'params': {'stock': 10}}, 'plenty': {'params': {'stock': 1000000}}},
+          defaults={'buyers': 50, 'rounds': 5})
+def checkout_contention(ctx):
+    web = ctx.web
+    params = ctx.params
+    buyers = [VirtualUser(web, user_id, socket=False) for user_id, _ in ctx.bench_users(params['buyers'])]
+    buyer_ids = [buyer.user_id for buyer in buyers]
+    oversold, mismatched, placed, phase = 0, 0, 0, 0.0
+
+    for round_number in range(params['rounds']):
+        with web.app.app_context():
+            web.db.session.execute(delete(web.CartItem).where(web.CartItem.user_id.in_(buyer_ids)))
+            product = web.Product(name=f'Дефицитный товар {os.getpid()}-{round_number}', price=100,
+                                  stock=params['stock'])
+            web.db.session.add(product)
+            web.db.session.commit()
+            product_id, product_name = product.id, product.name
+        for buyer_id in buyer_ids:
+            web.cart_summaries.invalidate(buyer_id)
+        for buyer in buyers:
+            buyer.http.post(f'/cart/add/{product_id}', json={'quantity': 1})
+
+        results = []
+
+        def checkout(index):
+            with ctx.recorder.timed('checkout') as outcome:
+                response = buyers[index].http.post('/checkout', data={'address': 'Нагрузочный адрес',
+                                                                       'contact': 'bench@example.com'})
+                if response.status_code != 302:
+                    outcome['failed'] = f'HTTP {response.status_code}'
+                results.append(response.headers.get('Location', '').endswith('/orders'))
+
+        started = time.perf_counter()
+        run_threads(len(buyers), checkout)
+        phase += time.perf_counter() - started
+
+        with web.app.app_context():
+            stock = web.db.session.get(web.Product, product_id).stock
+            ordered = web.db.session.scalar(select(func.coalesce(func.sum(web.OrderItem.quantity), 0))
+                                            .where(web.OrderItem.product_name == product_name))
+        succeeded = sum(results)
+        placed += succeeded
+        oversold += stock < 0 or ordered > params['stock']
+        mismatched += stock != params['stock'] - ordered or ordered != succeeded \
+            or succeeded != min(len(buyers), params['stock'])
+
+    ctx.extra.update({'orders_placed': placed, 'orders_per_s': round(placed / phase, 1) if phase else 0.0})
+    ctx.checks.update({'no_oversell': oversold == 0, 'stock_consistent': mismatched == 0})
+
+
+@scenario('login_storm', 'Задержка рассылки чата во время волны входов (scrypt в пуле потоков)',
+          variants={'quiet': {'params': {'storm': 0}}, 'storm': {'params': {'storm': 8}}},
+          defaults={'duration': 15, 'listeners': 20, 'interval': 0.02})
+def login_storm(ctx):
+    web = ctx.web
+    params = ctx.params
+    room_id = ctx.room_ids()[0]
+    senders = connect_users(ctx, ctx.bench_users(2), [room_id])
+    connect_users(ctx, ctx.bench_users(params['listeners']), [room_id])
+    storm_rows = ctx.bench_users(max(params['storm'], 1))
+    numbers = itertools.count(1)
+    sent = {}
+
+    def worker(index):
+        if index < len(senders):
+            for _ in deadline_loop(params['duration']):
+                number = next(numbers)
+                with ctx.recorder.timed('send'):
+                    sent[number] = time.perf_counter()
+                    senders[index].send(room_id, numbered_text(number))
+                time.sleep(params['interval'])
+            return
+        username = storm_rows[index - len(senders)][1]
+        for _ in deadline_loop(params['duration']):
+            with ctx.recorder.timed('login') as outcome:
+                if not login_with_password(web.app.test_client(), username):
+                    outcome['failed'] = 'вход не удался'
+
+    with DeliveryLog(web.socketio.server) as log:
+        ctx.recorder.started = time.perf_counter()
+        run_threads(len(senders) + params['storm'], worker)
+        ctx.recorder.stop()
+    record_fanout(ctx, log, sent)
+
+
+SEARCH_QUERIES = {
+    'search_common': 'привет',
+    'search_two_words': 'сервер работает',
+    'search_rare': 'квазар',
+    'search_prefix': 'обновл',
+    'search_yo': 'ёлка',
+}
+
+
+@scenario('search', 'Полнотекстовый поиск и история чата на наполненной базе',
+          defaults={'concurrency': 4, 'duration': 15})
+def search(ctx):
+    web = ctx.web
+    params = ctx.params
+    if not web.search_enabled:
+        raise ScenarioSkipped('поиск недоступен: не SQLite или SQLite без FTS5')
+    room_id = ctx.room_ids()[0]
+    users = [VirtualUser(web, user_id, socket=False) for user_id, _ in ctx.bench_users(params['concurrency'])]
+    queries = [(op, '/chat/search', {'room_id': room_id, 'q': query}) for op, query in SEARCH_QUERIES.items()]
+    queries += [('search_page3', '/chat/search', {'room_id': room_id, 'q': 'привет', 'page': 3}),
+                ('history', '/chat/history', {'room_id': room_id})]
+
+    def worker(index):
+        user = users[index]
+        for step, _ in enumerate(deadline_loop(params['duration'])):
+            op, path, query = queries[(index + step) % len(queries)]
+            with ctx.recorder.timed(op) as outcome:
+                response = user.http.get(path, query_string=query)
+                if response.status_code != 200:
+                    outcome['failed'] = f'HTTP {response.status_code}'
+
+    ctx.recorder.started = time.perf_counter()
+    run_threads(len(users), worker)
+    ctx.recorder.stop()
+    with web.app.app_context():
+        ctx.extra['messages_total'] = web.db.session.scalar(select(func.count(web.Message.id)))
+        ctx.extra['messages_in_room'] = web.db.session.scalar(
+            select(func.count(web.Message.id)).where(web.Message.room_id == room_id))
+
+
+@scenario('fanout', 'Рассылка в комнату на множество клиентов: кадры и байты, склейка и msgpack',
+          variants={
+              'plain': {'env': {}},
+              'batched': {'env': {'SOCKETIO_BATCH_WINDOW_MS': '20'}},
+              'batched_compact': {'env': {'SOCKETIO_BATCH_WINDOW_MS': '20', 'SOCKETIO_COMPACT_PAYLOADS': '1'},
+                                  'requires': ['msgpack']},
+          },
+          defaults={'clients': 1000, 'concurrency': 10, 'messages': 500, 'interval': 0.01, 'churn': 0.05})
+def fanout(ctx):
+    web = ctx.web
+    params = ctx.params
+    room_id = ctx.room_ids()[0]
+    rows = ctx.bench_users(params['clients'])
+    with DeliveryLog(web.socketio.server):
+        # Уведомления о входе n клиентов - это n^2 кадров, в замер они не входят
+        users = connect_users(ctx, rows, [room_id])
+    senders = users[:params['concurrency']]
+    churners = users[params['concurrency']:]
+    sent = {}
+    sending = threading.Event()
+
+    def churn():
+        # Переподключения слушателей: вход и выход в пределах окна склейки гасят друг друга
+        rng = random.Random(0)
+        while not sending.is_set() and churners:
+            user = rng.choice(churners)
+            user.socket.emit('leave', {'room_id': room_id})
+            user.join(room_id)
+            time.sleep(params['churn'])
+
+    with DeliveryLog(web.socketio.server) as log:
+        churn_thread = threading.Thread(target=churn, daemon=True)
+        ctx.recorder.started = time.perf_counter()
+        if params['churn']:
+            churn_thread.start()
+        send_paced(ctx, senders, params['messages'], lambda number: room_id, params['interval'], sent,
+                   itertools.count(1))
+        sending.set()
+        if churn_thread.is_alive():
+            churn_thread.join()
+        wait_batches(ctx)
+        ctx.recorder.stop()
+    record_fanout(ctx, log, sent)
+
+    elapsed = log.frames[-1][0] - ctx.recorder.started if log.frames else 0
+    ctx.extra.update({'clients': len(users),
+                      'frames_per_s': round(ctx.extra['frames'] / elapsed, 1) if elapsed else 0.0,
+                      'bytes_per_s': round(ctx.extra['bytes'] / elapsed, 1) if elapsed else 0.0})
+
+
+@scenario('room_fanout', 'Стоимость рассылки в зависимости от размера комнаты при том же числе онлайн',
+          variants={'one_room': {'params': {'rooms': 1}}, 'ten_rooms': {'params': {'rooms': 10}},
+                    'hundred_rooms': {'params': {'rooms': 100}}},
+          defaults={'clients': 1000, 'concurrency': 10, 'messages': 500})
+def room_fanout(ctx):
+    web = ctx.web
+    params = ctx.params
+    room_ids = ctx.room_ids(params['rooms'])
+    users = connect_users(ctx, ctx.bench_users(params['clients']), room_ids)
+    # Отправитель index сидит в комнате index % rooms и пишет только туда
+    senders = users[:params['concurrency']]
+    sent = {}
+    numbers = iter(range(1, params['messages'] + 1))
+    with DeliveryLog(web.socketio.server) as log:
+        ctx.recorder.started = time.perf_counter()
+        run_threads(len(senders), lambda index: send_own_room(ctx, senders[index], numbers, index, room_ids, sent))
+        wait_batches(ctx)
+        ctx.recorder.stop()
+    record_fanout(ctx, log, sent)
+    ctx.extra.update({'clients': len(users), 'rooms': len(room_ids),
+                      'room_size': round(len(users) / len(room_ids), 1)})
+
+
+def send_own_room(ctx, sender, numbers, index, room_ids, sent):
+    room_id = room_ids[index % len(room_ids)]
+    for number in numbers:
+        with ctx.recorder.timed('send'):
+            sent[number] = time.perf_counter()
+            sender.send(room_id, numbered_text(number))
+
+
+# Сценарии с живыми серверами gunicorn (см. bench/live.py)
+QUEUE_CLIENT_MODULES = {'redis': 'redis', 'rediss': 'redis', 'amqp': 'kombu', 'kafka': 'kafka', 'zmq': 'zmq'}
+
+
+def wait_until(condition, timeout, step=0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(step)
+    return condition()
+
+
+def message_number(payload):
+    match = DeliveryLog.token_re.search(payload.get('text', ''))
+    return int(match.group(1)) if match else None
+
+
+def record_live_fanout(ctx, clients, sent, op='broadcast'):
+    # От отправки до получения последним клиентом; потерянные - номера, не дошедшие хоть до одного
+    received = [{message_number(data): received_at for received_at, data in client.received('new_message')}
+                for client in clients]
+    lost = 0
+    for number, started in sent.items():
+        times = [deliveries.get(number) for deliveries in received]
+        if None in times:
+            lost += 1
+        else:
+            ctx.recorder.record(op, max(times) - started)
+    ctx.checks[f'{op}_lost_messages'] = lost
+    return received
+
+
+@scenario('queue_fanout', 'Несколько воркеров через очередь сообщений: каждый клиент получает каждое событие',
+          defaults={'workers': 4, 'clients': 40, 'messages': 50, 'queue_url': None}, external=True)
+def queue_fanout(ctx):
+    from bench.broker import QueueBroker
+    from bench.live import HttpSession, LiveClient, LiveServer, bench_accounts, connect_clients, default_room
+
+    params = ctx.params
+    queue_url = params['queue_url']
+    broker, app_module = None, 'app:app'
+    if queue_url:
+        module = QUEUE_CLIENT_MODULES.get(queue_url.split(':', 1)[0])
+        if module and importlib.util.find_spec(module) is None:
+            raise ScenarioSkipped(f'не установлен клиент очереди {module}')
+        queue_env = {'SOCKETIO_MESSAGE_QUEUE': queue_url}
+    else:
+        # Без --queue-url воркеры общаются через локальную заглушку брокера
+        broker = QueueBroker().start()
+        queue_env = {'SOCKETIO_MESSAGE_QUEUE': broker.url}
+        app_module = 'bench.broker_app:app'
+    ctx.extra['queue'] = queue_url or 'bench.broker'
+
+    room_id = default_room(params['db'])
+    accounts = bench_accounts(params['db'], min(params['clients'], 20))
+    servers = [LiveServer(params['db'], params['log'], app_module, **queue_env) for _ in range(params['workers'])]
+    clients = []
+    try:
+        for server in servers:
+            server.start()
+        sessions = [HttpSession(servers[0].url).login(username) for _, username in accounts]
+        clients, failures = connect_clients([server.url for server in servers], sessions, params['clients'],
+                                            room_id, recorder=ctx.recorder)
+        ctx.extra.update({'workers': len(servers), 'clients': len(clients), 'connect_failures': len(failures)})
+
+        # Модератор пишет через последний воркер, удаляет и мутит через другие
+        moderator = HttpSession(servers[0].url).login('Resolving', 'admin123')
+        sender = LiveClient(servers[-1].url, moderator.cookie_header())
+        sender.join(room_id)
+        sent = {}
+        for number in range(1, params['messages'] + 1):
+            sent[number] = time.perf_counter()
+            sender.emit('send_message', {'room_id': room_id, 'message': numbered_text(number)})
+            time.sleep(0.01)
+        wait_until(lambda: len(sender.received('new_message')) >= len(sent), 10)
+
+        own = {message_number(data): data['id'] for _, data in sender.received('new_message')}
+        deleted_ids = [own[number] for number in sorted(own)[:5]]
+        for message_id in deleted_ids:
+            sender.emit('delete_message', {'room_id': room_id, 'message_id': message_id})
+        muted_user_id = accounts[-1][0]
+        status, _ = moderator.for_server(servers[1 % len(servers)].url).request(
+            '/mute_user', json_body={'user_id': muted_user_id, 'room_id': room_id, 'duration': '10m'})
+        ctx.checks['mute_accepted'] = status == 200
+
+        def complete(client):
+            return len(client.received('new_message')) >= len(sent) \
+                and len(client.received('message_deleted')) >= len(deleted_ids) \
+                and client.received('user_muted')
+
+        wait_until(lambda: all(complete(client) for client in clients), 15)
+        record_live_fanout(ctx, clients, sent)
+        missing = {'new_message': 0, 'message_deleted': 0, 'user_muted': 0}
+        for client in clients:
+            missing['new_message'] += len(sent) - len({message_number(data)
+                                                       for _, data in client.received('new_message')} & set(sent))
+            missing['message_deleted'] += len(set(deleted_ids) - {data['message_id']
+                                                                  for _, data in client.received('message_deleted')})
+            missing['user_muted'] += not client.received('user_muted')
+        ctx.extra['missing_events'] = missing
+        ctx.checks['every_client_saw_every_event'] = not any(missing.values()) and not failures
+    finally:
+        for client in clients:
+            client.close()
+        for server in servers:
+            server.stop()
+        if broker:
+            ctx.extra['queue_frames'] = broker.frames
+            broker.stop()
+
+
+@scenario('socket_capacity', 'Одновременные WebSocket-соединения и рассылка в режимах threading, eventlet, gevent',
+          variants={
+              'threading': {'env': {'SOCKETIO_ASYNC_MODE': 'threading'}},
+              'eventlet': {'env': {'SOCKETIO_ASYNC_MODE': 'eventlet'}, 'requires': ['eventlet']},
+              'gevent': {'env': {'SOCKETIO_ASYNC_MODE': 'gevent'}, 'requires': ['gevent', 'geventwebsocket']},
+          },
+          defaults={'clients': 1000, 'messages': 20}, external=True)
+def socket_capacity(ctx):
+    from bench.live import HttpSession, LiveServer, bench_accounts, connect_clients, default_room
+
+    params = ctx.params
+    room_id = default_room(params['db'])
+    server = LiveServer(params['db'], params['log'], **ctx.env)
+    clients = []
+    try:
+        server.start()
+        idle = server.resources()
+        sessions = [HttpSession(server.url).login(username)
+                    for _, username in bench_accounts(params['db'], min(params['clients'], 20))]
+        clients, failures = connect_clients([server.url], sessions, params['clients'], room_id,
+                                            recorder=ctx.recorder)
+        connected = server.resources()
+        ctx.extra.update({'requested': params['clients'], 'connected': len(clients),
+                          'connect_failures': len(failures), 'failure_sample': failures[:3],
+                          'server_idle': idle, 'server_connected': connected})
+        if not clients:
+            raise RuntimeError(f'Ни одного соединения, лог сервера: {params["log"]}')
+
+        sent = {}
+        for number in range(1, params['messages'] + 1):
+            sent[number] = time.perf_counter()
+            clients[0].emit('send_message', {'room_id': room_id, 'message': numbered_text(number)})
+            time.sleep(0.05)
+        wait_until(lambda: all(len(client.received('new_message')) >= len(sent) for client in clients), 15)
+        record_live_fanout(ctx, clients, sent)
+        ctx.checks['all_requested_connected'] = len(clients) == params['clients']
+    finally:
+        for client in clients:
+            client.close()
+        server.stop()
@@ -0,0 +1,132 @@
+# Наполнение базы для нагрузочных прогонов: пользователи, комнаты, сообщения, товары и заказы.
+# Вставка пачками через executemany; DATABASE_URL выставляется до импорта приложения
+import random
+from datetime import datetime, timedelta
+
+from bench.harness import BENCH_PASSWORD
+
+# Словарь сообщений: частые слова встречаются по закону Ципфа, редкие - для выборочного поиска
+COMMON_WORDS = [
+    'привет', 'как', 'дела', 'что', 'это', 'да', 'нет', 'ну', 'вот', 'там', 'сегодня', 'завтра',
+    'вечером', 'кто', 'будет', 'играть', 'сервер', 'заказ', 'товар', 'доставка', 'спасибо',
+    'помогите', 'вопрос', 'ответ', 'чат', 'модератор', 'правила', 'новости', 'обновление',
+    'работает', 'сломалось', 'ошибка', 'время', 'деньги', 'цена', 'скидка', 'магазин', 'корзина',
+    'друзья', 'команда', 'ёлка', 'ещё', 'всё', 'hello', 'ok', 'lol', 'gg', 'thanks', 'update', 'server',
+]
+RARE_WORDS = ['квазар', 'эпифания', 'фрактал', 'полиглот', 'гиперкуб', 'zeppelin', 'quokka', 'nebula']
+
+PRODUCT_WORDS = ['Футболка', 'Кружка', 'Стикерпак', 'Худи', 'Кепка', 'Значок', 'Блокнот', 'Коврик']
+ORDER_STATUSES = [('completed', 50), ('shipped', 15), ('paid', 15), ('pending', 15), ('cancelled', 5)]
+
+
+def random_text(rng, weights):
+    words = rng.choices(COMMON_WORDS, weights=weights, k=rng.randint(2, 14))
+    if rng.random() < 0.01:
+        words.insert(rng.randrange(len(words)), rng.choice(RARE_WORDS))
+    return ' '.join(words)
+
+
+def spread_timestamps(rng, count, days):
+    # Равномерно по периоду с небольшим разбросом: id и время растут вместе, как в живом чате
+    start = datetime.utcnow() - timedelta(days=days)
+    step = days * 86400 / max(count, 1)
+    for index in range(count):
+        yield start + timedelta(seconds=index * step + rng.random() * step)
+
+
+def seed(users=1000, rooms=20, messages=100000, products=200, orders=5000, days=30, batch=10000, rng_seed=42):
+    import app as web
+    from sqlalchemy import func, insert, select
+    from werkzeug.security import generate_password_hash
+
+    rng = random.Random(rng_seed)
+    db = web.db
+
+    with web.app.app_context():
+        # Один хеш на всех: проверка пароля при входе стоит столько же, а наполнение не ждёт scrypt
+        password_hash = generate_password_hash(BENCH_PASSWORD, web.app.config['PASSWORD_HASH_METHOD'])
+        db.session.execute(insert(web.User), [{
+            'username': f'bench_user_{number:06d}',
+            'password_hash': password_hash,
+            'role': 'moderator' if number % 100 == 0 else 'user',
+        } for number in range(1, users + 1)])
+        db.session.execute(insert(web.Room), [{
+            'slug': f'room-{number:03d}',
+            'name': f'Комната {number}',
+        } for number in range(1, rooms)])
+        db.session.commit()
+
+        user_ids = db.session.scalars(select(web.User.id)).all()
+        room_ids = db.session.scalars(select(web.Room.id).order_by(web.Room.id)).all()
+        # Общая комната самая оживлённая
+        room_weights = [len(room_ids)] + [1] * (len(room_ids) - 1)
+
+        # Полнотекстовый индекс перестраивается одним проходом в конце - быстрее построчного триггера
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('DROP TRIGGER IF EXISTS message_fts_insert')
+
+        word_weights = [1 / rank for rank in range(1, len(COMMON_WORDS) + 1)]
+        rows = []
+        for timestamp in spread_timestamps(rng, messages, days):
+            rows.append({'user_id': rng.choice(user_ids),
+                         'room_id': rng.choices(room_ids, weights=room_weights)[0],
+                         'text': random_text(rng, word_weights),
+                         'timestamp': timestamp})
+            if len(rows) == batch:
+                db.session.execute(insert(web.Message), rows)
+                db.session.commit()
+                rows = []
+        if rows:
+            db.session.execute(insert(web.Message), rows)
+            db.session.commit()
+
+        if web.search_enabled:
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql("INSERT INTO message_fts(message_fts) VALUES ('rebuild')")
+            web.setup_message_search()
+
+        db.session.execute(insert(web.Product), [{
+            'name': f'{rng.choice(PRODUCT_WORDS)} #{number}',
+            'description': f'Тестовый товар {number}',
+            'price': round(rng.uniform(100, 5000), 2),
+            'stock': rng.randint(50, 500),
+        } for number in range(1, products + 1)])
+        db.session.commit()
+
+        catalog = db.session.execute(select(web.Product.name, web.Product.price)).all()
+        next_order_id = (db.session.scalar(select(func.max(web.Order.id))) or 0) + 1
+        statuses, status_weights = zip(*ORDER_STATUSES)
+        order_rows, item_rows = [], []
+        for order_id, created_at in enumerate(spread_timestamps(rng, orders, days), next_order_id):
+            lines = [(name, price, rng.randint(1, 3)) for name, price in rng.sample(catalog, rng.randint(1, 4))]
+            order_rows.append({'id': order_id,
+                               'user_id': rng.choice(user_ids),
+                               'total_price': sum(price * quantity for _, price, quantity in lines),
+                               'status': rng.choices(statuses, weights=status_weights)[0],
+                               'delivery_address': 'Тестовый адрес',
+                               'contact_info': 'bench@example.com',
+                               'created_at': created_at})
+            item_rows.extend({'order_id': order_id, 'product_name': name, 'product_price': price,
+                              'quantity': quantity} for name, price, quantity in lines)
+            if len(order_rows) == batch:
+                db.session.execute(insert(web.Order), order_rows)
+                db.session.execute(insert(web.OrderItem), item_rows)
+                db.session.commit()
+                order_rows, item_rows = [], []
+        if order_rows:
+            db.session.execute(insert(web.Order), order_rows)
+            db.session.execute(insert(web.OrderItem), item_rows)
+            db.session.commit()
+
+        # Агрегаты продаж той же командой, что и flask rebuild-sales-stats
+        result = web.app.test_cli_runner().invoke(web.rebuild_sales_stats, ['--batch-size', str(batch)])
+        if result.exit_code:
+            raise RuntimeError(f'Не удалось пересчитать агрегаты продаж: {result.output}')
+
+        if db.engine.dialect.name == 'sqlite':
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+                connection.exec_driver_sql('ANALYZE')
+
+    print(f'База наполнена: {users} пользователей, {rooms} комнат, {messages} сообщений, '
+          f'{products} товаров, {orders} заказов')
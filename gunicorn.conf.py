@@ -0,0 +1,52 @@
+# Продакшен-запуск: gunicorn -c gunicorn.conf.py app:app
+# Режим выбирается той же переменной SOCKETIO_ASYNC_MODE, что и в app.py:
+#   threading - потоковые воркеры, WebSocket через simple-websocket
+#   eventlet  - pip install eventlet
+#   gevent    - pip install gevent gevent-websocket
+import os
+import signal
+
+async_mode = os.environ.get('SOCKETIO_ASYNC_MODE', 'threading')
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', 8000)}")
+
+# Без очереди сообщений Socket.IO события не доходят до клиентов других воркеров,
+# поэтому по умолчанию воркер один; с SOCKETIO_MESSAGE_QUEUE нужны ещё sticky-сессии
+workers = int(os.environ.get('WEB_CONCURRENCY', 4 if os.environ.get('SOCKETIO_MESSAGE_QUEUE') else 1))
+
+if async_mode == 'eventlet':
+    worker_class = 'eventlet'
+    worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 10000))
+elif async_mode == 'gevent':
+    worker_class = 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
+    worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 10000))
+else:
+    # Каждое WebSocket-соединение занимает поток целиком
+    worker_class = 'gthread'
+    threads = int(os.environ.get('WORKER_THREADS', 100))
+
+# WebSocket-соединения живут долго: таймаут проверяет только живость воркера
+timeout = int(os.environ.get('WORKER_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_worker_init(worker):
+    # Перед остановкой по SIGTERM закрываем сокеты клиентов и сбрасываем буферы записи
+    handle_exit = worker.handle_exit
+
+    def drain_and_exit(signum, frame):
+        from app import drain_connections
+        drain_connections()
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, drain_and_exit)
+
+
+def worker_exit(server, worker):
+    # Страховка на случай остановки без SIGTERM (SIGQUIT, max_requests)
+    from app import flush_background_work
+    flush_background_work()
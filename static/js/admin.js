@@ -71,6 +71,35 @@ async function changeRole(userId, newRole) {
     }
 }
 
+// Назначение и снятие модератора комнаты
+const roomModeratorForm = document.getElementById('roomModeratorForm');
+
+if (roomModeratorForm) {
+    roomModeratorForm.addEventListener('submit', async (e) => {
+        e.preventDefault();
+
+        try {
+            const response = await fetch('/admin/room_moderator', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({
+                    user_id: parseInt(document.getElementById('roomModeratorUser').value),
+                    room_id: parseInt(document.getElementById('roomModeratorRoom').value),
+                    moderator: e.submitter.dataset.moderator === 'true'
+                })
+            });
+
+            const data = await response.json();
+            showFlash(data.message, data.success ? 'success' : 'error');
+        } catch (error) {
+            showFlash('Ошибка при изменении модераторов комнаты', 'error');
+            console.error(error);
+        }
+    });
+}
+
 // Удаление пользователя
 async function deleteUser(userId, username) {
     if (!confirm(`Вы уверены, что хотите удалить пользователя "${username}"? Это действие нельзя отменить.`)) {
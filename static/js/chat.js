@@ -1,13 +1,19 @@
 // WebSocket подключение
-const socket = io();
+const socket = io(window.SOCKET_OPTIONS || {});
 
 let currentMuteUserId = null;
 let currentMuteUsername = null;
 
-// Подключение к чату
+// Комната, открытая на странице
+const currentRoomId = parseInt(document.getElementById('chatMessages')?.dataset.roomId || 0);
+
+// Подключение к чату (и каждое переподключение): входим в комнату и догоняем пропущенные события
 socket.on('connect', () => {
     console.log('Connected to chat');
     startHeartbeat();
+    socket.emit('join', { room_id: currentRoomId }, (reply) => {
+        if (reply && reply.success) syncChat();
+    });
 });
 
 // Отключение от чата
@@ -15,57 +21,188 @@ socket.on('disconnect', () => {
     console.log('Disconnected from chat');
 });
 
-// Пользователь подключился
-socket.on('user_connected', (data) => {
-    updateUserStatus(data.user_id, true);
-    updateOnlineCount();
-    showSystemMessage(`${data.username} подключился к чату`);
-});
+// События комнаты чата: приходят по одному или пачкой events_batch
+const chatEventHandlers = {
+    // Пользователь подключился
+    user_connected: (data) => {
+        updateUserStatus(data.user_id, true);
+        updateOnlineCount();
+        showSystemMessage(`${data.username} подключился к чату`);
+    },
+
+    // Пользователь отключился
+    user_disconnected: (data) => {
+        updateUserStatus(data.user_id, false);
+        updateOnlineCount();
+        showSystemMessage(`${data.username} покинул чат`);
+    },
+
+    // Новое сообщение (при догонке может прийти повторно)
+    new_message: (message) => {
+        if (message.room_id !== currentRoomId) return;
+        if (document.querySelector(`[data-message-id="${message.id}"]`)) return;
+        addMessageToChat(message);
+        scrollToBottom();
+    },
+
+    // Сообщение удалено
+    message_deleted: (data) => {
+        const messageEl = document.querySelector(`[data-message-id="${data.message_id}"]`);
+        if (messageEl) {
+            messageEl.style.animation = 'messageOut 0.3s ease';
+            setTimeout(() => messageEl.remove(), 300);
+        }
+    },
+
+    // Пользователь замучен
+    user_muted: (data) => {
+        let durationText = '';
+        switch(data.duration) {
+            case 'forever': durationText = 'навсегда'; break;
+            case '10m': durationText = 'на 10 минут'; break;
+            case '1h': durationText = 'на 1 час'; break;
+            default: durationText = data.duration;
+        }
+        showSystemMessage(`${data.username} был замучен ${durationText} модератором ${data.moderator}`, 'warning');
+    },
 
-// Пользователь отключился
-socket.on('user_disconnected', (data) => {
-    updateUserStatus(data.user_id, false);
-    updateOnlineCount();
-    showSystemMessage(`${data.username} покинул чат`);
-});
+    // Пользователь размучен
+    user_unmuted: (data) => {
+        showSystemMessage(`С ${data.username} снят мут модератором ${data.moderator}`, 'success');
+    }
+};
 
-// Новое сообщение
-socket.on('new_message', (message) => {
-    addMessageToChat(message);
-    scrollToBottom();
-});
+// Номер последнего полученного события комнаты и процесс сервера, который его выдал
+const chatSyncState = document.getElementById('chatMessages')?.dataset || {};
+let syncEpoch = chatSyncState.epoch || '';
+let lastSeq = parseInt(chatSyncState.seq || 0);
+
+function handleChatEvent(event, data) {
+    if (data && data.seq) lastSeq = Math.max(lastSeq, data.seq);
+    const handler = chatEventHandlers[event];
+    if (handler) handler(data);
+}
 
-// Сообщение удалено
-socket.on('message_deleted', (data) => {
-    const messageEl = document.querySelector(`[data-message-id="${data.message_id}"]`);
-    if (messageEl) {
-        messageEl.style.animation = 'messageOut 0.3s ease';
-        setTimeout(() => messageEl.remove(), 300);
+Object.keys(chatEventHandlers).forEach(event => socket.on(event, (data) => handleChatEvent(event, data)));
+
+// Догонка: сервер присылает пропущенные события из буфера, а если разрыв больше буфера -
+// новые сообщения из базы, id удалённых и список онлайн
+function syncChat() {
+    const messageIds = Array.from(document.querySelectorAll('#chatMessages [data-message-id]'),
+                                  el => parseInt(el.dataset.messageId));
+    socket.emit('sync', {
+        room_id: currentRoomId,
+        epoch: syncEpoch,
+        seq: lastSeq,
+        last_message_id: messageIds.length ? Math.max(...messageIds) : 0,
+        known_ids: messageIds.slice(-500)
+    }, applySync);
+}
+
+function applySync(reply) {
+    if (!reply) return;
+    if (reply.mode === 'reload') {
+        window.location.reload();
+        return;
     }
-});
 
-// Пользователь замучен
-socket.on('user_muted', (data) => {
-    let durationText = '';
-    switch(data.duration) {
-        case 'forever': durationText = 'навсегда'; break;
-        case '10m': durationText = 'на 10 минут'; break;
-        case '1h': durationText = 'на 1 час'; break;
-        default: durationText = data.duration;
+    if (reply.mode === 'events') {
+        reply.events.forEach(([event, data]) => handleChatEvent(event, data));
+    } else {
+        reply.messages.forEach(message => chatEventHandlers.new_message(message));
+        reply.deleted_ids.forEach(messageId => chatEventHandlers.message_deleted({ message_id: messageId }));
+        document.querySelectorAll('.user-item').forEach(el => {
+            const userId = parseInt(el.dataset.userId);
+            updateUserStatus(userId, reply.online_ids.includes(userId));
+        });
+        updateOnlineCount();
     }
-    showSystemMessage(`${data.username} был замучен ${durationText} модератором ${data.moderator}`, 'warning');
-});
 
-// Пользователь размучен
-socket.on('user_unmuted', (data) => {
-    showSystemMessage(`С ${data.username} снят мут модератором ${data.moderator}`, 'success');
+    syncEpoch = reply.epoch;
+    lastSeq = reply.mode === 'events' ? Math.max(lastSeq, reply.seq) : reply.seq;
+}
+
+// Пачка событий: JSON {events: [...]} или msgpack-массив [[event, data], ...]
+socket.on('events_batch', (batch) => {
+    const events = batch instanceof ArrayBuffer ? decodeMsgpack(new Uint8Array(batch)) : batch.events;
+    events.forEach(([event, data]) => handleChatEvent(event, data));
 });
 
+// Минимальный декодер msgpack (только типы, которые отдаёт сервер)
+function decodeMsgpack(bytes) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    const utf8 = new TextDecoder();
+    let pos = 0;
+
+    const str = (length) => {
+        const value = utf8.decode(bytes.subarray(pos, pos + length));
+        pos += length;
+        return value;
+    };
+    const array = (length) => {
+        const value = [];
+        for (let i = 0; i < length; i++) value.push(read());
+        return value;
+    };
+    const map = (length) => {
+        const value = {};
+        for (let i = 0; i < length; i++) {
+            const key = read();
+            value[key] = read();
+        }
+        return value;
+    };
+    const next = (size, getter) => {
+        const value = view[getter](pos);
+        pos += size;
+        return value;
+    };
+
+    function read() {
+        const type = bytes[pos++];
+        if (type <= 0x7f) return type;
+        if (type <= 0x8f) return map(type & 0x0f);
+        if (type <= 0x9f) return array(type & 0x0f);
+        if (type <= 0xbf) return str(type & 0x1f);
+        if (type >= 0xe0) return type - 0x100;
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xca: return next(4, 'getFloat32');
+            case 0xcb: return next(8, 'getFloat64');
+            case 0xcc: return next(1, 'getUint8');
+            case 0xcd: return next(2, 'getUint16');
+            case 0xce: return next(4, 'getUint32');
+            case 0xcf: return Number(next(8, 'getBigUint64'));
+            case 0xd0: return next(1, 'getInt8');
+            case 0xd1: return next(2, 'getInt16');
+            case 0xd2: return next(4, 'getInt32');
+            case 0xd3: return Number(next(8, 'getBigInt64'));
+            case 0xd9: return str(next(1, 'getUint8'));
+            case 0xda: return str(next(2, 'getUint16'));
+            case 0xdb: return str(next(4, 'getUint32'));
+            case 0xdc: return array(next(2, 'getUint16'));
+            case 0xdd: return array(next(4, 'getUint32'));
+            case 0xde: return map(next(2, 'getUint16'));
+            case 0xdf: return map(next(4, 'getUint32'));
+            default: throw new Error(`msgpack: неподдерживаемый тип 0x${type.toString(16)}`);
+        }
+    }
+
+    return read();
+}
+
 // Ошибка сообщения
 socket.on('message_error', (data) => {
     showFlash(data.message, 'error');
 });
 
+// Сервер отбросил событие из-за превышения лимита
+socket.on('rate_limited', (data) => {
+    showFlash(data.message, 'error');
+});
+
 // Отправка сообщения
 const messageForm = document.getElementById('messageForm');
 const messageInput = document.getElementById('messageInput');
@@ -77,7 +214,7 @@ if (messageForm) {
         const message = messageInput.value.trim();
         if (!message) return;
 
-        socket.emit('send_message', { message });
+        socket.emit('send_message', { message, room_id: currentRoomId });
         messageInput.value = '';
     });
 }
@@ -85,14 +222,18 @@ if (messageForm) {
 // Удаление сообщения
 function deleteMessage(messageId) {
     if (confirm('Удалить это сообщение?')) {
-        socket.emit('delete_message', { message_id: messageId });
+        socket.emit('delete_message', { message_id: messageId, room_id: currentRoomId });
     }
 }
 
 // Добавление сообщения в чат
 function addMessageToChat(message) {
     const chatMessages = document.getElementById('chatMessages');
+    chatMessages.appendChild(createMessageElement(message));
+}
 
+// Разметка сообщения
+function createMessageElement(message) {
     const messageEl = document.createElement('div');
     messageEl.className = 'message';
     messageEl.dataset.messageId = message.id;
@@ -100,7 +241,7 @@ function addMessageToChat(message) {
 
     const currentUserId = parseInt(document.body.dataset.userId || 0);
     const isCurrentUser = message.user_id === currentUserId;
-    const isModerator = document.body.dataset.isModerator === 'true';
+    const isModerator = document.getElementById('chatMessages')?.dataset.canModerate === 'true';
 
     messageEl.innerHTML = `
         <div class="message-avatar">${message.username[0].toUpperCase()}</div>
@@ -115,7 +256,48 @@ function addMessageToChat(message) {
         ${isCurrentUser || isModerator ? `<button class="message-delete" onclick="deleteMessage(${message.id})">🗑️</button>` : ''}
     `;
 
-    chatMessages.appendChild(messageEl);
+    return messageEl;
+}
+
+// Подгрузка старой истории при прокрутке вверх
+let historyLoading = false;
+
+async function loadOlderMessages() {
+    const chatMessages = document.getElementById('chatMessages');
+    if (!chatMessages || historyLoading) return;
+    if (chatMessages.dataset.hasMore !== 'true' || !chatMessages.dataset.cursor) return;
+
+    historyLoading = true;
+    try {
+        const params = new URLSearchParams({ before: chatMessages.dataset.cursor, room_id: currentRoomId });
+        const response = await fetch(`/chat/history?${params}`);
+        const data = await response.json();
+
+        if (data.success) {
+            // Сохраняем позицию прокрутки, чтобы сообщения не "прыгали"
+            const previousHeight = chatMessages.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            data.messages.forEach(message => fragment.appendChild(createMessageElement(message)));
+            chatMessages.prepend(fragment);
+            chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+
+            chatMessages.dataset.hasMore = data.has_more ? 'true' : 'false';
+            chatMessages.dataset.cursor = data.next_cursor || '';
+        }
+    } catch (error) {
+        console.error(error);
+    } finally {
+        historyLoading = false;
+    }
+}
+
+const chatMessagesEl = document.getElementById('chatMessages');
+if (chatMessagesEl) {
+    chatMessagesEl.addEventListener('scroll', () => {
+        if (chatMessagesEl.scrollTop < 100) {
+            loadOlderMessages();
+        }
+    });
 }
 
 // Обновление статуса пользователя
@@ -231,6 +413,7 @@ async function muteUser(duration) {
             },
             body: JSON.stringify({
                 user_id: currentMuteUserId,
+                room_id: currentRoomId,
                 duration: duration
             })
         });
@@ -273,6 +456,7 @@ function muteUserCustom() {
             },
             body: JSON.stringify({
                 user_id: currentMuteUserId,
+                room_id: currentRoomId,
                 duration: 'custom',
                 custom_minutes: minutes
             })
@@ -291,7 +475,8 @@ async function unmuteUser(userId) {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
-                user_id: userId
+                user_id: userId,
+                room_id: currentRoomId
             })
         });
 
@@ -314,6 +499,35 @@ async function unmuteUser(userId) {
     }
 }
 
+// Создание комнаты (модераторы)
+async function createRoom() {
+    const name = prompt('Название комнаты');
+    if (!name) return;
+    const slug = prompt('Адрес комнаты (латинские буквы, цифры, - и _)');
+    if (!slug) return;
+
+    try {
+        const response = await fetch('/chat/rooms', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ name, slug })
+        });
+
+        const data = await response.json();
+
+        if (data.success) {
+            window.location.href = data.url;
+        } else {
+            showFlash(data.message, 'error');
+        }
+    } catch (error) {
+        showFlash('Ошибка при создании комнаты', 'error');
+        console.error(error);
+    }
+}
+
 // Закрытие модального окна при клике вне его
 document.addEventListener('click', (e) => {
     const modal = document.getElementById('muteModal');
@@ -0,0 +1,91 @@
+# Приложение поднимается один раз на временной базе SQLite: окружение выставляется до импорта app
+import itertools
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DIR = tempfile.mkdtemp(prefix='chat-tests-')
+
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(TEST_DIR, 'test.db')}",
+    'SECRET_KEY': 'test-secret-key',
+    'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+    'CHAT_ARCHIVE_DIR': os.path.join(TEST_DIR, 'archive'),
+    'ASSETS_DIR': os.path.join(TEST_DIR, 'assets'),
+    'LOGIN_IP_BURST': '1000000',
+    'LOGIN_USER_BURST': '1000000',
+    'RATE_LIMIT_ROOM_BURST': '1000000',
+    **{f'RATE_LIMIT_{role}_BURST': '1000000' for role in ('CREATOR', 'MODERATOR', 'USER')},
+})
+sys.path.insert(0, ROOT)
+
+import app as web  # noqa: E402
+
+_names = itertools.count(1)
+
+
+@contextmanager
+def app_context():
+    # Отдельный контекст на каждую работу с базой: запросы тестовых клиентов, выполненные
+    # внутри чужого контекста, делили бы с ним g, а значит и current_user
+    with web.app.app_context():
+        yield web.db.session
+
+
+@pytest.fixture
+def make_user():
+    def make(role='user', password='password'):
+        with app_context() as session:
+            user = web.User(username=f'test_user_{next(_names)}', role=role)
+            user.set_password(password)
+            session.add(user)
+            session.commit()
+            return user.id
+    return make
+
+
+@pytest.fixture
+def make_room():
+    def make():
+        number = next(_names)
+        with app_context() as session:
+            room = web.Room(slug=f'test-room-{number}', name=f'Комната {number}')
+            session.add(room)
+            session.commit()
+            return room.id, room.slug
+    return make
+
+
+def login(user_id):
+    # Сессия Flask-Login выставляется напрямую, без проверки пароля
+    client = web.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    return client
+
+
+def socket_client(client):
+    return web.socketio.test_client(web.app, flask_test_client=client)
+
+
+@contextmanager
+def count_queries():
+    # Все SQL-запросы к базе приложения внутри блока
+    statements = []
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with web.app.app_context():
+        engine = web.db.engine
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'after_cursor_execute', after_cursor_execute)
@@ -0,0 +1,22 @@
+from conftest import app_context, login, web
+
+
+def test_pagers_keep_the_other_table_page(monkeypatch, make_user):
+    monkeypatch.setitem(web.app.config, 'ADMIN_PAGE_SIZE', 2)
+    creator_id, buyer_id = make_user('creator'), make_user()
+    with app_context() as session:
+        for number in range(5):
+            product = web.Product(name=f'Товар {number}', description='Описание', price=10.0, stock=10)
+            session.add(product)
+            session.commit()
+            # Заказы через place_order, чтобы агрегаты продаж совпадали с заказами
+            session.add(web.CartItem(user_id=buyer_id, product_id=product.id, quantity=1))
+            session.commit()
+            web.place_order(buyer_id, 'Адрес', 'test@example.com')
+
+    html = login(creator_id).get('/admin/shop?page=2&products_page=2&status=pending').get_data(as_text=True)
+
+    # Ссылки одной таблицы сохраняют страницу другой и фильтры
+    assert 'page=2&amp;products_page=3&amp;status=pending' in html
+    assert 'page=3&amp;products_page=2&amp;status=pending' in html
+    assert 'name="products_page" value="2"' in html
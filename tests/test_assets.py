@@ -0,0 +1,29 @@
+import gzip
+import os
+
+from conftest import app_context, web
+
+
+def test_assets_from_previous_builds_stay_available():
+    with app_context():
+        current = web.build_assets()['css/style.css']['file']
+    old = 'css/style.0123456789ab.css'
+    old_path = os.path.join(web.app.config['ASSETS_DIR'], old)
+    with open(old_path, 'wb') as old_file:
+        old_file.write(b'body{color:red}')
+    with open(old_path + '.gz', 'wb') as old_file:
+        old_file.write(gzip.compress(b'body{color:red}'))
+
+    client = web.app.test_client()
+    assert client.get(f'/assets/{current}').status_code == 200
+
+    response = client.get(f'/assets/{old}', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == b'body{color:red}'
+    assert client.get(f'/assets/{old}').data == b'body{color:red}'
+
+    # Только существующие файлы с хешем в имени
+    assert client.get('/assets/manifest.json').status_code == 404
+    assert client.get('/assets/css/style.ffffffffffff.css').status_code == 404
+    assert client.get('/assets/css/..%2F..%2Ftest.0123456789ab.css').status_code == 404
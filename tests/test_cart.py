@@ -0,0 +1,47 @@
+import pytest
+from sqlalchemy import insert, select
+
+from conftest import app_context, count_queries, login, web
+
+
+def make_cart(user_id, items):
+    with app_context() as session:
+        product_ids = []
+        for number in range(items + 1):
+            product = web.Product(name=f'Товар {number}', description='Описание', price=10.0 + number, stock=100)
+            session.add(product)
+            session.flush()
+            product_ids.append(product.id)
+        session.execute(insert(web.CartItem), [{'user_id': user_id, 'product_id': product_id, 'quantity': 1}
+                                               for product_id in product_ids[:items]])
+        session.commit()
+        item_ids = session.scalars(select(web.CartItem.id).where(web.CartItem.user_id == user_id)).all()
+    return product_ids[-1], item_ids
+
+
+@pytest.mark.parametrize('items', [3, 30])
+def test_cart_endpoints_query_counts(make_user, items):
+    user_id = make_user()
+    spare_product_id, item_ids = make_cart(user_id, items)
+    client = login(user_id)
+    client.get('/shop')  # прогрев кэша пользователей и сводки корзины
+
+    def queries(method, url, **kwargs):
+        with count_queries() as statements:
+            response = getattr(client, method)(url, **kwargs)
+        assert response.status_code in (200, 302), url
+        return statements
+
+    # Число запросов не зависит от размера корзины
+    assert len(queries('get', '/cart')) == 1
+    assert len(queries('get', '/checkout')) == 1
+    # Товар, поиск строки корзины и INSERT, затем товар, поиск и UPDATE
+    assert len(queries('post', f'/cart/add/{spare_product_id}', json={'quantity': 1})) == 3
+    assert len(queries('post', f'/cart/add/{spare_product_id}', json={'quantity': 1})) == 3
+    # Строка корзины вместе с товаром и сам UPDATE/DELETE
+    assert len(queries('post', f'/cart/update/{item_ids[0]}', json={'quantity': 3})) == 2
+    assert len(queries('post', f'/cart/remove/{item_ids[1]}')) == 2
+
+    # Оформление списывает склад и пишет продажи построчно, остальное - фиксированная часть
+    statements = queries('post', '/checkout', data={'address': 'Адрес', 'contact': 'test@example.com'})
+    assert len(statements) <= 8 + 3 * (items + 1), statements
@@ -0,0 +1,31 @@
+from sqlalchemy import insert
+
+from conftest import app_context, login, web
+
+
+def test_catalog_cache_clamps_page_and_stays_bounded():
+    cache = web.CatalogCache(ttl=300, max_pages=8)
+    with app_context() as session:
+        session.execute(insert(web.Product), [{'name': f'Товар {number}', 'description': 'Описание', 'price': 100 + number, 'stock': 5}
+                                              for number in range(30)])
+        session.commit()
+
+        last_page = cache.get_page(1, 10, 'default')['pages']
+        for page in range(1, 2001):
+            entry = cache.get_page(page, 10, 'default')
+        assert entry['page'] == last_page
+        assert entry['products']
+        assert len(cache._pages) == min(last_page, cache.max_pages)
+
+        for sort in web.CATALOG_SORTS:
+            for limit in range(1, 20):
+                cache.get_page(1, limit, sort)
+        assert len(cache._pages) == cache.max_pages
+
+
+def test_catalog_api_serves_last_page_for_out_of_range_page(make_user):
+    client = login(make_user())
+    response = client.get('/shop/api/products', query_string={'page': 5000, 'limit': 5})
+    assert response.status_code == 200
+    assert response.json['page'] == response.json['pages']
+    assert client.get('/shop', query_string={'page': 5000}).status_code == 200
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from conftest import app_context, count_queries, login, web
+
+
+def test_chat_renders_with_fixed_query_count(make_user, make_room):
+    user_id = make_user()
+    authors = [make_user() for _ in range(20)]
+    room_id, slug = make_room()
+    started = datetime.utcnow() - timedelta(days=1)
+    with app_context() as session:
+        session.execute(insert(web.Message), [
+            {'user_id': authors[number % len(authors)], 'room_id': room_id, 'text': f'сообщение {number}',
+             'timestamp': started + timedelta(seconds=number)}
+            for number in range(10000)
+        ])
+        session.commit()
+
+    client = login(user_id)
+    assert client.get(f'/chat/rooms/{slug}').status_code == 200  # прогрев кэша пользователей
+
+    with count_queries() as statements:
+        response = client.get(f'/chat/rooms/{slug}')
+
+    assert response.status_code == 200
+    assert 'сообщение 9999'.encode() in response.data
+    # Комнаты, страница сообщений вместе с авторами и список пользователей
+    assert len(statements) <= 3, statements
+
+
+def test_chat_history_loads_authors_in_one_query(make_user, make_room):
+    user_id = make_user()
+    room_id, _ = make_room()
+    authors = [make_user() for _ in range(30)]
+    with app_context() as session:
+        session.execute(insert(web.Message), [
+            {'user_id': author_id, 'room_id': room_id, 'text': f'история {number}'}
+            for number, author_id in enumerate(authors)
+        ])
+        session.commit()
+
+    client = login(user_id)
+    client.get('/chat/history', query_string={'room_id': room_id})
+
+    with count_queries() as statements:
+        response = client.get('/chat/history', query_string={'room_id': room_id, 'limit': 30})
+
+    assert len(response.json['messages']) == 30
+    assert len(statements) == 1, statements
@@ -0,0 +1,45 @@
+import pytest
+
+from conftest import login, socket_client, web
+
+
+@pytest.fixture
+def chat(make_user, make_room):
+    moderator_id, user_id = make_user('moderator'), make_user()
+    room_id, _ = make_room()
+    socket = socket_client(login(user_id))
+    assert socket.emit('join', {'room_id': room_id}, callback=True)['success']
+    socket.get_received()
+    yield login(moderator_id), socket, user_id, room_id
+    socket.disconnect()
+
+
+def send(socket, room_id, text):
+    socket.emit('send_message', {'room_id': room_id, 'message': text})
+    return {packet['name']: packet['args'][0] for packet in socket.get_received()}
+
+
+@pytest.mark.parametrize('scope', ['global', 'room'])
+def test_mute_and_unmute_apply_to_next_message(chat, scope):
+    moderator, socket, user_id, room_id = chat
+    target = {'user_id': user_id, 'room_id': room_id if scope == 'room' else None}
+
+    assert 'new_message' in send(socket, room_id, 'до мута')
+
+    assert moderator.post('/mute_user', json={**target, 'duration': '10m'}).json['success']
+    events = send(socket, room_id, 'во время мута')
+    assert 'new_message' not in events
+    assert 'замучены' in events['message_error']['message']
+
+    assert moderator.post('/unmute_user', json=target).json['success']
+    assert send(socket, room_id, 'после мута')['new_message']['text'] == 'после мута'
+
+
+def test_expired_mute_is_lifted_without_moderator(chat):
+    moderator, socket, user_id, room_id = chat
+    moderator.post('/mute_user', json={'user_id': user_id, 'duration': '10m'})
+    assert 'message_error' in send(socket, room_id, 'во время мута')
+
+    # Срок истёк: мут снимается лениво при следующей проверке
+    web.mute_registry.mute(user_id, web.datetime.utcnow() - web.timedelta(seconds=1))
+    assert 'new_message' in send(socket, room_id, 'мут истёк')
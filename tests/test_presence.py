@@ -0,0 +1,47 @@
+from conftest import login, socket_client, web
+
+
+def events(socket, name):
+    return [packet['args'][0] for packet in socket.get_received() if packet['name'] == name]
+
+
+def test_room_presence_follows_last_session(make_user, make_room):
+    watcher_id, user_id = make_user(), make_user()
+    room_id, slug = make_room()
+    watcher = socket_client(login(watcher_id))
+    watcher.emit('join', {'room_id': room_id}, callback=True)
+    watcher.get_received()
+    client = login(user_id)
+    first, second = socket_client(client), socket_client(client)
+
+    first.emit('join', {'room_id': room_id}, callback=True)
+    second.emit('join', {'room_id': room_id}, callback=True)
+    assert [data['user_id'] for data in events(watcher, 'user_connected')] == [user_id]
+    assert web.presence.online_user_ids(room_id) == {watcher_id, user_id}
+    assert '2 онлайн'.encode() in login(watcher_id).get(f'/chat/rooms/{slug}').data
+
+    # Одна из двух вкладок закрыта - пользователь ещё в комнате
+    first.disconnect()
+    assert events(watcher, 'user_disconnected') == []
+    second.emit('leave', {'room_id': room_id})
+    assert [data['user_id'] for data in events(watcher, 'user_disconnected')] == [user_id]
+    assert web.presence.online_user_ids(room_id) == {watcher_id}
+
+    second.disconnect()
+    watcher.disconnect()
+    assert web.presence.online_user_ids(room_id) == set()
+
+
+def test_memory_backend_drops_expired_sessions():
+    backend = web.MemoryPresenceBackend()
+    assert backend.touch(1, 10, 'a', expires_at=100, now=0)
+    assert not backend.touch(1, 10, 'b', expires_at=200, now=0)
+    assert backend.touch(1, 11, 'c', expires_at=50, now=0)
+    assert not backend.touch(1, 11, 'c', expires_at=60, now=10)  # heartbeat той же сессии
+    assert backend.online_user_ids(1, now=61) == {10}
+
+    # Сессия b истекла (воркер упал) - вход с новой снова первый
+    assert backend.touch(1, 10, 'd', expires_at=400, now=300)
+    assert not backend.remove(1, 10, 'a', now=300)
+    assert backend.remove(1, 10, 'd', now=300)
+    assert backend.online_user_ids(1, now=300) == set()
@@ -0,0 +1,86 @@
+import fcntl
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, select
+
+from conftest import app_context, web
+
+
+def test_retention_skips_run_while_another_process_holds_the_lock(monkeypatch, make_user, make_room):
+    monkeypatch.setitem(web.app.config, 'CHAT_RETENTION_DAYS', 30)
+    user_id = make_user()
+    room_id, _ = make_room()
+    with app_context() as session:
+        session.execute(insert(web.Message), [
+            {'user_id': user_id, 'room_id': room_id, 'text': f'старое {number}',
+             'timestamp': datetime.utcnow() - timedelta(days=60, seconds=number)}
+            for number in range(5)
+        ])
+        session.commit()
+
+    def remaining():
+        with app_context() as session:
+            return session.scalar(select(func.count()).where(web.Message.room_id == room_id))
+
+    # Файл открыт отдельно, как в другом воркере: flock на нём конфликтует с run_retention
+    os.makedirs(web.app.config['CHAT_ARCHIVE_DIR'], exist_ok=True)
+    with open(os.path.join(web.app.config['CHAT_ARCHIVE_DIR'], 'retention.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        with app_context():
+            assert web.run_retention() == 0
+        assert remaining() == 5
+
+    with app_context():
+        assert web.run_retention() == 5
+    assert remaining() == 0
+
+
+def test_message_limit_applies_per_room(monkeypatch, make_user, make_room):
+    monkeypatch.setitem(web.app.config, 'CHAT_RETENTION_DAYS', 0)
+    monkeypatch.setitem(web.app.config, 'CHAT_RETENTION_MAX_MESSAGES', 5)
+    user_id = make_user()
+    (busy_room_id, _), (quiet_room_id, _) = make_room(), make_room()
+    started = datetime.utcnow() - timedelta(days=1)
+    with app_context() as session:
+        # Тихая комната писала раньше: при общем лимите её история ушла бы в архив целиком
+        session.execute(insert(web.Message), [
+            {'user_id': user_id, 'room_id': quiet_room_id, 'text': f'тихо {number}',
+             'timestamp': started + timedelta(seconds=number)}
+            for number in range(3)
+        ] + [
+            {'user_id': user_id, 'room_id': busy_room_id, 'text': f'шумно {number}',
+             'timestamp': started + timedelta(minutes=1, seconds=number)}
+            for number in range(20)
+        ])
+        session.commit()
+
+    with app_context() as session:
+        web.run_retention()
+        kept = dict(session.execute(
+            select(web.Message.room_id, func.count())
+            .where(web.Message.room_id.in_([busy_room_id, quiet_room_id]))
+            .group_by(web.Message.room_id)).all())
+        newest_busy = session.scalars(select(web.Message.text).where(web.Message.room_id == busy_room_id)
+                                      .order_by(web.Message.timestamp)).all()
+
+    assert kept == {busy_room_id: 5, quiet_room_id: 3}
+    assert newest_busy == [f'шумно {number}' for number in range(15, 20)]
+
+
+def test_vacuum_interval_survives_restarts(monkeypatch):
+    monkeypatch.setitem(web.app.config, 'DB_VACUUM_INTERVAL', 3600)
+    marker = web.vacuum_marker_path()
+    if os.path.exists(marker):
+        os.remove(marker)
+
+    assert not web.vacuum_due()  # первая проверка только ставит метку
+    assert os.path.exists(marker)
+    assert not web.vacuum_due()
+
+    # Метка старше интервала - VACUUM нужен в любом процессе, даже только что запущенном
+    os.utime(marker, (0, 0))
+    assert web.vacuum_due()
+    with app_context():
+        web.maintain_database()
+    assert not web.vacuum_due()
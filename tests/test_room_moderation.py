@@ -0,0 +1,90 @@
+import pytest
+
+from conftest import app_context, login, socket_client, web
+
+
+@pytest.fixture
+def rooms(make_user, make_room):
+    creator_id, room_moderator_id, user_id = make_user('creator'), make_user(), make_user()
+    (room_id, _), (other_room_id, _) = make_room(), make_room()
+    response = login(creator_id).post('/admin/room_moderator',
+                                      json={'user_id': room_moderator_id, 'room_id': room_id, 'moderator': True})
+    assert response.json['success']
+    return room_moderator_id, user_id, room_id, other_room_id
+
+
+def post_message(user_id, room_id, text):
+    with app_context() as session:
+        message = web.Message(user_id=user_id, room_id=room_id, text=text)
+        session.add(message)
+        session.commit()
+        return message.id
+
+
+def message_exists(message_id):
+    with app_context() as session:
+        return session.get(web.Message, message_id) is not None
+
+
+def test_room_moderator_deletes_only_in_own_room(rooms):
+    room_moderator_id, user_id, room_id, other_room_id = rooms
+    own = post_message(user_id, room_id, 'в своей комнате')
+    foreign = post_message(user_id, other_room_id, 'в чужой комнате')
+
+    socket = socket_client(login(room_moderator_id))
+    socket.emit('delete_message', {'message_id': foreign})
+    errors = [packet for packet in socket.get_received() if packet['name'] == 'message_error']
+    assert errors and message_exists(foreign)
+
+    socket.emit('delete_message', {'message_id': own})
+    assert not message_exists(own)
+    socket.disconnect()
+
+
+def test_room_moderator_mutes_only_in_own_room(rooms):
+    room_moderator_id, user_id, room_id, other_room_id = rooms
+    client = login(room_moderator_id)
+
+    assert client.post('/mute_user', json={'user_id': user_id, 'room_id': other_room_id,
+                                           'duration': '10m'}).status_code == 403
+    assert client.post('/mute_user', json={'user_id': user_id, 'duration': '10m'}).status_code == 403
+    assert client.post('/mute_user', json={'user_id': user_id, 'room_id': room_id,
+                                           'duration': '10m'}).json['success']
+    assert client.post('/unmute_user', json={'user_id': user_id, 'room_id': room_id}).json['success']
+
+
+def test_removed_room_moderator_loses_rights(make_user, rooms):
+    room_moderator_id, user_id, room_id, _ = rooms
+    creator = login(make_user('creator'))
+    assert creator.post('/admin/room_moderator',
+                        json={'user_id': room_moderator_id, 'room_id': room_id, 'moderator': False}).json['success']
+
+    assert login(room_moderator_id).post('/mute_user', json={'user_id': user_id, 'room_id': room_id,
+                                                             'duration': '10m'}).status_code == 403
+
+
+def test_delete_message_is_limited_by_message_room(monkeypatch, rooms):
+    _, user_id, room_id, _ = rooms
+    message_id = post_message(user_id, room_id, 'текст')
+    buckets = []
+
+    def deny(user, action, room=None):
+        buckets.append(room)
+        return False
+
+    monkeypatch.setattr(web.rate_limiter, 'allow', deny)
+
+    # room_id в событии не передан - лимит всё равно считается по комнате сообщения
+    socket = socket_client(login(user_id))
+    socket.emit('delete_message', {'message_id': message_id})
+    socket.disconnect()
+
+    assert buckets == [web.room_channel(room_id)]
+    assert message_exists(message_id)
+
+
+def test_admin_page_lists_rooms_for_moderators(make_user, make_room):
+    make_room()
+    response = login(make_user('creator')).get('/admin')
+    assert response.status_code == 200
+    assert b'roomModeratorForm' in response.data
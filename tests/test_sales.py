@@ -0,0 +1,54 @@
+from sqlalchemy import select
+
+from conftest import app_context, count_queries, login, web
+
+
+def test_bump_rollup_upserts_in_one_statement():
+    with app_context() as session, count_queries() as statements:
+        web.bump_rollup(web.ProductSales, {'product_name': 'Новый товар'}, units=2, revenue=20.0)
+        web.bump_rollup(web.ProductSales, {'product_name': 'Новый товар'}, units=3, revenue=30.0)
+        row = session.get(web.ProductSales, 'Новый товар')
+        assert (row.units, row.revenue) == (5, 50.0)
+        session.rollback()
+
+    assert sum(statement.startswith('INSERT') for statement in statements) == 2
+    assert not any(statement.startswith('UPDATE') for statement in statements)
+
+
+def place_order(user_id, price, quantity):
+    with app_context() as session:
+        product = web.Product(name=f'Товар за {price}', description='Описание', price=price, stock=100)
+        session.add(product)
+        session.commit()
+        session.add(web.CartItem(user_id=user_id, product_id=product.id, quantity=quantity))
+        session.commit()
+        return web.place_order(user_id, 'Адрес', 'test@example.com').id
+
+
+def sales_stats():
+    # Нулевые строки остаются после отмен и удалений, пересчёт их не создаёт
+    with app_context() as session:
+        return {
+            model.__tablename__: {
+                tuple(row)[0]: tuple(round(value, 2) for value in tuple(row)[1:])
+                for row in session.execute(select(*model.__table__.columns))
+                if any(tuple(row)[1:])
+            }
+            for model in (web.SalesDaily, web.ProductSales, web.OrderStatusStats)
+        }
+
+
+def test_deleting_user_subtracts_their_orders_from_sales(make_user):
+    creator_id, buyer_id, other_id = make_user('creator'), make_user(), make_user()
+    place_order(buyer_id, 100.0, 2)
+    cancelled_id = place_order(buyer_id, 50.0, 1)
+    place_order(other_id, 100.0, 1)
+    creator = login(creator_id)
+    assert creator.post(f'/admin/shop/order/{cancelled_id}/status', json={'status': 'cancelled'}).json['success']
+
+    assert creator.post('/admin/delete_user', json={'user_id': buyer_id}).json['success']
+
+    incremental = sales_stats()
+    result = web.app.test_cli_runner().invoke(args=['rebuild-sales-stats'])
+    assert result.exit_code == 0, result.output
+    assert incremental == sales_stats()
@@ -0,0 +1,36 @@
+from sqlalchemy import insert
+
+from conftest import app_context, login, web
+
+
+def test_exact_matches_rank_above_stem_matches(make_user, make_room):
+    user_id = make_user()
+    room_id, _ = make_room()
+    other_room_id, _ = make_room()
+    # Совпадение только по основе короче и чаще, а точные слова частые во всём индексе:
+    # по одному bm25 оно оказалось бы выше
+    texts = ['мамонт мамонты мамонтов мамонтам мамонтах', 'мама пришла домой поздно вечером после долгой работы',
+             'мама', 'приветливый приветливая приветливые приветливых приветливом',
+             'Привет всем, кто сегодня пришёл в этот чат после долгой работы', 'привет']
+    with app_context() as session:
+        session.execute(insert(web.Message), [{'user_id': user_id, 'room_id': room_id, 'text': text} for text in texts])
+        session.execute(insert(web.Message), [{'user_id': user_id, 'room_id': other_room_id, 'text': 'мама привет'}
+                                              for _ in range(50)])
+        session.commit()
+
+    client = login(user_id)
+
+    def search(query):
+        response = client.get('/chat/search', query_string={'q': query, 'room_id': room_id})
+        return [result['text'] for result in response.json['results']]
+
+    found = search('мама')
+    assert set(found[:2]) == {'мама', 'мама пришла домой поздно вечером после долгой работы'}
+    assert found[2:] == ['мамонт мамонты мамонтов мамонтам мамонтах']
+    assert set(search('привет')[:2]) == {'привет', 'Привет всем, кто сегодня пришёл в этот чат после долгой работы'}
+
+
+def test_search_query_keeps_exact_term_next_to_stem():
+    assert web.build_search_query('Мама ёлки') == '("мама" OR "мам"*) ("елки" OR "елк"*)'
+    assert web.build_search_query('чат') == '"чат"*'
+    assert web.build_exact_search_query('Мама ёлки') == '"мама" "елки"'
@@ -0,0 +1,68 @@
+import threading
+
+import pytest
+
+from conftest import login, socket_client, web
+
+
+@pytest.fixture
+def joined(make_user, make_room):
+    user_id = make_user()
+    room_id, _ = make_room()
+    socket = socket_client(login(user_id))
+    assert socket.emit('join', {'room_id': room_id}, callback=True)['success']
+    socket.emit('send_message', {'room_id': room_id, 'message': 'до обрыва'})
+    yield socket, user_id, room_id
+    socket.disconnect()
+
+
+@pytest.mark.parametrize('payload', [
+    {'epoch': None, 'seq': 'x'},
+    {'last_message_id': 'x'},
+    {'known_ids': 'abc'},
+    {'known_ids': {'a': 1}},
+])
+def test_malformed_sync_asks_for_reload(joined, payload):
+    socket, _, room_id = joined
+    if 'seq' in payload:
+        payload['epoch'] = web.chat_events.epoch
+    assert socket.emit('sync', {'room_id': room_id, **payload}, callback=True) == {'mode': 'reload'}
+
+
+def test_sync_ignores_non_integer_known_ids(joined):
+    socket, _, room_id = joined
+    reply = socket.emit('sync', {'room_id': room_id, 'last_message_id': 0, 'known_ids': ['a', None, 999999999, '5x']},
+                        callback=True)
+    assert reply['mode'] == 'snapshot'
+    assert reply['deleted_ids'] == [999999999]
+    assert [message['text'] for message in reply['messages']] == ['до обрыва']
+
+
+def test_sync_with_non_dict_payload_asks_for_reload(joined):
+    socket, _, _ = joined
+    assert socket.emit('sync', 'room', callback=True) == {'mode': 'reload'}
+
+
+def test_broadcast_in_one_room_does_not_wait_for_another(monkeypatch):
+    entered, release = threading.Event(), threading.Event()
+    sent = []
+
+    def send_broadcast(event, data, room):
+        if room == web.room_channel(1):
+            entered.set()
+            release.wait(5)  # медленная рассылка, например публикация в очередь
+        sent.append((room, data['seq']))
+
+    monkeypatch.setattr(web, 'send_broadcast', send_broadcast)
+    slow = threading.Thread(target=web.broadcast, args=('new_message', {}, 1))
+    slow.start()
+    assert entered.wait(5)
+    try:
+        fast = threading.Thread(target=web.broadcast, args=('new_message', {}, 2))
+        fast.start()
+        fast.join(1)
+        assert not fast.is_alive()
+        assert [room for room, _ in sent] == [web.room_channel(2)]
+    finally:
+        release.set()
+        slow.join()
@@ -0,0 +1,35 @@
+from conftest import app_context, login, socket_client, web
+
+
+def test_role_change_applies_to_next_request(make_user):
+    creator_id, moderator_id, user_id = make_user('creator'), make_user('moderator'), make_user()
+    moderator = login(moderator_id)
+    assert moderator.post('/unmute_user', json={'user_id': user_id}).status_code == 200  # пользователь в кэше
+
+    assert login(creator_id).post('/admin/change_role', json={'user_id': moderator_id, 'role': 'user'}).json['success']
+
+    assert moderator.post('/mute_user', json={'user_id': user_id, 'duration': '10m'}).status_code == 403
+
+
+def test_deleted_user_is_logged_out_on_next_request(make_user, make_room):
+    creator_id, user_id = make_user('creator'), make_user()
+    room_id, _ = make_room()
+    client = login(user_id)
+    socket = socket_client(client)
+    assert client.get('/chat').status_code == 200
+    assert socket.emit('join', {'room_id': room_id}, callback=True)['success']
+
+    assert login(creator_id).post('/admin/delete_user', json={'user_id': user_id}).json['success']
+
+    assert client.get('/chat').status_code == 302
+    assert not socket.emit('join', {'room_id': room_id}, callback=True)
+    socket.disconnect()
+
+
+def test_zero_ttl_reads_user_from_database(make_user):
+    user_id = make_user()
+    cache = web.UserCache(0, 10)
+    with app_context():
+        assert cache.get(user_id).id == user_id
+        assert cache.get(user_id).id == user_id
+    assert cache.stats()['size'] == 0
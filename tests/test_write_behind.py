@@ -0,0 +1,42 @@
+import pytest
+from sqlalchemy import delete, select
+
+from conftest import app_context, login, web
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    message_writer = web.MessageWriteBehind(batch_size=1000, interval=60)
+    monkeypatch.setattr(web, 'message_writer', message_writer)
+    return message_writer
+
+
+def flush_and_fetch_authors(writer, message_ids):
+    with app_context() as session:
+        writer.flush()
+        return set(session.scalars(select(web.Message.user_id).where(web.Message.id.in_(message_ids))))
+
+
+def test_deleting_user_drops_buffered_messages(writer, make_user):
+    creator_id, author_id, reader_id = make_user('creator'), make_user(), make_user()
+    with app_context():
+        row = writer.enqueue(author_id, web.default_room_id, 'ещё в буфере')
+
+    response = login(creator_id).post('/admin/delete_user', json={'user_id': author_id})
+    assert response.json['success']
+
+    assert flush_and_fetch_authors(writer, [row['id']]) == set()
+    assert login(reader_id).get('/chat').status_code == 200
+
+
+def test_flush_skips_rows_of_already_deleted_users(writer, make_user):
+    author_id, deleted_id = make_user(), make_user()
+    with app_context() as session:
+        rows = [writer.enqueue(author_id, web.default_room_id, 'остаётся'),
+                writer.enqueue(deleted_id, web.default_room_id, 'без автора')]
+        # Пользователь удалён в обход delete_users_cascade, строка осталась в буфере
+        session.execute(delete(web.User).where(web.User.id == deleted_id))
+        session.commit()
+
+    assert flush_and_fetch_authors(writer, [row['id'] for row in rows]) == {author_id}
+    assert writer.wait_committed(rows[-1]['id'], timeout=0)